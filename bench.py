@@ -0,0 +1,386 @@
+"""
+Micro-benchmarks for the jobspec parsers.
+
+usage: python bench.py [benchmark[:argument] ...]
+
+e.g. python bench.py suite:small,medium,large
+"""
+import os
+import sys
+import json
+import time
+import random
+import timeit
+import tempfile
+import threading
+import subprocess
+
+import parse_resource_string as prs
+import resource_match
+from phase_stats import rss_bytes
+
+BARE_COUNTS = ['1', '2', '16', '1024', '4:15', '1:15:*4', '0:8:+2']
+BRACKETED_COUNTS = ['[1]', '[2:8]', '[1:15:+2]']
+
+
+def report(name, seconds, ops):
+    print '%-40s %10.2f us/op' % (name, seconds * 1e6 / ops)
+
+
+def run(name, fn, number, ops_per_call=1):
+    best = min(timeit.repeat(fn, number=number, repeat=3))
+    report(name, best, number * ops_per_call)
+
+
+def bench_parse_range(number=2000):
+    counts = BARE_COUNTS + BRACKETED_COUNTS
+
+    def reference():
+        for c in counts:
+            prs.parse_range_pyparsing(c)
+
+    def cold():
+        prs._range_cache.clear()
+        for c in counts:
+            prs.parse_range(c)
+
+    def warm():
+        for c in counts:
+            prs.parse_range(c)
+
+    run('parse_range pyparsing + exception', reference, number, len(counts))
+    run('parse_range single pass (cold cache)', cold, number, len(counts))
+    run('parse_range single pass (warm cache)', warm, number, len(counts))
+
+
+def bench_vertex_memory(path='sequoia.yaml'):
+    import parse_job_spec as pjs
+    with open(path) as f:
+        canonical = pjs.canonicalize(f)
+    before = rss_bytes()
+    start = time.time()
+    g = pjs.to_resource_graph(canonical)
+    elapsed = time.time() - start
+    used = rss_bytes() - before
+    n = g.num_vertices()
+    print '%-40s %10d vertices in %.3fs' % ('to_resource_graph ' + path, n,
+                                           elapsed)
+    print '%-40s %10.1f bytes/vertex' % ('resident memory', float(used) / n)
+
+
+class PeakRSS(threading.Thread):
+    """ Samples the resident set size while running, peak is the highest
+    value seen above the one at start"""
+
+    def __init__(self, interval=0.002):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.start_rss = self.peak_rss = rss_bytes()
+        self.done = threading.Event()
+
+    def run(self):
+        while not self.done.is_set():
+            self.peak_rss = max(self.peak_rss, rss_bytes())
+            self.done.wait(self.interval)
+
+    def stop(self):
+        self.done.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, rss_bytes())
+        return self.peak_rss - self.start_rss
+
+
+def phase(results, name, fn, *args):
+    """ Run fn(*args) as phase name, recording its time and peak memory"""
+    sampler = PeakRSS()
+    sampler.start()
+    start = time.time()
+    ret = fn(*args)
+    results[name] = {'seconds': time.time() - start,
+                     'peak_bytes': sampler.stop()}
+    return ret
+
+
+def measure_phases(path, fanout, queries=20):
+    """ Per-phase time and peak memory of loading the cluster in path, built
+    by gen_spec.cluster(fanout), and querying it, in this process"""
+    import gen_spec
+    import parse_job_spec as pjs
+    results = {}
+    with open(path) as f:
+        text = f.read()
+    docs = phase(results, 'yaml', lambda: list(pjs.iter_documents(text)))
+    canonical = phase(results, 'canonicalize', pjs.canonicalize_inner, docs[0])
+    g = phase(results, 'to_resource_graph', pjs.to_resource_graph, canonical)
+    phase(results, 'resource_tree', pjs.resource_tree, g)
+    requests = [pjs.canonicalize_inner(j['request'])
+                for j in gen_spec.jobs(queries, fanout)]
+    phase(results, 'query', lambda: [pjs.query(g, r) for r in requests])
+    return {'vertices': g.num_vertices(), 'phases': results}
+
+
+SCALES = {'small': 10 ** 4, 'medium': 10 ** 5, 'large': 10 ** 6}
+
+# (name, gen_spec.cluster options)
+SUITE_VARIANTS = [('named', {'names': True, 'pools': True}),
+                  ('short', {'names': False, 'pools': False,
+                             'short_form': True})]
+
+PHASES = ('yaml', 'canonicalize', 'to_resource_graph', 'resource_tree',
+          'query')
+
+RESULTS = os.environ.get('BENCH_RESULTS', os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'bench_results.jsonl'))
+
+
+def git_commit():
+    """ Short hash of HEAD, with + when the tree has uncommitted changes"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=here).strip()
+        dirty = subprocess.call(['git', 'diff', '--quiet', 'HEAD'], cwd=here)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('+' if dirty else '')
+
+
+def previous_results(path=RESULTS):
+    """ The latest stored record per scenario from another commit"""
+    commit = git_commit()
+    ret = {}
+    if not os.path.exists(path):
+        return ret
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if record['commit'] != commit:
+                ret[record['scenario']] = record
+    return ret
+
+
+def bench_suite(scales='small,medium'):
+    """ Load and query generated clusters of each scale in a fresh process
+    per scenario, append the results to RESULTS and compare each phase to
+    the last results stored from another commit"""
+    import yaml
+    import gen_spec
+    here = os.path.dirname(os.path.abspath(__file__))
+    previous = previous_results()
+    commit = git_commit()
+    tmp = tempfile.mkdtemp()
+    try:
+        for scale in scales.split(','):
+            fanout = gen_spec.fanout_for(SCALES[scale])
+            for variant, options in SUITE_VARIANTS:
+                scenario = '%s-%s' % (scale, variant)
+                path = os.path.join(tmp, scenario + '.yaml')
+                with open(path, 'w') as f:
+                    yaml.safe_dump(gen_spec.cluster(fanout, **options), f,
+                                   default_flow_style=False)
+                out = subprocess.check_output(
+                    [sys.executable, '-c', 'import bench, json; print '
+                     'json.dumps(bench.measure_phases(%r, %r))'
+                     % (path, fanout)], cwd=here)
+                record = dict(json.loads(out.splitlines()[-1]),
+                              scenario=scenario, commit=commit,
+                              time=time.time(), fanout=fanout)
+                report_phases(record, previous.get(scenario))
+                with open(RESULTS, 'a') as f:
+                    f.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+        import shutil
+        shutil.rmtree(tmp)
+
+
+def report_phases(record, before=None):
+    print '%s (%d vertices)' % (record['scenario'], record['vertices'])
+    for name in PHASES:
+        p = record['phases'][name]
+        line = '  %-38s %10.3fs %10.1f MB' % (name, p['seconds'],
+                                              p['peak_bytes'] / 2.0 ** 20)
+        if before is not None and name in before['phases']:
+            b = before['phases'][name]
+            line += '   x%.2f vs %s' % (
+                p['seconds'] / max(b['seconds'], 1e-6), before['commit'])
+        print line
+
+
+def bench_block_build(path='sequoia.yaml'):
+    """ to_resource_graph of path through add_block, the flattened arrays
+    assigned in bulk, and through add_resource one vertex at a time"""
+    import parse_job_spec as pjs
+    with open(path) as f:
+        canonical = pjs.canonicalize(f)
+    g, block = timed(pjs.to_resource_graph, canonical, False, True)
+    g, incremental = timed(pjs.to_resource_graph, canonical, False, False)
+    n = g.num_vertices()
+    print '%-40s %10.3fs %8.2f us/vertex' % (
+        'add_resource ' + path, incremental, incremental * 1e6 / n)
+    print '%-40s %10.3fs %8.2f us/vertex  x%.2f' % (
+        'add_block ' + path, block, block * 1e6 / n, incremental / block)
+
+
+def bench_parallel_build(workers='2,4,8', scales='small,medium,large'):
+    """ to_resource_graph of generated clusters of each scale, serially and
+    split per rack across each number of worker processes (no more than
+    the cpus), the parallel build forced whatever
+    parse_job_spec.PARALLEL_MIN_VERTICES says. The break-even is the
+    smallest cluster a parallel build was faster for."""
+    import multiprocessing
+    import gen_spec
+    import parse_job_spec as pjs
+    cpus = multiprocessing.cpu_count()
+    counts = [int(w) for w in workers.split(',') if 1 < int(w) <= cpus]
+    print '%d cpus' % cpus
+    threshold = pjs.PARALLEL_MIN_VERTICES
+    even = None
+    try:
+        pjs.PARALLEL_MIN_VERTICES = 0
+        for scale in scales.split(','):
+            canonical = pjs.canonicalize_inner(gen_spec.cluster(
+                gen_spec.fanout_for(SCALES[scale])))
+            g, serial = timed(pjs.to_resource_graph, canonical)
+            n = g.num_vertices()
+            print '%-40s %10.3fs' % ('build %s (%d), serial' % (scale, n),
+                                     serial)
+            for w in counts:
+                g, elapsed = timed(pjs.to_resource_graph, canonical, False,
+                                   True, w)
+                print '%-40s %10.3fs  x%.2f' % (
+                    'build %s (%d), %d workers' % (scale, n, w), elapsed,
+                    serial / elapsed)
+                if elapsed < serial and even is None:
+                    even = n
+    finally:
+        pjs.PARALLEL_MIN_VERTICES = threshold
+    print '%-40s %10s  (PARALLEL_MIN_VERTICES %d)' % (
+        'break-even vertices', even or 'none', threshold)
+
+
+def synthetic_day(jobs, seed=0):
+    """ (submit, duration, id, request) for jobs node requests of 1 to 1024
+    nodes arriving uniformly over a day"""
+    rng = random.Random(seed)
+    ret = []
+    for i in range(jobs):
+        nodes = 2 ** rng.randint(0, 10)
+        ret.append((rng.uniform(0, 86400), rng.uniform(60, 4 * 3600),
+                    'job%d' % i, {'type': 'node', 'count': {'min': nodes}}))
+    return ret
+
+
+def bench_replay(path='sequoia.yaml', jobs=2000):
+    import parse_job_spec as pjs
+    with open(path) as f:
+        g = pjs.to_resource_graph(pjs.canonicalize(f))
+    start = time.time()
+    allocator = pjs.allocation(g)
+    setup = time.time() - start
+    start = time.time()
+    stats = resource_match.replay(allocator, synthetic_day(jobs))
+    elapsed = time.time() - start
+    print '%-40s %10.3fs' % ('allocation setup ' + path, setup)
+    print '%-40s %10.3fs %s' % ('replay %d jobs' % jobs, elapsed, stats)
+    report('per submission', elapsed, jobs)
+
+
+# imported by parse_job_spec only where they are used
+DEFERRED_MODULES = ('graph_tool', 'numpy', 'resource_match', 'matplotlib',
+                    'networkx', 'pytoml', 'axon', 'sexpdata',
+                    'multiprocessing', 'canonical_cache', 'argparse')
+
+COLD_START = """
+import sys, time
+start = time.time()
+import parse_job_spec
+imported = time.time()
+parse_job_spec.canonicalize(open(%r))
+done = time.time()
+loaded = [m for m in %r if m in sys.modules]
+print imported - start, done - imported, ','.join(loaded)
+"""
+
+
+def bench_import(path='hype.yaml', repeat=5):
+    """ Cold start of a short-lived process that only canonicalizes: import
+    parse_job_spec and canonicalize one file in a fresh interpreter, then
+    what importing the deferred modules up front would add"""
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = COLD_START % (path, DEFERRED_MODULES)
+    runs = []
+    for i in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=here)
+        imported, canonical, loaded = (out.split() + [''])[:3]
+        runs.append((float(imported), float(canonical)))
+    imported, canonical = min(runs)
+    print '%-40s %10.3fs' % ('import parse_job_spec', imported)
+    print '%-40s %10.3fs' % ('canonicalize ' + path, canonical)
+    print '%-40s %10s' % ('deferred modules loaded', loaded or 'none')
+    for name in DEFERRED_MODULES:
+        code = 'import time; start = time.time(); import %s; ' \
+               'print time.time() - start' % name
+        try:
+            out = subprocess.check_output([sys.executable, '-c', code],
+                                          stderr=open(os.devnull, 'w'))
+        except subprocess.CalledProcessError:
+            print '%-40s %10s' % ('  deferred ' + name, 'missing')
+            continue
+        print '%-40s %10.3fs' % ('  deferred ' + name, float(out))
+
+
+def timed(fn, *args):
+    start = time.time()
+    ret = fn(*args)
+    return ret, time.time() - start
+
+
+def bench_snapshot(path='sequoia.yaml'):
+    import tempfile
+    import graph_tool as gt
+    import parse_job_spec as pjs
+    with open(path) as f:
+        canonical = pjs.canonicalize(f)
+    g, build = timed(pjs.to_resource_graph, canonical)
+    tmp = tempfile.mkdtemp()
+    graphml = os.path.join(tmp, 'graph.graphml')
+    snapshot = os.path.join(tmp, 'graph.snap')
+    try:
+        _, graphml_save = timed(g.save, graphml)
+        _, graphml_load = timed(gt.load_graph, graphml)
+        _, snapshot_save = timed(pjs.save_snapshot, g, snapshot, canonical)
+        _, snapshot_load = timed(pjs.load_snapshot, snapshot)
+        print '%-40s %10.3fs' % ('rebuild from yaml ' + path, build)
+        print '%-40s %10.3fs %10.3fs save %12d bytes' % (
+            'load graphml', graphml_load, graphml_save,
+            os.path.getsize(graphml))
+        print '%-40s %10.3fs %10.3fs save %12d bytes' % (
+            'load snapshot', snapshot_load, snapshot_save,
+            os.path.getsize(snapshot))
+    finally:
+        for p in (graphml, snapshot):
+            if os.path.exists(p):
+                os.unlink(p)
+        os.rmdir(tmp)
+
+
+BENCHMARKS = {
+    'block_build': bench_block_build,
+    'import': bench_import,
+    'parallel_build': bench_parallel_build,
+    'parse_range': bench_parse_range,
+    'replay': bench_replay,
+    'snapshot': bench_snapshot,
+    'suite': bench_suite,
+    'vertex_memory': bench_vertex_memory,
+}
+
+if __name__ == '__main__':
+    for arg in sys.argv[1:] or sorted(BENCHMARKS):
+        name, _, argument = arg.partition(':')
+        if argument:
+            BENCHMARKS[name](argument)
+        else:
+            BENCHMARKS[name]()
@@ -0,0 +1,155 @@
+"""
+Content-addressed on-disk cache of canonical jobspecs.
+
+Entries are keyed by the sha1 of the raw input bytes salted with the
+grammar/canonicalizer versions, stored as zlib-compressed marshal data and
+evicted least-recently-used first once the cache grows past max_bytes.
+"""
+import os
+import sys
+import zlib
+import marshal
+import hashlib
+import tempfile
+import unittest
+import collections
+
+CacheStats = collections.namedtuple('CacheStats',
+        ['hits', 'misses', 'stores', 'evictions', 'bytes'])
+
+# marshal's format is only stable within a python version
+FORMAT = 'marshal-zlib-%d.%d' % sys.version_info[:2]
+
+
+def plain(obj):
+    """Convert dict/list subclasses (frozen cache results) for marshal"""
+    if isinstance(obj, dict):
+        return dict((k, plain(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [plain(v) for v in obj]
+    return obj
+
+
+class CanonicalCache(object):
+    def __init__(self, root, max_bytes=256 << 20, salt=''):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.salt = FORMAT + '\0' + salt + '\0'
+        self.hits = self.misses = self.stores = self.evictions = 0
+        self.size = None  # computed on the first store
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    def key(self, data):
+        return hashlib.sha1(self.salt + data).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key[2:])
+
+    def get(self, data):
+        """Return the cached canonical form of data or None"""
+        p = self.path(self.key(data))
+        try:
+            with open(p, 'rb') as f:
+                ret = marshal.loads(zlib.decompress(f.read()))
+        except (IOError, OSError, ValueError, EOFError, zlib.error):
+            self.misses += 1
+            return None
+        try:
+            os.utime(p, None)  # mark as recently used
+        except OSError:
+            pass
+        self.hits += 1
+        return ret
+
+    def put(self, data, canonical):
+        try:
+            blob = zlib.compress(marshal.dumps(plain(canonical)))
+        except ValueError:
+            return  # holds something marshal can not encode, e.g. a date
+        p = self.path(self.key(data))
+        d = os.path.dirname(p)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        fd, tmp = tempfile.mkstemp(dir=d)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(blob)
+        os.rename(tmp, p)  # atomic, concurrent writers store the same bytes
+        self.stores += 1
+        if self.size is None:
+            self.size = sum(s for s, m, e in self.entries())
+        else:
+            self.size += len(blob)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        for sub in os.listdir(self.root):
+            d = os.path.join(self.root, sub)
+            if not os.path.isdir(d):
+                continue
+            for name in os.listdir(d):
+                p = os.path.join(d, name)
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                yield st.st_size, st.st_mtime, p
+
+    def evict(self, target=None):
+        """Drop least recently used entries until at most target bytes remain,
+        by default 90% of max_bytes"""
+        if target is None:
+            target = self.max_bytes * 9 // 10
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        self.size = sum(e[0] for e in entries)
+        for size, mtime, p in entries:
+            if self.size <= target:
+                break
+            try:
+                os.unlink(p)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        self.evict(0)
+
+    def stats(self):
+        if self.size is None:
+            self.size = sum(s for s, m, e in self.entries())
+        return CacheStats(self.hits, self.misses, self.stores, self.evictions,
+                          self.size)
+
+
+class TestCanonicalCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = CanonicalCache(self.root, max_bytes=1 << 20, salt='1:1')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def test_roundtrip(self):
+        doc = {'type': 'node', 'count': {'min': 4}, 'with': [{'type': 'core'}]}
+        self.assertIsNone(self.cache.get('type: Node'))
+        self.cache.put('type: Node', doc)
+        self.assertEqual(self.cache.get('type: Node'), doc)
+        self.assertEqual(self.cache.stats().hits, 1)
+        self.assertEqual(self.cache.stats().misses, 1)
+
+    def test_salt_changes_key(self):
+        other = CanonicalCache(self.root, salt='1:2')
+        self.cache.put('Node', {'type': 'node'})
+        self.assertIsNone(other.get('Node'))
+
+    def test_eviction(self):
+        self.cache.max_bytes = 4096
+        for i in range(64):
+            self.cache.put('doc %d' % i, {'payload': os.urandom(200).encode('hex')})
+        stats = self.cache.stats()
+        self.assertTrue(stats.evictions > 0)
+        self.assertTrue(stats.bytes <= 4096)
+        self.assertIsNotNone(self.cache.get('doc 63'))
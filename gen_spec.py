@@ -0,0 +1,187 @@
+"""
+Synthetic cluster descriptions and job streams for benchmarks.
+
+usage: python gen_spec.py cluster [--fanout 4,16,2,8 | --vertices N] [...]
+       python gen_spec.py jobs [-n 100] [--fanout ...] [...]
+
+Clusters nest LEVELS with the given fan-out beneath a single cluster, jobs
+are the documents iter_jobs reads (submit, duration, id, request).
+"""
+import sys
+import random
+import argparse
+import unittest
+
+import yaml
+
+LEVELS = ('rack', 'node', 'socket', 'core', 'pu')
+
+
+def hostnames(prefix, first, count, width):
+    return '%s[%0*d-%0*d]' % (prefix, width, first, width, first + count - 1)
+
+
+def cluster(fanout=(4, 16, 2, 8), names=True, pools=True, short_form=False,
+            name='synthetic'):
+    """
+    A cluster with fanout[i] instances of LEVELS[i] beneath each instance of
+    the level above. With names the racks are listed one by one and their
+    nodes named by hostlists (n[0001-0016], n[0017-0032], ...) instead of
+    counted, pools gives every node a memory pool and short_form writes the
+    two deepest levels as a short-form string (Core[8]>PU[2]).
+    """
+    depth = len(fanout)
+    if not 1 <= depth <= len(LEVELS):
+        raise ValueError("fanout needs 1 to %d levels" % len(LEVELS))
+    tail = min(2, depth) if short_form else 0
+
+    def level(i):
+        if i == depth:
+            return None
+        if i >= depth - tail:
+            return '>'.join('%s[%d]' % (LEVELS[j].capitalize(), fanout[j])
+                            for j in range(i, depth))
+        ret = {'type': LEVELS[i], 'count': fanout[i]}
+        inner = level(i + 1)
+        if LEVELS[i] == 'node' and pools:
+            memory = {'type': 'memory', 'unit': 'GB',
+                      'count': 4 * product(fanout[i + 1:])}
+            inner = [memory] if inner is None else [inner, memory]
+        if inner is not None:
+            ret['with'] = inner
+        return ret
+
+    ret = {'type': 'cluster', 'name': name}
+    if names and depth >= 2 and tail < depth - 1:
+        racks = []
+        width = len(str(fanout[0] * fanout[1]))
+        for r in range(fanout[0]):
+            nodes = level(1)
+            del nodes['count']
+            nodes['names'] = hostnames('n', r * fanout[1] + 1, fanout[1], width)
+            racks.append({'type': 'rack', 'name': 'rack%d' % r,
+                          'with': nodes})
+        ret['with'] = racks
+    else:
+        ret['with'] = level(0)
+    return ret
+
+
+def product(counts):
+    ret = 1
+    for c in counts:
+        ret *= c
+    return ret
+
+
+def vertex_count(fanout, pools=True):
+    """ Vertices of the graph to_resource_graph builds for cluster(fanout),
+    its root and the cluster vertex included"""
+    ret = 2
+    for i in range(len(fanout)):
+        ret += product(fanout[:i + 1])
+    if pools and len(fanout) >= 2:
+        ret += product(fanout[:2])
+    return ret
+
+
+def fanout_for(vertices, shape=(2, 8), nodes_per_rack=64, pools=True):
+    """ Fan-out of a cluster of about the given number of vertices: racks of
+    nodes_per_rack nodes with shape beneath each node"""
+    per_rack = vertex_count((1, nodes_per_rack) + tuple(shape), pools) - 2
+    racks = max(1, int(round(float(vertices - 2) / per_rack)))
+    return (racks, nodes_per_rack) + tuple(shape)
+
+
+def request(rng, fanout, pools=True, short_form=True):
+    """ A random request for nodes and what is in them"""
+    if len(fanout) < 2:
+        return 'Rack[1]'
+    nodes = 2 ** rng.randint(0, max(0, len(bin(fanout[1])) - 3))
+    kind = rng.randint(0, 3)
+    if kind == 0 or len(fanout) < 3:
+        return 'Node[%d]' % nodes if short_form else \
+            {'type': 'node', 'count': nodes}
+    inner = LEVELS[len(fanout) - 1]
+    per_node = product(fanout[2:])
+    if kind == 1 and short_form:
+        return 'Node[%d]>%s[%d:%d]' % (nodes, inner.capitalize(), 1, per_node)
+    ret = {'type': 'node', 'count': nodes,
+           'with': [{'type': inner, 'count': rng.randint(1, per_node)}]}
+    if kind == 3 and pools:
+        ret['with'].append({'type': 'memory', 'unit': 'GB',
+                            'count': 2 * per_node})
+    return ret
+
+
+def jobs(n, fanout=(4, 16, 2, 8), pools=True, short_form=True, seed=0,
+         span=86400):
+    """ n job documents arriving uniformly over span seconds"""
+    rng = random.Random(seed)
+    ret = []
+    for i in range(n):
+        ret.append({'id': 'job%d' % i,
+                    'submit': round(rng.uniform(0, span), 3),
+                    'duration': round(rng.uniform(60, 4 * 3600), 3),
+                    'request': request(rng, fanout, pools, short_form)})
+    ret.sort(key=lambda j: j['submit'])
+    return ret
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='gen_spec.py')
+    parser.add_argument('what', choices=('cluster', 'jobs'))
+    parser.add_argument('--fanout', default=None,
+                        help='instances per level, e.g. 4,16,2,8')
+    parser.add_argument('--vertices', type=int, default=None,
+                        help='size the cluster to about this many vertices')
+    parser.add_argument('--no-names', dest='names', action='store_false')
+    parser.add_argument('--no-pools', dest='pools', action='store_false')
+    parser.add_argument('--short-form', action='store_true')
+    parser.add_argument('-n', '--jobs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.fanout:
+        fanout = tuple(int(c) for c in args.fanout.split(','))
+    elif args.vertices:
+        fanout = fanout_for(args.vertices, pools=args.pools)
+    else:
+        fanout = (4, 16, 2, 8)
+    if args.what == 'cluster':
+        yaml.safe_dump(cluster(fanout, args.names, args.pools, args.short_form),
+                       sys.stdout, default_flow_style=False)
+    else:
+        yaml.safe_dump_all(jobs(args.jobs, fanout, args.pools, True, args.seed),
+                           sys.stdout, default_flow_style=False)
+    return 0
+
+
+class TestGenerate(unittest.TestCase):
+    def test_cluster(self):
+        import hostlist
+        c = cluster((3, 5, 2, 4))
+        self.assertEqual(len(c['with']), 3)
+        self.assertEqual(c['with'][2]['with']['names'], 'n[11-15]')
+        names = sum((hostlist.expand_hostlist(r['with']['names'])
+                     for r in c['with']), [])
+        self.assertEqual(len(set(names)), 15)
+        short = cluster((2, 4, 2, 8), names=False, pools=False, short_form=True)
+        self.assertEqual(short['with']['with']['with'], 'Socket[2]>Core[8]')
+        self.assertEqual(vertex_count((3, 5, 2, 4)), 2 + 3 + 15 + 30 + 120 + 15)
+
+    def test_sizing(self):
+        fanout = fanout_for(10 ** 6)
+        self.assertTrue(abs(vertex_count(fanout) - 10 ** 6) < 10 ** 5)
+
+    def test_jobs(self):
+        import parse_job_spec as pjs
+        docs = jobs(50, (2, 16, 2, 8), seed=1)
+        self.assertEqual(docs, jobs(50, (2, 16, 2, 8), seed=1))
+        stream = yaml.safe_dump_all(docs)
+        parsed = list(pjs.iter_jobs(stream))
+        self.assertEqual(len(parsed), 50)
+        self.assertEqual(parsed[0][2], docs[0]['id'])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,64 +1,272 @@
 import glob
-import uuid
 import sys
-import pyparsing as pp
 import os
-import fileinput
-import pprint
-import unittest
 import yaml
 import parse_resource_string as prs
-import pytoml
-import axon
+import phase_stats
 import json
-import sexpdata
-import networkx as nx
-from networkx.algorithms import isomorphism
-from networkx.readwrite import json_graph
 import copy
-import matplotlib.pyplot as plt
+import io
+import struct
+import itertools
 import collections
+import array
 import hostlist
 import cmd
+import time
+import shutil
+import tempfile
+import unittest
 
-# drawing
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-
-import graph_tool as gt
-import graph_tool.draw as gt_draw
+# graph_tool, numpy, resource_match, drawing (matplotlib, graph_tool.draw),
+# multiprocessing, pickling, argument parsing and the alternate serializers
+# are imported where they are used: canonicalizing a document does not pay
+# for them
 
-NodeType = collections.namedtuple('NodeType', ['type','instances'])
-EdgeType = collections.namedtuple('EdgeType', ['type','instances'])
 # Task = collections.namedtuple('Program', ['type', 'command', 'walltime'])
 # Resource = collections.namedtuple('Resource', ['type', 'pool', 'units'])
 
-types = {
-        'program' : NodeType('program', []),
-        }
+
+class TypeRegistry(object):
+    """ Per-graph index of vertex and edge instances by type.
+
+    Instances are kept as vertex/edge indices in compact integer arrays, the
+    registry lives in the graph's 'registry' property and goes away with it.
+    """
+
+    def __init__(self):
+        import resource_match
+        self.vertices = {}
+        self.edges = {}
+        # 'with' parent of each vertex by index, -1 for the root
+        self.parents = array.array('l')
+        # slot_id -> vertex indices, and executable vertices without
+        # executable descendants, both maintained as the graph is built
+        self.slots = {}
+        self.executable_leaves = set()
+        self.executable_ancestors = set()
+        # string -> index into the graph's 'strings' table
+        self.string_codes = {'': 0}
+        # hostnames of named resources as compressed ranges
+        self.names = resource_match.NameIndex()
+        # vertices taken out by delta documents, they keep their index
+        self.removed = set()
+        # (num_vertices, num_edges), ResourceTree built for them by query()
+        self.tree = None
+
+    def add_vertex(self, t, v):
+        """ Record v as an instance of t, returns its per-type ordinal"""
+        instances = self.vertices.get(t, None)
+        if instances is None:
+            instances = self.vertices[t] = array.array('l')
+        instances.append(int(v))
+        self.parents.append(-1)
+        return len(instances) - 1
+
+    def add_edge(self, t, e, source, target):
+        if t == 'with':
+            self.parents[int(target)] = int(source)
+        instances = self.edges.get(t, None)
+        if instances is None:
+            instances = self.edges[t] = array.array('l')
+        instances.append(e)
+        return len(instances) - 1
+
+    def add_resource(self, v, slot_id, executable):
+        """ Index an attached resource vertex by slot_id and executability"""
+        v = int(v)
+        if slot_id:
+            instances = self.slots.get(slot_id, None)
+            if instances is None:
+                instances = self.slots[slot_id] = array.array('l')
+            instances.append(v)
+        if executable:
+            self.executable_leaves.add(v)
+            self.add_executable_ancestors(self.parents[v])
+
+    def add_executable_ancestors(self, u):
+        """ u and its ancestors have an executable descendant: they stop
+        being leaves, stopping at the first one already known"""
+        while u >= 0 and u not in self.executable_ancestors:
+            self.executable_ancestors.add(u)
+            self.executable_leaves.discard(u)
+            u = self.parents[u]
+
+    def merge(self, other, base, edge_base):
+        """ Append the registry of a graph whose vertices and edges were
+        appended to this one's from index base and edge_base on. Its roots
+        stay roots until attach()ed."""
+        import numpy as np
+        def shifted(a, k):
+            # indices moved by k, -1 (no parent) stays
+            values = np.frombuffer(a, a.typecode)
+            ret = array.array(a.typecode)
+            ret.fromstring(np.where(values >= 0, values + k, values).astype(
+                a.typecode).tostring())
+            return ret
+        self.parents.extend(shifted(other.parents, base))
+        for key, offset in (('vertices', base), ('edges', edge_base),
+                            ('slots', base)):
+            mine = getattr(self, key)
+            for t, a in getattr(other, key).iteritems():
+                mine.setdefault(t, array.array('l')).extend(shifted(a, offset))
+        self.executable_leaves.update(v + base
+                                      for v in other.executable_leaves)
+        self.executable_ancestors.update(v + base
+                                         for v in other.executable_ancestors)
+        self.removed.update(v + base for v in other.removed)
+        for run in other.names.live_runs():
+            self.names.add_run(*(run[:5] + (run[5] + base, run[6])))
+
+    def __getstate__(self):
+        """ Arrays are pickled as raw bytes, the caches built from the graph
+        are dropped"""
+        state = dict(self.__dict__, tree=None)
+        state['parents'] = (self.parents.typecode, self.parents.tostring())
+        for key in ('vertices', 'edges', 'slots'):
+            state[key] = dict((t, (a.typecode, a.tostring()))
+                              for t, a in state[key].iteritems())
+        return state
+
+    def __setstate__(self, state):
+        import resource_match
+        def unpack(packed):
+            ret = array.array(packed[0])
+            ret.fromstring(packed[1])
+            return ret
+        state['parents'] = unpack(state['parents'])
+        for key in ('vertices', 'edges', 'slots'):
+            state[key] = dict((t, unpack(p)) for t, p in state[key].iteritems())
+        state.setdefault('names', resource_match.NameIndex())
+        state.setdefault('removed', set())
+        self.__dict__.update(state)
+
+    def remove_resources(self, vertices, slot_ids):
+        """ Drop removed vertices from the slot, executable and name indices.
+        Type instances keep them: ordinals are the vertices' labels."""
+        vertices = set(int(v) for v in vertices)
+        for slot_id in set(slot_ids):
+            if slot_id in self.slots:
+                self.slots[slot_id] = array.array('l', (
+                    v for v in self.slots[slot_id] if v not in vertices))
+        self.executable_leaves -= vertices
+        self.executable_ancestors -= vertices
+        for v in vertices:
+            self.names.discard(v)
+        self.removed |= vertices
+
+    def slot_vertices(self, slot_id):
+        return self.slots.get(slot_id, array.array('l'))
+
+    def vertices_of_type(self, t):
+        """ Indices of all vertices of type t"""
+        return self.vertices.get(t, array.array('l'))
+
+    def edges_of_type(self, t):
+        return self.edges.get(t, array.array('l'))
+
+    def vertex_types(self):
+        return self.vertices.keys()
+
+    def edge_types(self):
+        return self.edges.keys()
+
+
+_vertex_phase = phase_stats.phase('vertices')
+_hostlist_phase = phase_stats.phase('hostlist')
+
 
 def add_with_type(g, t):
-    v = g.add_vertex()
-    # print t
-    if types.get(t, None) is None:
-        types[t] = NodeType(t, [])
-    tgt = types[t]
-    g.vp.type[v] = tgt.type
-    g.vp.data[v] = {}
-    g.vp.label[v] = t + '-' + str(len(tgt.instances))
-    tgt.instances.append(v)
+    with _vertex_phase:
+        v = g.add_vertex()
+        # print t
+        g.vp.type[v] = intern_string(g, t)
+        g.vp.ordinal[v] = g.gp.registry.add_vertex(t, v)
+        g.vp.count_min[v] = 1
+        g.vp.count_max[v] = 1
+        _vertex_phase.items += 1
     return v
 
+
+def expand_hostlist(expr):
+    """ hostlist.expand_hostlist, counted in the 'hostlist' phase"""
+    with _hostlist_phase:
+        ret = hostlist.expand_hostlist(expr)
+        _hostlist_phase.items += len(ret)
+    return ret
+
 def add_edge_type(g, f, to, t='with'):
     # print f
     e = g.add_edge(f, to)
-    if types.get(t, None) is None:
-        types[t] = EdgeType(t, [])
-    tgt = types[t]
-    g.ep.type[e] = tgt.type
-    tgt.instances.append(e)
+    g.ep.type[e] = intern_string(g, t)
+    g.gp.registry.add_edge(t, g.edge_index[e], f, to)
     return e
 
+def intern_string(g, s):
+    """ Code of s in the graph's string table, adding it if needed"""
+    codes = g.gp.registry.string_codes
+    c = codes.get(s, None)
+    if c is None:
+        c = codes[s] = len(g.gp.strings)
+        g.gp.strings.append(s)
+    return c
+
+
+# vertex attributes held as codes into the graph's string table
+INTERNED_ATTRS = ('type', 'unit', 'slot_id', 'walltime')
+
+
+def set_vertex_attr(g, v, key, value):
+    """ Store a vertex attribute in its typed map, types, units, slot ids
+    and walltimes as interned strings and commands as argument vectors.
+    Other keys go to the sparse overflow store, so vertices without them
+    cost nothing."""
+    if key in INTERNED_ATTRS:
+        g.vp[key][v] = intern_string(g, str(value))
+    elif key == 'command':
+        g.vp.command[v] = as_list(value)
+    else:
+        g.gp.overflow.setdefault(int(v), {})[key] = value
+
+
+def get_vertex_attr(g, v, key, default=None):
+    """ An attribute stored by set_vertex_attr, or the label of v: its type
+    and per-type ordinal, e.g. core-12"""
+    if key in INTERNED_ATTRS:
+        c = g.vp[key][v]
+        return g.gp.strings[c] if c else default
+    elif key == 'label':
+        return g.gp.strings[g.vp.type[v]] + '-' + str(g.vp.ordinal[v])
+    elif key == 'command':
+        return list(g.vp.command[v]) or default
+    return g.gp.overflow.get(int(v), {}).get(key, default)
+
+
+def pop_vertex_attr(g, v, key, default=None):
+    """ Remove and return an overflow attribute of v"""
+    extra = g.gp.overflow.get(int(v), None)
+    if not extra:
+        return default
+    ret = extra.pop(key, default)
+    if not extra:
+        del g.gp.overflow[int(v)]
+    return ret
+
+
+def edge_type(g, e):
+    return g.gp.strings[g.ep.type[e]]
+
+
+def vertex_data(g, v):
+    """ All attributes of v as one dict, what the old 'data' map held"""
+    ret = dict(g.gp.overflow.get(int(v), {}))
+    for key in ('walltime', 'command'):
+        value = get_vertex_attr(g, v, key)
+        if value is not None:
+            ret[key] = value
+    return ret
+
+
 def add_typed_and_attach(g, t, parent, edge_type='with'):
     v = add_with_type(g, t)
     add_edge_type(g, parent, v, edge_type)
@@ -69,6 +277,14 @@ def add_typed_and_attach(g, t, parent, edge_type='with'):
 next_id = 1
 
 
+def reserve_ids(n):
+    """ Reserve a block of n consecutive ids, returns the first one"""
+    global next_id
+    first = next_id
+    next_id += n
+    return first
+
+
 def get_id():
     global next_id
     # return str(uuid.uuid4())
@@ -95,6 +311,12 @@ def get_node_type(node):
     return t
 
 
+def as_list(l):
+    if isinstance(l, (list, tuple)):
+        return list(l)
+    return [l]
+
+
 def canonicalize_list(l):
     new_list = []
     for n in l:
@@ -102,6 +324,7 @@ def canonicalize_list(l):
     return new_list
 
 
+@phase_stats.timed('canonicalize')
 def canonicalize_inner(node, node_type=None):
     # print "NODE", node
     if isinstance(node, str):  # bare string, it's a resource, should use tags for this
@@ -130,8 +353,16 @@ def canonicalize_inner(node, node_type=None):
                     else:
                         ret[name] = canonicalize_inner(node[name])
 
+            if node.get('with>', False):
+                # "with>" is the long-form spelling of the plain out-link,
+                # prs.link_name() folds it into "with" for short-form strings
+                out = canonicalize_inner(ret.pop('with>'), 'resource')
+                if ret.get('with', None) is None:
+                    ret['with'] = out
+                else:
+                    ret['with'] = as_list(ret['with']) + as_list(out)
             for k in node:
-                if k in ('with', 'name', 'type', 'count'):
+                if k in ('with', 'with>', 'name', 'type', 'count'):
                     continue
                 ret[k] = node[k]
             if  ret.get('executable', None) is None:
@@ -150,18 +381,72 @@ def canonicalize_inner(node, node_type=None):
     return node
 
 
+# libyaml's loader when pyyaml was built with it, the pure-python one otherwise
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def iter_documents(stream):
+    """ Lazily load the yaml documents in stream (a string or a file)"""
+    return phase_stats.timed_iter('yaml', yaml.load_all(stream,
+                                                         Loader=YamlLoader))
+
+
+def iter_canonical(stream):
+    """ Yield the canonical form of each document in stream as it is read,
+    nothing is kept between documents so memory does not grow with the
+    length of the stream"""
+    for c in iter_documents(stream):
+        yield canonicalize_inner(c)
+
+
+def iter_parse(stream):
+    """ Yield (canonical, original) pairs for each document in stream"""
+    for c in iter_documents(stream):
+        yield canonicalize_inner(c), c
+
+
+# bump when canonicalize_inner output changes, persistent caches are keyed on it
+CANONICALIZER_VERSION = 1
+
+disk_cache = None
+
+
+def enable_disk_cache(root, max_bytes=256 << 20):
+    """ Opt in to the persistent cache of canonical documents under root"""
+    import canonical_cache
+    global disk_cache
+    disk_cache = canonical_cache.CanonicalCache(
+        root, max_bytes,
+        salt='%s:%s' % (prs.GRAMMAR_VERSION, CANONICALIZER_VERSION))
+    return disk_cache
+
+
+def disable_disk_cache():
+    global disk_cache
+    disk_cache = None
+
+
+if os.environ.get('JOBSPEC_CACHE_DIR'):
+    enable_disk_cache(os.environ['JOBSPEC_CACHE_DIR'])
+
+
 def canonicalize(yaml_conf):
     """ Generate a complete canonical program list from the input spec"""
-    ret = []
-    for c in yaml.load_all(yaml_conf):
-        ret.append(canonicalize_inner(c))
+    if disk_cache is None:
+        ret = list(iter_canonical(yaml_conf))
+    else:
+        data = yaml_conf.read() if hasattr(yaml_conf, 'read') else yaml_conf
+        ret = disk_cache.get(data)
+        if ret is None:
+            # plain dicts and lists as a hit reads them back, not the frozen
+            # results shared by the parse_resource_string cache
+            ret = prs.thaw(list(iter_canonical(data)))
+            disk_cache.put(data, ret)
     return ret if len(ret) > 1 else ret[0]
 
 
 def parse(spec):
-    ret = []
-    for c in yaml.load_all(spec):
-        ret.append((canonicalize_inner(c), c))
+    ret = list(iter_parse(spec))
     return ret if len(ret) > 1 else ret[0]
 
 
@@ -170,20 +455,49 @@ def add_resource(g, r, node, parent):
     vtx = add_typed_and_attach(g, node['type'], parent)
     if node['type'] == 'task':
         print "adding task"
-        g.vp.data[vtx]['command'] = node.get('command', ['flux', 'start'])
-        connect_task(g, node, vtx)
+        set_vertex_attr(g, vtx, 'command', r.get('command', ['flux', 'start']))
+        connect_task(g, r, vtx)
     else:
         g.vp.pool[vtx] = node['pool']
-        g.vp.unit[vtx] = node['unit']
-        g.vp.slot_id[vtx] = node.get('slot_id', "")
+        set_vertex_attr(g, vtx, 'unit', node['unit'])
+        set_vertex_attr(g, vtx, 'slot_id', node.get('slot_id', ""))
         g.vp.executable[vtx] = node.get('executable', False)
-        print node
-        print g.vp.executable[vtx], node.get('executable', 15)
+        g.gp.registry.add_resource(
+            vtx, get_vertex_attr(g, vtx, 'slot_id', ""), g.vp.executable[vtx])
+        # pools: number of units, aggregates: number of instances represented
+        g.vp.count_min[vtx] = node.get('count', 1)
+        g.vp.count_max[vtx] = node.get('count', 1)
+        if node.get('count', 1) > 1 and not node['pool']:
+            set_vertex_attr(g, vtx, 'spec', r)
     sl = r.get('with', None)
     if sl is not None:
         add_level_to_graph(g, sl, vtx)
 
 
+def counted_instances(rng, pool, compact):
+    """ Number of vertices to build for a resource with count rng and the
+    count_min/count_max each of them carries"""
+    r_min = 0
+    r_max = 1
+    if isinstance(rng, int):
+        r_max = rng
+    else:
+        if isinstance(rng, str):
+            rng = prs.process_range(rng)
+        if isinstance(rng, dict):
+            r_min = rng.get('min', 1)
+            r_max = rng.get('max', None)
+            if r_max is None:
+                r_max = r_min
+                r_min = 0
+    if pool:  # only one, but with a size
+        return 1, r_max - r_min
+    if compact and r_max - r_min > 1:
+        # one aggregate vertex standing for all instances, see materialize
+        return 1, r_max - r_min
+    return max(r_max - r_min, 0), 1
+
+
 def add_resources_to_graph(g, r, t, parent):
     # print r
     if isinstance(r, str):
@@ -193,10 +507,14 @@ def add_resources_to_graph(g, r, t, parent):
             add_typed_and_attach(g, r, parent)
         else:
             add_resources_to_graph(g, r, t, parent)
-    elif type(r) in (list, set, tuple):
+    elif isinstance(r, (list, set, tuple)):
         for sr in r:
             add_resources_to_graph(g, sr, t, parent)
     elif isinstance(r, dict):
+        if g.gp.vectorized and vectorizable(r):
+            flattener = Flattener(g.gp.compact)
+            add_block(g, flattener.resources(r, t), flattener.table, parent)
+            return
         t = r.get('type', t)
         # vtx = add_typed_and_attach(g, t, parent)
         # g.vp.unit[vtx] = r.get('unit', 'units')
@@ -205,48 +523,39 @@ def add_resources_to_graph(g, r, t, parent):
         node = {'id': get_id(),
                 'type': t,
                 'unit': r.get('unit', 'units'),
+                'slot_id': r.get('slot_id', ""),
                 'executable':r.get('executable', False)}
         node['pool'] = r.get('unit', 'units') != 'units'
-        r_min = 0
-        r_max = 1
         rng = r.get('count', None)
         if rng is None:
             ids = r.get('ids', False)
             if ids:
                 c_node = copy.deepcopy(node)
-                for res_id in hostlist.expand_hostlist(ids):
+                for res_id in expand_hostlist(ids):
                     c_node['id'] = res_id
                     add_resource(g, r, c_node, parent)
                 return
             names = r.get('names', False)
             if names:
-                c_node = copy.deepcopy(node)
-                for res_id in hostlist.expand_hostlist(names):
-                    c_node['id'] = get_id()
-                    c_node['name'] = res_id
-                    add_resource(g, r, c_node, parent)
+                # every instance builds the same subtree: the names are
+                # indexed as ranges over its first vertex and its size
+                first = g.num_vertices()
+                names = expand_hostlist(names)
+                for res_id in names:
+                    node['id'] = get_id()
+                    add_resource(g, r, node, parent)
+                stride = (g.num_vertices() - first) // max(len(names), 1)
+                g.gp.registry.names.add(names, first, stride)
                 return
         else:
             if r.get('ids', False) or r.get('names', False):
                 raise AttributeError(
                     "ids and names must not be specified with count!")
 
-        if isinstance(rng, int):
-            r_max = rng
-        else:
-            if isinstance(rng, str):
-                rng = prs.process_range(rng)
-            if isinstance(rng, dict):
-                r_min = rng.get('min', 1)
-                r_max = rng.get('max', None)
-                if r_max is None:
-                    r_max = r_min
-                    r_min = 0
-        if node['pool']:  # only one, but with a size
-            r_max = r_min + 1
-
+        instances, node['count'] = counted_instances(rng, node['pool'],
+                                                     g.gp.compact)
         c_node = copy.deepcopy(node)
-        for i in range(r_min, r_max):
+        for i in range(instances):
             c_node['id'] = get_id()
             add_resource(g, r, c_node, parent)
 
@@ -260,10 +569,425 @@ def add_resources_to_graph(g, r, t, parent):
         raise RuntimeError("Invalid resource:" + str(r))
 
 
+class NotVectorizable(Exception):
+    """ Resource subtree that has to go through add_resource one by one"""
+
+
+class ResourceBlock(object):
+    """ A flattened resource subtree in build (pre-)order.
+
+    parent holds block-local indices with -1 for the block's roots, the
+    other columns hold per-vertex values, strings as codes into the
+    Flattener's table. specs maps block indices of aggregate vertices to
+    the spec materialize() expands them from, names block indices to the
+    (names, stride) of the instances starting there.
+    """
+    columns = ('parent', 'type', 'unit', 'slot', 'pool', 'executable', 'count')
+
+    def __init__(self, n=0):
+        import numpy as np
+        self.parent = np.full(n, -1, np.int64)
+        self.type = np.zeros(n, np.int32)
+        self.unit = np.zeros(n, np.int32)
+        self.slot = np.zeros(n, np.int32)
+        self.pool = np.zeros(n, np.bool_)
+        self.executable = np.zeros(n, np.bool_)
+        self.count = np.ones(n, np.int64)
+        self.specs = {}
+        self.names = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    @staticmethod
+    def concat(blocks):
+        import numpy as np
+        out = ResourceBlock()
+        if not blocks:
+            return out
+        parents = []
+        offset = 0
+        for b in blocks:
+            p = b.parent + offset
+            p[b.parent < 0] = -1
+            parents.append(p)
+            for k, spec in b.specs.iteritems():
+                out.specs[k + offset] = spec
+            for k, names in b.names.iteritems():
+                out.names[k + offset] = names
+            offset += len(b)
+        out.parent = np.concatenate(parents)
+        for c in ResourceBlock.columns[1:]:
+            setattr(out, c, np.concatenate([getattr(b, c) for b in blocks]))
+        return out
+
+    def tile(self, n):
+        """ n consecutive copies of this block"""
+        import numpy as np
+        size = len(self)
+        out = ResourceBlock()
+        offsets = np.repeat(np.arange(n, dtype=np.int64) * size, size)
+        out.parent = np.tile(self.parent, n)
+        roots = out.parent < 0
+        out.parent += offsets
+        out.parent[roots] = -1
+        for c in ResourceBlock.columns[1:]:
+            setattr(out, c, np.tile(getattr(self, c), n))
+        for i in range(n):
+            for k, spec in self.specs.iteritems():
+                out.specs[k + i * size] = spec
+            for k, names in self.names.iteritems():
+                out.names[k + i * size] = names
+        return out
+
+    def take(self, rows):
+        """ The block of the given ascending rows, made of whole subtrees:
+        rows whose parent is not taken become roots"""
+        import numpy as np
+        local = np.full(len(self), -1, np.int64)
+        local[rows] = np.arange(len(rows))
+        out = ResourceBlock()
+        parent = self.parent[rows]
+        out.parent = np.where(parent >= 0, local[parent], -1)
+        for c in ResourceBlock.columns[1:]:
+            setattr(out, c, getattr(self, c)[rows])
+        for k, spec in self.specs.iteritems():
+            if local[k] >= 0:
+                out.specs[local[k]] = spec
+        for k, (names, stride) in self.names.iteritems():
+            starts = local[k + stride * np.arange(len(names))]
+            taken = np.flatnonzero(starts >= 0)
+            # the taken instances, in runs of consecutive ones
+            for run in np.split(taken, np.flatnonzero(np.diff(taken) > 1) + 1):
+                if len(run):
+                    out.names[starts[run[0]]] = (
+                        names[run[0]:run[-1] + 1], stride)
+        return out
+
+    def split(self, code, parts):
+        """ (begin, end) row ranges, in order, of the outermost subtrees
+        rooted at vertices of type code, adjacent ones grouped so that
+        there are about parts ranges of the same size"""
+        import numpy as np
+        n = len(self)
+        depth = np.zeros(n, np.int64)
+        up = self.parent.copy()
+        while (up >= 0).any():
+            below = up >= 0
+            depth += below
+            up[below] = self.parent[up[below]]
+        starts = np.flatnonzero(self.type == code)
+        if not len(starts):
+            return []
+        # a subtree in pre-order ends at the next row no deeper than its root
+        ends = np.full(len(starts), n, np.int64)
+        for d in np.unique(depth[starts]):
+            shallow = np.flatnonzero(depth <= d)
+            at = depth[starts] == d
+            pos = np.searchsorted(shallow, starts[at], 'right')
+            ends[at] = np.where(pos < len(shallow),
+                                shallow[np.minimum(pos, len(shallow) - 1)], n)
+        enclosing = np.maximum.accumulate(ends)
+        outer = starts >= np.concatenate(([0], enclosing[:-1]))
+        starts, ends = starts[outer], ends[outer]
+        sizes = ends - starts
+        group = (np.cumsum(sizes) - sizes) * parts // sizes.sum()
+        first = np.ones(len(starts), np.bool_)
+        first[1:] = (group[1:] != group[:-1]) | (starts[1:] != ends[:-1])
+        first = np.flatnonzero(first)
+        last = np.append(first[1:] - 1, len(starts) - 1)
+        return zip(starts[first].tolist(), ends[last].tolist())
+
+    def under(self, root):
+        """ This block attached below the single-vertex block root"""
+        out = ResourceBlock.concat([root, self])
+        out.parent[len(root):][self.parent < 0] = 0
+        return out
+
+
+class Flattener(object):
+    """ Flattens canonical resource specs into ResourceBlocks, mirroring the
+    vertices add_resources_to_graph would build for them"""
+
+    def __init__(self, compact=False):
+        self.compact = compact
+        self.codes = {'': 0}
+        self.table = ['']
+
+    def code(self, s):
+        c = self.codes.get(s, None)
+        if c is None:
+            c = self.codes[s] = len(self.table)
+            self.table.append(s)
+        return c
+
+    def level(self, n):
+        # same dispatch as add_level_to_graph
+        try:
+            t = n.get('ftype', 'Group')
+        except AttributeError:
+            t = 'Group'
+        if t in ('program', 'task'):
+            raise NotVectorizable(t)
+        return self.resources(n, t)
+
+    def resources(self, r, t):
+        if isinstance(r, str):
+            r = prs.parse_resource_string(r)
+            if isinstance(r, str):
+                raise NotVectorizable(r)
+            return self.resources(r, t)
+        elif isinstance(r, (list, set, tuple)):
+            return ResourceBlock.concat([self.resources(sr, t) for sr in r])
+        elif not isinstance(r, dict):
+            raise RuntimeError("Invalid resource:" + str(r))
+        t = r.get('type', t)
+        if t == 'task':
+            raise NotVectorizable(t)
+        pool = r.get('unit', 'units') != 'units'
+        rng = r.get('count', None)
+        count = 1
+        names = None
+        if rng is None and (r.get('ids', False) or r.get('names', False)):
+            expanded = expand_hostlist(r.get('ids', False) or r['names'])
+            if not r.get('ids', False):
+                names = expanded
+            instances = len(expanded)
+        elif rng is not None and (r.get('ids', False) or r.get('names', False)):
+            raise AttributeError(
+                "ids and names must not be specified with count!")
+        else:
+            instances, count = counted_instances(rng, pool, self.compact)
+
+        root = ResourceBlock(1)
+        root.type[0] = self.code(t)
+        root.unit[0] = self.code(r.get('unit', 'units'))
+        root.slot[0] = self.code(r.get('slot_id', ""))
+        root.pool[0] = pool
+        root.executable[0] = r.get('executable', False)
+        root.count[0] = count
+        if count > 1 and not pool:
+            root.specs[0] = r
+        sl = r.get('with', None)
+        if sl is not None:
+            root = self.level(sl).under(root)
+        out = root.tile(instances)
+        if names:
+            out.names[0] = (names, len(root))
+        return out
+
+
+def vectorizable(n):
+    """ Whether the subtree n consists of resources only, tasks and programs
+    need the incremental builder to see the graph as built so far"""
+    if isinstance(n, dict):
+        if n.get('ftype', None) in ('program', 'task') or \
+                n.get('type', None) == 'task':
+            return False
+        return vectorizable(n.get('with', None))
+    if isinstance(n, (list, set, tuple)):
+        return all(vectorizable(sn) for sn in n)
+    if isinstance(n, str):
+        r = prs.parse_resource_string(n)
+        return not isinstance(r, str) and vectorizable(r)
+    return True
+
+
+@phase_stats.timed('vertices')
+def add_block(g, block, table, parent, ordinals=None):
+    """ Add a flattened resource block below parent: one add_edge_list call,
+    array assignment for every column, strings as their codes in the
+    graph's string table, and bulk registry updates. With parent None the
+    block's roots are left unattached. ordinals are the per-type label
+    numbers to start from when not the registry's instance counts."""
+    import numpy as np
+    n = len(block)
+    if n == 0:
+        return
+    _vertex_phase.items += n
+    registry = g.gp.registry
+    base = g.num_vertices()
+    vids = np.arange(base, base + n, dtype=np.int64)
+    parents = block.parent + base
+    parents[block.parent < 0] = -1 if parent is None else int(parent)
+    reserve_ids(n)
+    first_edge = g.num_edges()
+    g.add_vertex(n)
+    if parent is None:
+        g.add_edge_list(np.column_stack((parents, vids))[block.parent >= 0])
+    else:
+        g.add_edge_list(np.column_stack((parents, vids)))
+
+    end = base + n
+    g.vp.pool.a[base:end] = block.pool
+    g.vp.executable.a[base:end] = block.executable
+    g.vp.count_min.a[base:end] = block.count
+    g.vp.count_max.a[base:end] = block.count
+    codes = np.array([intern_string(g, s) for s in table], np.int32)
+    g.vp.type.a[base:end] = codes[block.type]
+    g.vp.unit.a[base:end] = codes[block.unit]
+    g.vp.slot_id.a[base:end] = codes[block.slot]
+    # add_edge_list appended the 'with' edge of every attached vertex
+    edges = np.arange(first_edge, g.num_edges(), dtype=np.int64)
+    g.ep.type.a[first_edge:g.num_edges()] = intern_string(g, 'with')
+
+    ordinals = ordinals or {}
+    ordinal = np.zeros(n, np.int64)
+    for c in np.unique(block.type):
+        t = table[c]
+        rows = np.flatnonzero(block.type == c)
+        ordinal[rows] = np.arange(len(rows)) + ordinals.get(
+            t, len(registry.vertices_of_type(t)))
+        if t not in registry.vertices:
+            registry.vertices[t] = array.array('l')
+        registry.vertices[t].fromlist(vids[rows].tolist())
+    g.vp.ordinal.a[base:end] = ordinal
+
+    for i, spec in block.specs.iteritems():
+        set_vertex_attr(g, base + i, 'spec', spec)
+    for i, (names, stride) in sorted(block.names.iteritems()):
+        registry.names.add(names, base + i, stride)
+
+    if 'with' not in registry.edges:
+        registry.edges['with'] = array.array('l')
+    registry.edges['with'].fromlist(edges.tolist())
+    registry.parents.fromlist(parents.tolist())
+    for c in np.unique(block.slot[block.slot > 0]):
+        registry.slots.setdefault(table[c], array.array('l')).fromlist(
+            vids[block.slot == c].tolist())
+
+    # executable leaves: executable vertices no executable vertex lies below
+    if block.executable.any():
+        covered = np.zeros(n, np.bool_)
+        frontier = np.unique(block.parent[block.executable])
+        frontier = frontier[frontier >= 0]
+        while len(frontier):
+            frontier = frontier[~covered[frontier]]
+            covered[frontier] = True
+            frontier = np.unique(block.parent[frontier])
+            frontier = frontier[frontier >= 0]
+        registry.executable_leaves.update(
+            vids[block.executable & ~covered].tolist())
+        registry.executable_ancestors.update(vids[covered].tolist())
+        if parent is not None:
+            registry.add_executable_ancestors(int(parent))
+
+
+# blocks smaller than this are built by add_block even when workers are
+# asked for: shipping the partitions back and merging them costs more than
+# building them in parallel saves, see bench.py parallel_build
+PARALLEL_MIN_VERTICES = 10 ** 6
+
+
+def add_block_parallel(g, block, table, parent, split, workers):
+    """ add_block, with the subtrees of block rooted at split vertices
+    (e.g. 'rack') built as separate graphs by up to workers processes, one
+    per cpu at most, and appended in order: vertices get the same ids and
+    labels as from add_block. Blocks under PARALLEL_MIN_VERTICES are built
+    in this process."""
+    import multiprocessing
+    import numpy as np
+    workers = min(workers, multiprocessing.cpu_count())
+    if workers < 2 or len(block) < PARALLEL_MIN_VERTICES:
+        return add_block(g, block, table, parent)
+    ranges = block.split(table.index(split), workers) \
+        if split in table else []
+    if len(ranges) < 2:
+        return add_block(g, block, table, parent)
+    # (rows, partition): the ranges and the rows between them, in order
+    segments = []
+    at = 0
+    for begin, end in ranges + [(len(block), len(block))]:
+        if at < begin:
+            segments.append((np.arange(at, begin), False))
+        if begin < end:
+            segments.append((np.arange(begin, end), True))
+        at = end
+    base = g.num_vertices()
+    registry = g.gp.registry
+    ordinals = dict((t, len(a)) for t, a in registry.vertices.iteritems())
+    blocks = []
+    jobs = []
+    for rows, partition in segments:
+        part = block.take(rows)
+        blocks.append(part)
+        if partition:
+            jobs.append((part, table, g.gp.compact, dict(ordinals)))
+        for c in np.unique(part.type):
+            t = table[c]
+            ordinals[t] = ordinals.get(t, 0) + int((part.type == c).sum())
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        built = pool.imap(build_partition, jobs)
+        for (rows, partition), part in zip(segments, blocks):
+            if partition:
+                merge_partition(g, next(built))
+            else:
+                add_block(g, part, table, None)
+            roots = np.flatnonzero(part.parent < 0)
+            above = block.parent[rows[roots]]
+            for v, u in zip(base + rows[roots],
+                            np.where(above >= 0, base + above, int(parent))):
+                attach(g, int(u), int(v))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def build_partition(job):
+    """ Pool worker: build a partition of add_block_parallel as a graph of
+    its own, returned as its python objects and graph_tool bytes"""
+    block, table, compact, ordinals = job
+    g = new_resource_graph(compact)
+    add_block(g, block, table, None, ordinals)
+    objects, _ = detach_objects(g)
+    f = io.BytesIO()
+    g.save(f, fmt='gt')
+    return objects, f.getvalue()
+
+
+@phase_stats.timed('merge')
+def merge_partition(g, built):
+    """ Append a graph made by build_partition to g, its vertices and edges
+    keeping their order, its roots unattached"""
+    import numpy as np
+    import graph_tool as gt
+    from graph_tool.generation import graph_union
+    objects, data = built
+    part = gt.load_graph(io.BytesIO(data), fmt='gt')
+    base, edge_base = g.num_vertices(), g.num_edges()
+    ours, theirs = dict(g.properties.items()), dict(part.properties.items())
+    keys = [key for key in theirs if key[0] in 've' and key in ours]
+    _, merged = graph_union(g, part, include=True,
+                            props=[(ours[k], theirs[k]) for k in keys])
+    for key, pm in zip(keys, merged):
+        g.properties[key] = pm
+    # the partition's string codes, to the same strings' codes here
+    remap = np.array([intern_string(g, s) for s in part.gp.strings], np.int32)
+    for key in INTERNED_ATTRS:
+        a = g.vp[key].a
+        a[base:] = remap[a[base:]]
+    a = g.ep.type.a
+    a[edge_base:] = remap[a[edge_base:]]
+    phase_stats.phase('merge').items += part.num_vertices()
+    reserve_ids(part.num_vertices())
+    g.gp.registry.merge(objects[('g', 'registry')], base, edge_base)
+    for v, attrs in objects[('g', 'overflow')].iteritems():
+        g.gp.overflow[v + base] = attrs
+
+
+def attach(g, parent, v):
+    """ Add the 'with' edge from parent to the unattached vertex v"""
+    registry = g.gp.registry
+    add_edge_type(g, parent, v)
+    if v in registry.executable_leaves or v in registry.executable_ancestors:
+        registry.add_executable_ancestors(parent)
+
+
 def add_tasks_to_graph(g, t, parent):
     if t is None:
         return
-    elif type(t) in (list, tuple, set):
+    elif isinstance(t, (list, tuple, set)):
         for each in t:
             add_tasks_to_graph(g, each, parent)
     elif isinstance(t, str):
@@ -277,21 +1001,21 @@ def add_tasks_to_graph(g, t, parent):
 
     return
 
+@phase_stats.timed('connect_task')
 def connect_task(graph, task, task_vtx):
+    """ Attach a task to the vertices carrying its slot_id, or without one to
+    every executable leaf built so far"""
+    registry = graph.gp.registry
     target = task.get('slot_id', False)
     if target:
-        for v in graph.vertices():
-            if graph.vp.slot_id[v] == target:
-                add_edge_type(graph, task_vtx, v, 'slot')
-            else:
-                raise RuntimeError("no matching slot-id found")
+        slots = registry.slot_vertices(target)
+        if not slots:
+            raise RuntimeError("no matching slot-id found: " + str(target))
+        for v in slots:
+            add_edge_type(graph, task_vtx, v, 'slot')
     else:
         # print 'deriving task slot'
-        executable = gt.GraphView(graph, vfilt=graph.vp.executable)
-        # print executable
-        e_leaves = gt.GraphView(executable, vfilt=lambda v: v.in_degree() == 1 and v.out_degree() == 0)
-        # print e_leaves
-        for v in e_leaves.vertices():
+        for v in sorted(registry.executable_leaves):
             add_edge_type(graph, task_vtx, v, 'slot')
 
 
@@ -303,7 +1027,7 @@ def add_level_to_graph(g, n, parent, query=False):
         t = 'Group'
     if t == 'program':
         p = add_with_type(g, 'program')
-        g.vp.data[p]['walltime'] = n.get('walltime', '1h')
+        set_vertex_attr(g, p, 'walltime', n.get('walltime', '1h'))
         add_edge_type(g, parent, p)
         try:
             for r in n['resources']:
@@ -313,7 +1037,7 @@ def add_level_to_graph(g, n, parent, query=False):
     elif t == 'task':
         print "adding task"
         p = add_with_type(g, 'task')
-        g.vp.data[p]['command'] = n.get('command', ['flux', 'start'])
+        set_vertex_attr(g, p, 'command', n.get('command', ['flux', 'start']))
         add_edge_type(g, parent, p)
         connect_task(g, n, p)
     else:
@@ -322,25 +1046,105 @@ def add_level_to_graph(g, n, parent, query=False):
     #     raise RuntimeError("unknown node type:" + t)
 
 
-def to_resource_graph(tree):
+@phase_stats.timed('to_resource_graph')
+def to_resource_graph(tree, compact=False, vectorized=True, workers=None,
+                      split='rack'):
+    """
+    Build the resource graph for a canonical jobspec tree. In compact mode a
+    counted resource becomes a single aggregate vertex whose count_min and
+    count_max hold its multiplicity, expand it with materialize().
+    With vectorized, subtrees made only of resources are flattened into
+    arrays and added in bulk, see add_block(). With more than one of
+    workers, a tree made only of resources is built in parallel, the
+    subtrees of its split level (racks) across a process pool, see
+    add_block_parallel().
+    """
+    g = new_resource_graph(compact, vectorized)
+    root = add_with_type(g, 'root')
+    if workers > 1 and vectorized and vectorizable(tree):
+        flattener = Flattener(compact)
+        add_block_parallel(g, flattener.level(tree), flattener.table, root,
+                           split, workers)
+    else:
+        add_level_to_graph(g, tree, root)
+    return g
+
+
+def new_resource_graph(compact=False, vectorized=True):
+    """ An empty graph with the properties and registry of a resource
+    graph"""
+    import graph_tool as gt
     g = gt.Graph()
-    g.ep.type = g.new_ep("string")
-    g.vp.type = g.new_vp("string")
-    g.vp.type = g.new_vp("string")
+    g.gp.compact = g.new_gp("bool")
+    g.gp.compact = compact
+    g.gp.vectorized = g.new_gp("bool")
+    g.gp.vectorized = vectorized
+    g.gp.registry = g.new_gp("object")
+    g.gp.registry = TypeRegistry()
+    # types, units and slot ids as codes into strings, see intern_string,
+    # labels as the per-type ordinal that follows the type
+    g.ep.type = g.new_ep("int")
+    g.vp.type = g.new_vp("int")
     g.ep.data = g.new_ep("object")
-    g.vp.data = g.new_vp("object")
+    # known per-vertex attributes live in typed maps, see set_vertex_attr
+    g.vp.walltime = g.new_vp("int")
+    g.vp.command = g.new_vp("vector<string>")
+    g.gp.strings = g.new_gp("vector<string>")
+    g.gp.strings.append('')
+    g.gp.overflow = g.new_gp("object")
+    g.gp.overflow = {}
     g.vp.count_min = g.new_vp("int")
     g.vp.count_max = g.new_vp("int")
-    g.vp.unit = g.new_vp("string")
-    g.vp.label = g.new_vp("string")
+    g.vp.unit = g.new_vp("int")
+    g.vp.ordinal = g.new_vp("int")
     g.vp.pool = g.new_vp("bool")
-    g.vp.slot_id = g.new_vp("string")
+    g.vp.slot_id = g.new_vp("int")
     g.vp.executable = g.new_vp("bool")
-    root = add_with_type(g, 'root')
-    add_level_to_graph(g, tree, root)
     return g
 
 
+def with_parent(g, v):
+    for e in v.in_edges():
+        if edge_type(g, e) == 'with':
+            return e.source()
+    return None
+
+
+def materialize(g, v, recursive=False):
+    """
+    Expand the aggregate vertex v of a compact graph into individual
+    vertices, v becomes the first instance and its siblings are built from
+    the stored spec. With recursive, aggregates below them are expanded too.
+    Returns the list of instance vertices.
+    """
+    n = g.vp.count_max[v]
+    instances = [v]
+    if not g.vp.pool[v] and n > 1:
+        spec = pop_vertex_attr(g, v, 'spec')
+        parent = with_parent(g, v)
+        node = {'type': get_vertex_attr(g, v, 'type'),
+                'unit': get_vertex_attr(g, v, 'unit', ''),
+                'slot_id': get_vertex_attr(g, v, 'slot_id', ""),
+                'pool': False,
+                'executable': g.vp.executable[v]}
+        g.vp.count_min[v] = 1
+        g.vp.count_max[v] = 1
+        first = g.num_vertices()
+        for i in range(1, n):
+            node['id'] = get_id()
+            add_resource(g, spec, node, parent)
+        instances += [g.vertex(i) for i in range(first, g.num_vertices())
+                      if with_parent(g, g.vertex(i)) == parent]
+    if recursive:
+        stack = list(instances)
+        while stack:
+            u = stack.pop()
+            for e in u.out_edges():
+                if edge_type(g, e) == 'with':
+                    stack.extend(materialize(g, e.target(), recursive=False))
+    return instances
+
+
 def print_res(n, s):
     print '-' * 20, n, '-' * 20
     print '-' * 20, 'size=', len(s), '-' * 20
@@ -366,52 +1170,489 @@ def flatten(root):
     return (nodes, links)
 
 
-def query(graph, match, limit=1):
+def resource_tree(g):
+    """ Array view of the 'with' hierarchy of g for resource_match, with the
+    per-vertex subtree counts, rebuilt only when vertices or edges were
+    added since the last call. A ResourceTree, e.g. one mapped with
+    open_columnar, is returned as is."""
+    import numpy as np
+    import resource_match
+    if isinstance(g, resource_match.ResourceTree):
+        return g
+    registry = g.gp.registry
+    stamp = (g.num_vertices(), g.num_edges())
+    if registry.tree is not None and registry.tree[0] == stamp:
+        return registry.tree[1]
+    # the registry keeps types as spelled, Core and core are one type here
+    # as they are in graft()
+    types, code_of = resource_match.type_table(registry.vertex_types())
+    codes = np.zeros(g.num_vertices(), np.int32)
+    for t, code in code_of.iteritems():
+        codes[np.asarray(registry.vertices_of_type(t), np.int64)] = code
+    pool = np.asarray(g.vp.pool.a, np.bool_)
+    units = dict((v, get_vertex_attr(g, g.vertex(v), 'unit', ''))
+                 for v in np.flatnonzero(pool))
+    tree = resource_match.ResourceTree(
+        np.asarray(registry.parents, np.int64), codes, types,
+        count=g.vp.count_max.a, pool=pool,
+        labels=lambda v: get_vertex_attr(g, g.vertex(v), 'label'), units=units,
+        executable=g.vp.executable.a, names=registry.names)
+    registry.tree = (stamp, tree)
+    return tree
+
+
+def subtree_counts(g, v):
+    """ Instances of each type and pool capacity per (type, unit) beneath
+    one instance of v, e.g. {'node': 1024, 'core': 16384} for a rack"""
+    return resource_tree(g).counts(int(v))
+
+
+def allocation(g):
+    """ Allocation state of g's resources (a graph or a ResourceTree), kept
+    with its resource tree: started over (everything free) when the graph
+    changed since it was created"""
+    import resource_match
+    tree = resource_tree(g)
+    if tree.allocator is None:
+        tree.allocator = resource_match.Allocator(tree)
+    return tree.allocator
+
+
+def save_columnar(g, path):
+    """ Write the resource tree of g as a columnar directory, see
+    resource_match.ResourceTree.save"""
+    resource_tree(g).save(path)
+
+
+def is_columnar(path):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def open_columnar(path):
+    """ Map a columnar resource tree read-only: every process opening it
+    shares one physical copy, the query and allocation functions here take
+    it in place of a graph"""
+    import resource_match
+    return resource_match.ResourceTree.open(path)
+
+
+# graph_tool's adjacency list: per vertex its out/in edge list headers, per
+# edge an entry in the lists of both ends
+GRAPH_VERTEX_BYTES = 48
+GRAPH_EDGE_BYTES = 32
+PROPERTY_BYTES = {'bool': 1, 'uint8_t': 1, 'int16_t': 2, 'short': 2,
+                  'int32_t': 4, 'int': 4, 'int64_t': 8, 'long': 8,
+                  'double': 8, 'float': 8, 'long double': 16,
+                  'python::object': 8}
+
+
+def property_bytes(value_type, value):
+    """ Estimated bytes a graph_tool property of value_type holds for
+    value: std::string keeps up to 15 characters inline, objects count
+    what they reference"""
+    if value_type == 'string':
+        return 32 + (len(value) + 1 if len(value) > 15 else 0)
+    if value_type.startswith('vector<'):
+        inner = value_type[len('vector<'):-1]
+        return 24 + sum(property_bytes(inner, x) for x in value)
+    if value_type == 'python::object' and value is not None:
+        return 8 + phase_stats.deep_sizeof(value)
+    return PROPERTY_BYTES.get(value_type, 8)
+
+
+def vertex_memory(g, sample=1000):
+    """ {type: {'vertices', 'per_vertex', 'bytes'}}: estimated bytes per
+    instance of each vertex type, from up to sample instances spread over
+    all of them. An instance pays for its place in the graph and its 'with'
+    edge, their properties, its overflow attributes, its registry entries
+    and its share of the cached resource tree."""
+    registry = g.gp.registry
+    overflow = g.gp.overflow
+    vprops = [(pm.value_type(), pm) for _, pm in g.vp.items()]
+    eprops = [(pm.value_type(), pm) for _, pm in g.ep.items()]
+    # type instances and parents
+    shared = 2 * registry.parents.itemsize
+    if registry.tree is not None and len(registry.tree[1]):
+        tree = registry.tree[1]
+        shared += float(tree.nbytes()) / len(tree)
+    ret = {}
+    for t in sorted(registry.vertex_types()):
+        instances = registry.vertices_of_type(t)
+        if not len(instances):
+            continue
+        picked = instances[::max(1, len(instances) // sample)]
+        total = 0
+        for i in picked:
+            v = g.vertex(i)
+            total += GRAPH_VERTEX_BYTES
+            total += sum(property_bytes(vt, pm[v]) for vt, pm in vprops)
+            for e in v.in_edges():
+                total += GRAPH_EDGE_BYTES
+                total += sum(property_bytes(vt, pm[e]) for vt, pm in eprops)
+            extra = overflow.get(i, None)
+            if extra is not None:
+                total += phase_stats.deep_sizeof(extra)
+        per_vertex = float(total) / len(picked) + shared
+        ret[t] = {'vertices': len(instances), 'per_vertex': per_vertex,
+                  'bytes': per_vertex * len(instances)}
+    return ret
+
+
+def load_resources(path, compact=False, workers=None):
+    """ (resources, canonical) from path: a columnar directory mapped
+    read-only (no canonical jobspec), a snapshot, or a yaml jobspec built
+    into a graph, by workers processes if more than one"""
+    if os.path.isdir(path):
+        return open_columnar(path), None
+    if is_snapshot(path):
+        return load_snapshot(path)
+    with open(path) as f:
+        canonical = canonicalize(f)
+    return to_resource_graph(canonical, compact=compact,
+                             workers=workers), canonical
+
+
+def iter_jobs(stream):
+    """ Yield (submit, duration, id, canonical request) from a stream of
+    job documents with those keys"""
+    for doc in iter_documents(stream):
+        yield (doc['submit'], doc['duration'], doc['id'],
+               canonicalize_inner(doc['request']))
+
+
+def iter_query(graph, match, budget=None):
+    """ Lazily yield disjoint matches of the canonical request match among
+    the free resources of the graph (or ResourceTree), see
+    resource_match.iter_matches. Nothing is allocated."""
+    import resource_match
+    free = allocation(graph).free.copy()
+    return resource_match.iter_matches(resource_tree(graph), match, free,
+                                       budget)
+
+
+@phase_stats.timed('query')
+def query(graph, match, limit=1, budget=None):
+    """ The first limit matches (None for all) of the canonical request
+    match, each a list of placements per request. Stops early with the
+    matches found so far when the resource_match.Budget runs out."""
+    return list(itertools.islice(iter_query(graph, match, budget), limit))
+
+
+# keys of a delta document, applied in this order
+DELTA_KEYS = ('add', 'remove', 'drain', 'resume')
+
+
+def delta_targets(g, targets):
+    """ Vertices named by targets: a hostlist expression of resource names
+    or labels (rack-0, node-[4-7]), a vertex index or a list of those"""
+    if isinstance(targets, (list, tuple)):
+        return [v for t in targets for v in delta_targets(g, t)]
+    if isinstance(targets, (int, long)):
+        return [targets]
+    registry = g.gp.registry
+    ret = []
+    for name in hostlist.expand_hostlist(str(targets)):
+        v = registry.names.resolve(name)
+        if v is None:
+            t, _, k = name.rpartition('-')
+            instances = registry.vertices_of_type(t)
+            if k.isdigit() and int(k) < len(instances):
+                v = instances[int(k)]
+        if v is None or v in registry.removed:
+            raise ValueError("unknown resource: " + name)
+        ret.append(v)
+    return ret
+
+
+def with_subtree(g, v):
+    """ v and the vertices beneath it along 'with' edges"""
+    ret = [int(v)]
+    for u in ret:
+        for e in g.vertex(u).out_edges():
+            if edge_type(g, e) == 'with':
+                ret.append(int(e.target()))
+    return ret
+
+
+def graft(g, tree, base):
+    """ Append the vertices of g from base on to its resource tree"""
+    import numpy as np
+    end = g.num_vertices()
+    vertices = [g.vertex(v) for v in range(base, end)]
+    pool = np.asarray(g.vp.pool.a[base:end], np.bool_)
+    tree.graft(np.asarray(g.gp.registry.parents[base:end], np.int64),
+               [get_vertex_attr(g, v, 'type') for v in vertices],
+               count=g.vp.count_max.a[base:end], pool=pool,
+               units=[get_vertex_attr(g, v, 'unit', '') if p else ''
+                      for v, p in zip(vertices, pool)],
+               executable=g.vp.executable.a[base:end])
+    if tree.allocator is not None:
+        tree.allocator.grow()
+
+
+def apply_delta(g, delta):
+    """
+    Apply a delta document to the resource graph g in place:
+
+        add: <resources>    attached below each of under, or the root
+        under: <targets>
+        remove: <targets>   taken out with everything beneath them
+        drain: <targets>    no longer handed out by allocation(g)
+        resume: <targets>   handed out again
+
+    resources are in jobspec form, targets as taken by delta_targets().
+    The registry, the resource tree and allocation state are updated for
+    the change only, removed vertices keep their index with a count of 0.
+    Returns the vertices added or targeted.
+    """
+    unknown = set(delta) - set(DELTA_KEYS + ('under',))
+    if unknown:
+        raise ValueError("unknown delta keys: " + ', '.join(sorted(unknown)))
+    registry = g.gp.registry
+    tree = None
+    if registry.tree is not None and \
+            registry.tree[0] == (g.num_vertices(), g.num_edges()):
+        tree = registry.tree[1]
+    ret = []
+    if 'add' in delta:
+        spec = canonicalize_inner(delta['add'], 'resource')
+        for parent in delta_targets(g, delta.get('under', 0)):
+            base = g.num_vertices()
+            add_level_to_graph(g, spec, g.vertex(parent))
+            ret.extend(range(base, g.num_vertices()))
+            if tree is not None:
+                graft(g, tree, base)
+    if 'remove' in delta:
+        vertices = delta_targets(g, delta['remove'])
+        for v in vertices:
+            g.vp.count_min[g.vertex(v)] = 0
+            g.vp.count_max[g.vertex(v)] = 0
+        gone = [u for v in vertices for u in with_subtree(g, v)]
+        registry.remove_resources(
+            gone, [get_vertex_attr(g, g.vertex(u), 'slot_id', "")
+                   for u in gone])
+        if tree is not None and tree.allocator is not None:
+            tree.allocator.remove(vertices)
+        elif tree is not None:
+            tree.prune(vertices)
+        ret.extend(vertices)
+    if tree is not None:
+        registry.tree = ((g.num_vertices(), g.num_edges()), tree)
+    for key in ('drain', 'resume'):
+        if key in delta:
+            vertices = delta_targets(g, delta[key])
+            getattr(allocation(g), key)(vertices)
+            ret.extend(vertices)
+    return ret
+
+
+def apply_deltas(g, stream):
+    """ Apply each delta document in stream to g, returns how many"""
+    count = 0
+    for delta in iter_documents(stream):
+        apply_delta(g, delta)
+        count += 1
+    return count
+
+
+# binary snapshot: magic, format version and payload length, the pickled
+# payload (python object properties, canonical spec, next id), then the
+# graph in graph_tool's native format
+SNAPSHOT_MAGIC = '\x89JSGRAPH'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct('<8sIQ')
+
+
+def is_snapshot(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def detach_objects(g):
+    """ Take the python object properties, which graph_tool's file formats
+    do not keep, off g. Returns their values by property key and the
+    removed maps, to put back with g.properties[key] = pm."""
+    objects = {}
+    removed = []
+    for key, pm in list(g.properties.items()):
+        if pm.value_type() != 'python::object':
+            continue
+        kind = key[0]
+        if kind == 'g':
+            objects[key] = pm[g]
+        elif kind == 'v':
+            objects[key] = dict((int(v), pm[v]) for v in g.vertices()
+                                if pm[v] is not None)
+        else:
+            objects[key] = dict((g.edge_index[e], pm[e]) for e in g.edges()
+                                if pm[e] is not None)
+        removed.append((key, pm))
+        del g.properties[key]
+    return objects, removed
+
+
+def spell_out(g):
+    """ Replace the maps of string codes of g by maps of the strings and add
+    the labels, for formats read outside this module. Returns the replaced
+    maps, to put back with restore_maps()."""
+    strings = list(g.gp.strings)
+    label = g.new_vp("string")
+    for v in g.vertices():
+        label[v] = get_vertex_attr(g, v, 'label')
+    replaced = [(('v', 'label'), None)]
+    coded = [(('v', key), g.vp[key], g.vertices()) for key in INTERNED_ATTRS]
+    coded.append((('e', 'type'), g.ep.type, g.edges()))
+    for key, pm, items in coded:
+        spelled = g.new_vp("string") if key[0] == 'v' else g.new_ep("string")
+        for x in items:
+            spelled[x] = strings[pm[x]]
+        replaced.append((key, pm))
+        g.properties[key] = spelled
+    g.properties[('v', 'label')] = label
+    return replaced
+
+
+def restore_maps(g, replaced):
+    for key, pm in replaced:
+        if pm is None:
+            del g.properties[key]
+        else:
+            g.properties[key] = pm
 
-    m = isomorphism.DiGraphMatcher(
-        graph, match, node_match=isomorphism.categorical_node_match('type', 'resource'))
-    print m.subgraph_is_isomorphic()
-    # for i in  list(m.subgraph_isomorphisms_iter()):
-    # for db, q in i.items():
 
-    for db, q in m.mapping.items():
-        print graph.node[db], '==', match.node[q]
-    sys.exit(1)
-    # for n in graph.successors_iter(0):
-    #     print graph.node[n]
-    #     print graph[n]
-    return ""
+def save_snapshot(g, path, canonical=None):
+    """ Write g, including its registry and attribute overflow, to path"""
+    import cPickle
+    objects, removed = detach_objects(g)
+    try:
+        payload = cPickle.dumps({'objects': objects, 'canonical': canonical,
+                                 'next_id': next_id}, 2)
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                         len(payload)))
+            f.write(payload)
+            g.save(f, fmt='gt')
+    finally:
+        for key, pm in removed:
+            g.properties[key] = pm
+
+
+def load_snapshot(path):
+    """ Read a graph written by save_snapshot, returns (graph, canonical)"""
+    import cPickle
+    import graph_tool as gt
+    global next_id
+    with open(path, 'rb') as f:
+        header = f.read(SNAPSHOT_HEADER.size)
+        if len(header) < SNAPSHOT_HEADER.size:
+            raise ValueError("truncated snapshot: " + path)
+        magic, version, size = SNAPSHOT_HEADER.unpack(header)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("not a snapshot: " + path)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("unsupported snapshot version %d: %s"
+                             % (version, path))
+        payload = cPickle.loads(f.read(size))
+        g = gt.load_graph(io.BytesIO(f.read()), fmt='gt')
+    for key, value in payload['objects'].iteritems():
+        kind = key[0]
+        if kind == 'g':
+            pm = g.new_gp("object")
+            pm[g] = value
+        elif kind == 'v':
+            pm = g.new_vp("object")
+            for i, v in value.iteritems():
+                pm[g.vertex(i)] = v
+        else:
+            pm = g.new_ep("object")
+            if value:
+                edges = dict((g.edge_index[e], e) for e in g.edges())
+                for i, v in value.iteritems():
+                    pm[edges[i]] = v
+        g.properties[key] = pm
+    # ids handed out later must not collide with the loaded ones
+    next_id = max(next_id, payload['next_id'])
+    return g, payload['canonical']
 
 
 class Interactive(cmd.Cmd):
     """Simple load/query interface"""
 
-    def do_load(self, yaml_path):
+    graph = None
+    canonical = None
+    mapped = None
+
+    def resources(self):
+        """ The mapped columnar tree if one was loaded, the graph otherwise"""
+        return self.mapped if self.mapped is not None else self.graph
+
+    def do_load(self, line):
         """
-        load <yaml_path>
-        Load jobspec information from the specified file.
+        load [--compact] [--workers N] <yaml_path>
+        Load jobspec information from the specified file, --compact keeps
+        counted resources as single aggregate vertices, --workers builds
+        the racks of a resource-only jobspec in N processes. Snapshots
+        written by export snapshot are recognized and loaded as they were
+        saved, columnar directories written by export columnar are mapped
+        read-only (query, allocate and replay only).
         """
-        with open(yaml_path) as f:
-            self.canonical = canonicalize(f)
-            # print self.canonical
-            # sys.exit(1)
-        self.graph = to_resource_graph(self.canonical)
-
+        import resource_match
+        args = line.split()
+        workers = None
+        if '--workers' in args:
+            i = args.index('--workers')
+            workers = int(args[i + 1])
+            del args[i:i + 2]
+        compact = '--compact' in args
+        yaml_path = [a for a in args if a != '--compact'][-1]
+        resources, self.canonical = load_resources(yaml_path, compact,
+                                                   workers)
+        if isinstance(resources, resource_match.ResourceTree):
+            self.graph, self.mapped = None, resources
+            print "Successfully mapped", yaml_path
+            return
+        self.graph, self.mapped = resources, None
         print "Successfully loaded", yaml_path
 
+    def do_cache(self, line):
+        """
+        cache [off | <dir> [max_mb]]
+        Enable or disable the persistent canonical cache, show its counters
+        without arguments.
+        """
+        args = line.split()
+        if args and args[0] == 'off':
+            disable_disk_cache()
+        elif args:
+            max_mb = int(args[1]) if len(args) > 1 else 256
+            enable_disk_cache(args[0], max_mb << 20)
+        if disk_cache is None:
+            print "cache disabled"
+        else:
+            print disk_cache.root, disk_cache.stats()
+
     def complete_load(self, text, line, begidx, endidx):
         completions = glob.glob(text + '*')
         return completions
 
     def do_draw(self, line):
         g = self.graph
+        replaced = spell_out(g)
+        try:
+            self.draw(g, line)
+        finally:
+            restore_maps(g, replaced)
 
+    def draw(self, g, line):
+        import matplotlib.pyplot as plt
+        import graph_tool.draw as gt_draw
         spectral = plt.get_cmap('spectral')
-        n_levels = len(types)
+        names = g.gp.registry.vertex_types()
+        n_levels = len(names)
         val = 0.0
         step = 1.0 / n_levels
         colors = {}
-        for k in types.keys():
+        for k in names:
             colors[k] = spectral(val)
             val += step
         g.vp.v_colors = g.new_vp('vector<float>')
@@ -431,7 +1672,7 @@ class Interactive(cmd.Cmd):
                                        vertex_fill_color=g.vp.v_colors,
                                        vertex_size=10,
                                        display_props=[g.vp.type,
-                                                      g.vp.data,
+                                                      g.vp.command,
                                                       g.vp.pool,
                                                       g.vp.unit ])
         # nx.draw_networkx(self.graph)
@@ -443,10 +1684,28 @@ class Interactive(cmd.Cmd):
         """
         export [format] [path]
         Export the graph representation in <format> to a file at [path] or stdout
+        snapshot writes a binary snapshot that load reads back quickly,
+        columnar a directory of arrays that load maps read-only
         """
         args = line.split()
+        if args[:1] in (['graphml'], ['snapshot']) and self.graph is None:
+            print args[0], "export needs a graph, a mapped tree only " \
+                "exports as columnar"
+            return
         if 'graphml' == args[0]:
-            self.graph.save(args[1] if len( args) > 1 else './meh.graphml')
+            replaced = spell_out(self.graph)
+            try:
+                self.graph.save(args[1] if len( args) > 1 else './meh.graphml')
+            finally:
+                restore_maps(self.graph, replaced)
+            return
+        if 'snapshot' == args[0]:
+            save_snapshot(self.graph, args[1] if len(args) > 1 else './meh.snap',
+                          self.canonical)
+            return
+        if 'columnar' == args[0]:
+            save_columnar(self.resources(),
+                          args[1] if len(args) > 1 else './meh.columns')
             return
         # prepare for use with d3 TODO: needs to be fixed after GT conversion
         # gt = json_graph.tree_data(self.graph, 0)
@@ -497,8 +1756,174 @@ class Interactive(cmd.Cmd):
         print >> f, yaml.dump(self.canonical)
 
     def do_query(self, line):
-        with open(line) as f:
-            print query(self.graph, canonicalize(f))
+        """
+        query [--limit N] [--steps N] [--seconds S] <yaml_path>
+        Match the request in the file against the free resources and
+        print where it fits, up to N disjoint matches (default 1, 0 for
+        all) within an optional budget of visited vertices or seconds.
+        """
+        import argparse
+        import resource_match
+        parser = argparse.ArgumentParser(prog='query')
+        parser.add_argument('--limit', type=int, default=1)
+        parser.add_argument('--steps', type=int, default=None)
+        parser.add_argument('--seconds', type=float, default=None)
+        parser.add_argument('path')
+        try:
+            args = parser.parse_args(line.split())
+        except SystemExit:
+            return
+        with open(args.path) as f:
+            request = canonicalize(f)
+        budget = resource_match.Budget(args.steps, args.seconds)
+        found = query(self.resources(), request, args.limit or None, budget)
+        tree = resource_tree(self.resources())
+        for i, placements in enumerate(found):
+            print "match", i
+            print yaml.dump([resource_match.labelled(tree, p)
+                             for p in placements], default_flow_style=False)
+            names = resource_match.placed_hostlist(
+                tree, list(itertools.chain(*placements)))
+            if names:
+                print "hosts:", names
+        if budget.exhausted:
+            print "budget exhausted after", budget.used, "steps,",
+        print len(found), "matches"
+
+    def do_allocate(self, line):
+        """
+        allocate <job_id> <yaml_path>
+        Allocate free resources matching the request in the file to job_id
+        """
+        import resource_match
+        job_id, path = line.split()
+        with open(path) as f:
+            request = canonicalize(f)
+        allocator = allocation(self.resources())
+        placements = allocator.allocate(job_id, request)
+        if placements is None:
+            print "no match"
+        else:
+            print yaml.dump([resource_match.labelled(allocator.tree, p)
+                             for p in placements], default_flow_style=False)
+            names = resource_match.placed_hostlist(
+                allocator.tree, list(itertools.chain(*placements)))
+            if names:
+                print "hosts:", names
+
+    def do_delta(self, line):
+        """
+        delta <yaml_path>
+        Apply add/remove/drain/resume documents to the loaded graph, see
+        apply_delta
+        """
+        if self.graph is None:
+            print "delta needs a graph, load a yaml file or a snapshot"
+            return
+        with open(line.strip()) as f:
+            for delta in iter_documents(f):
+                try:
+                    vertices = apply_delta(self.graph, delta)
+                except ValueError as e:
+                    print e
+                    return
+                print ', '.join(k for k in DELTA_KEYS if k in delta), \
+                    len(vertices), "vertices"
+
+    def do_stats(self, line):
+        """
+        stats [reset | json [path]]
+        Calls, items and cumulative seconds of each load phase so far:
+        yaml, canonicalize, parse_resource_string, hostlist, vertices,
+        merge, connect_task, to_resource_graph and query. json prints them as
+        json or writes them to path, reset starts over.
+        """
+        args = line.split()
+        if args[:1] == ['reset']:
+            phase_stats.reset()
+        elif args[:1] == ['json']:
+            if len(args) > 1:
+                with open(args[1], 'w') as f:
+                    f.write(phase_stats.to_json(indent=2))
+            else:
+                print phase_stats.to_json(indent=2)
+        else:
+            print phase_stats.report()
+
+    def do_memstats(self, line):
+        """
+        memstats [on | off]
+        Memory accounting: on makes the load phases record how much the
+        resident set grew while they ran, without arguments prints that per
+        phase and the estimated bytes per vertex of each resource type of
+        the loaded graph.
+        """
+        args = line.split()
+        if args[:1] in (['on'], ['off']):
+            phase_stats.track_memory(args[0] == 'on')
+            return
+        if not phase_stats.tracking:
+            print "memory accounting is off, turn it on before loading"
+        print phase_stats.report()
+        print "%-24s %10.1f MB" % ("resident",
+                                   phase_stats.rss_bytes() / 2.0 ** 20)
+        if self.canonical is not None:
+            print "%-24s %10.1f MB" % (
+                "canonical jobspec", phase_stats.deep_sizeof(self.canonical)
+                / 2.0 ** 20)
+        if self.mapped is not None:
+            print "%-24s %10.1f MB" % ("mapped resource tree",
+                                       self.mapped.nbytes() / 2.0 ** 20)
+        if self.graph is None:
+            return
+        print "%-24s %10s %12s %10s" % ("type", "vertices", "bytes/vertex",
+                                        "MB")
+        for t, m in sorted(vertex_memory(self.graph).iteritems(),
+                           key=lambda (t, m): -m['bytes']):
+            print "%-24s %10d %12.1f %10.1f" % (t, m['vertices'],
+                                                m['per_vertex'],
+                                                m['bytes'] / 2.0 ** 20)
+
+    def do_resolve(self, line):
+        """
+        resolve <hostlist>
+        Print the vertices named by a hostlist expression, e.g. hype[201-210]
+        """
+        tree = resource_tree(self.resources())
+        for v in tree.names.resolve_hostlist(line.strip()):
+            print tree.names.name(v), v, tree.label(v)
+
+    def do_release(self, line):
+        """
+        release <job_id>
+        Free the resources allocated to job_id
+        """
+        try:
+            allocation(self.resources()).release(line.strip())
+        except ValueError as e:
+            print e
+
+    def do_replay(self, line):
+        """
+        replay <jobs_yaml>
+        Replay job documents (submit, duration, id, request) first come first
+        served against the free resources
+        """
+        import resource_match
+        with open(line.strip()) as f:
+            jobs = list(iter_jobs(f))
+        start = time.time()
+        stats = resource_match.replay(allocation(self.resources()), jobs)
+        print stats, "in %.3fs" % (time.time() - start)
+
+    def do_usage(self, line):
+        """
+        usage
+        Allocated and total amount of each resource type
+        """
+        for column, (used, total) in sorted(
+                allocation(self.resources()).usage().items()):
+            print "%-20s %10d / %d" % (column, used, total)
 
     def do_EOF(self, line):
         return True
@@ -506,9 +1931,368 @@ class Interactive(cmd.Cmd):
     def postloop(self):
         print
 
+def percentile(values, p):
+    """ Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def document_error(path, doc, e):
+    err = {'type': type(e).__name__,
+           'message': getattr(e, 'msg', None) or str(e)}
+    if isinstance(e, prs.ResourceStringError):
+        err['col'] = e.col
+        err['text'] = e.text
+    mark = getattr(e, 'problem_mark', None)  # yaml errors
+    if mark is not None:
+        err['line'] = mark.line + 1
+        err['col'] = mark.column + 1
+    return {'file': path, 'doc': doc, 'error': err}
+
+
+def canonicalize_file(path):
+    """ Canonicalize every document in path, reporting each one separately.
+    Returns (path, seconds, lines, errors), a json line per document holding
+    either the canonical document or the error that stopped it."""
+    start = time.time()
+    lines = []
+    errors = 0
+    doc = 0
+    try:
+        with open(path) as f:
+            for c in iter_documents(f):
+                try:
+                    # yaml dates and other non-json scalars as strings
+                    lines.append(json.dumps(
+                        {'file': path, 'doc': doc,
+                         'canonical': canonicalize_inner(c)},
+                        sort_keys=True, default=str))
+                except Exception as e:
+                    lines.append(json.dumps(document_error(path, doc, e),
+                                            sort_keys=True, default=str))
+                    errors += 1
+                doc += 1
+    except (IOError, yaml.YAMLError) as e:
+        # the stream can not be resumed past a yaml syntax error
+        lines.append(json.dumps(document_error(path, doc, e),
+                                sort_keys=True, default=str))
+        errors += 1
+    return path, time.time() - start, lines, errors
+
+
+def expand_batch_paths(args):
+    paths = []
+    for a in args:
+        if os.path.isdir(a):
+            for root, dirs, files in os.walk(a):
+                paths.extend(os.path.join(root, f) for f in sorted(files)
+                             if f.endswith(('.yaml', '.yml')))
+        else:
+            paths.extend(sorted(glob.glob(a)) or [a])
+    return paths
+
+
+def batch_canonicalize(paths, processes=None, out=sys.stdout):
+    """ Canonicalize the yaml files in paths across a process pool, write one
+    json line per document to out and return a summary dict"""
+    import multiprocessing
+    start = time.time()
+    latencies = []
+    docs = errors = 0
+    pool = multiprocessing.Pool(processes)
+    try:
+        for path, seconds, lines, failed in pool.imap_unordered(
+                canonicalize_file, paths):
+            latencies.append(seconds)
+            docs += len(lines)
+            errors += failed
+            for line in lines:
+                out.write(line + '\n')
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return {'files': len(paths),
+            'docs': docs,
+            'errors': errors,
+            'seconds': elapsed,
+            'docs_per_sec': docs / elapsed if elapsed else 0.0,
+            'file_latency': {'mean': sum(latencies) / len(latencies) if latencies else 0.0,
+                             'p50': percentile(latencies, 50),
+                             'p95': percentile(latencies, 95),
+                             'max': latencies[-1] if latencies else 0.0}}
+
+
+def batch_main(argv):
+    """
+    batch [-j N] [-o out.jsonl] <dir|glob|file> ...
+    Canonicalize jobspec files in bulk, one json line per document.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='parse_job_spec.py batch')
+    parser.add_argument('-j', '--processes', type=int, default=None,
+                        help='worker processes, defaults to the cpu count')
+    parser.add_argument('-o', '--output', default=None,
+                        help='json-lines output file, defaults to stdout')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args(argv)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        summary = batch_canonicalize(expand_batch_paths(args.paths),
+                                     args.processes, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    lat = summary['file_latency']
+    print >> sys.stderr, "%d docs (%d errors) from %d files in %.3fs, %.1f docs/sec" % (
+        summary['docs'], summary['errors'], summary['files'],
+        summary['seconds'], summary['docs_per_sec'])
+    print >> sys.stderr, "per-file latency: mean %.4fs p50 %.4fs p95 %.4fs max %.4fs" % (
+        lat['mean'], lat['p50'], lat['p95'], lat['max'])
+    return 1 if summary['errors'] else 0
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_batch(self):
+        good = self.write('good.yaml', 'resources: Node[2]>Core[4]\n'
+                          '---\n'
+                          'resources: Node[1]\n'
+                          'walltime: 2016-01-01\n')
+        bad = self.write('bad.yaml', 'resources: Node[2]>\n')
+        out = io.BytesIO()
+        summary = batch_canonicalize(expand_batch_paths([self.root]), 1, out)
+        self.assertEqual((summary['files'], summary['docs'],
+                          summary['errors']), (2, 3, 1))
+        records = dict(((r['file'], r['doc']), r) for r in
+                       map(json.loads, out.getvalue().splitlines()))
+        self.assertEqual(records[good, 0]['canonical']['resources']
+                         ['count'], {'min': 2})
+        self.assertEqual(records[good, 1]['canonical']['walltime'],
+                         '2016-01-01')
+        self.assertIn('error', records[bad, 0])
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.saved = disk_cache
+        self.root = tempfile.mkdtemp()
+        enable_disk_cache(self.root)
+
+    def tearDown(self):
+        global disk_cache
+        disk_cache = self.saved
+        shutil.rmtree(self.root)
+
+    def test_same_types(self):
+        spec = 'resources: Node[2]>Core[4]\n'
+        miss, hit = canonicalize(spec), canonicalize(spec)
+        self.assertEqual(disk_cache.stats().hits, 1)
+        self.assertEqual(miss, hit)
+        for doc in miss, hit:
+            node = doc['resources']
+            self.assertIs(type(node), dict)
+            self.assertIs(type(node['with']), list)
+            node['count'] = {'min': 1}
+
+
+def require_graph_tool(test):
+    """ Skip test when graph_tool is not installed"""
+    try:
+        import graph_tool
+    except ImportError:
+        test.skipTest("graph_tool is not installed")
+
+
+def sample(name):
+    """ Path of one of the sample jobspecs next to this file"""
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), name)
+
+
+def build(name, **kwargs):
+    """ The resource graph of a sample jobspec, ids starting over at 1"""
+    global next_id
+    next_id = 1
+    with open(sample(name)) as f:
+        return to_resource_graph(canonicalize(f), **kwargs)
+
+
+def vertex_rows(g):
+    """ The attributes of every vertex of g, in vertex order"""
+    return [(get_vertex_attr(g, v, 'type'), get_vertex_attr(g, v, 'label'),
+             get_vertex_attr(g, v, 'unit'), get_vertex_attr(g, v, 'slot_id'),
+             g.vp.count_min[v], g.vp.count_max[v], g.vp.pool[v],
+             g.vp.executable[v]) for v in g.vertices()]
+
+
+def edge_rows(g):
+    return sorted((int(e.source()), int(e.target()), edge_type(g, e))
+                  for e in g.edges())
+
+
+def registry_rows(g, edges=True):
+    """ The registry of g as plain values, edge instances (edge indices,
+    which depend on the order edges were added in) only with edges"""
+    r = g.gp.registry
+    rows = [sorted((t, list(a)) for t, a in r.vertices.items()),
+            list(r.parents), sorted(r.executable_leaves),
+            sorted(r.executable_ancestors),
+            sorted((s, list(a)) for s, a in r.slots.items()),
+            # named vertices, however their runs were split up
+            sorted((first + k * stride, prefix, start + k, width, suffix)
+                   for prefix, suffix, width, start, count, first, stride
+                   in r.names.live_runs() for k in range(count))]
+    if edges:
+        rows.append(sorted((t, list(a)) for t, a in r.edges.items()))
+    return rows
+
+
+class TestBuild(unittest.TestCase):
+    samples = ('hype.yaml', 'laptop.yaml')
+
+    def setUp(self):
+        require_graph_tool(self)
+
+    def assertSameGraph(self, g, h, edges=True):
+        self.assertEqual(vertex_rows(g), vertex_rows(h))
+        self.assertEqual([vertex_data(g, v) for v in g.vertices()],
+                         [vertex_data(h, v) for v in h.vertices()])
+        self.assertEqual(edge_rows(g), edge_rows(h))
+        self.assertEqual(registry_rows(g, edges), registry_rows(h, edges))
+        self.assertEqual(list(resource_tree(g).columns),
+                         list(resource_tree(h).columns))
+
+    def test_vectorized(self):
+        for name in self.samples:
+            self.assertSameGraph(build(name, vectorized=True),
+                                 build(name, vectorized=False))
+
+    def test_compact(self):
+        for name in self.samples:
+            compact = build(name, compact=True, vectorized=True)
+            self.assertSameGraph(compact,
+                                 build(name, compact=True, vectorized=False))
+            full = build(name)
+            self.assertEqual(resource_tree(compact).counts(0),
+                             resource_tree(full).counts(0))
+            materialize(compact, compact.vertex(0), recursive=True)
+            self.assertEqual(compact.num_vertices(), full.num_vertices())
+            self.assertEqual(sorted(vertex_rows(compact)),
+                             sorted(vertex_rows(full)))
+
+    def test_parallel(self):
+        # one partition per node even on a single cpu
+        import multiprocessing
+        saved = PARALLEL_MIN_VERTICES, multiprocessing.cpu_count
+        globals()['PARALLEL_MIN_VERTICES'] = 0
+        multiprocessing.cpu_count = lambda: 2
+        try:
+            for name in self.samples:
+                # partitions are attached after they are built: same
+                # vertices and edges, edge indices in another order
+                self.assertSameGraph(build(name, workers=2, split='node'),
+                                     build(name), edges=False)
+        finally:
+            globals()['PARALLEL_MIN_VERTICES'] = saved[0]
+            multiprocessing.cpu_count = saved[1]
+
+    def test_snapshot(self):
+        root = tempfile.mkdtemp()
+        try:
+            for name in self.samples:
+                with open(sample(name)) as f:
+                    canonical = canonicalize(f)
+                g = build(name)
+                path = os.path.join(root, name + '.snap')
+                save_snapshot(g, path, canonical)
+                self.assertTrue(is_snapshot(path))
+                loaded, again = load_snapshot(path)
+                self.assertEqual(again, canonical)
+                self.assertSameGraph(loaded, g)
+                self.assertEqual(list(loaded.gp.strings), list(g.gp.strings))
+        finally:
+            shutil.rmtree(root)
+
+    def test_add_block(self):
+        g = new_resource_graph()
+        root = add_with_type(g, 'root')
+        flattener = Flattener(False)
+        with open(sample('laptop.yaml')) as f:
+            block = flattener.level(canonicalize(f))
+        add_block(g, block, flattener.table, root)
+        self.assertEqual(g.num_vertices(), len(block) + 1)
+        self.assertEqual(g.num_edges(), len(block))
+        self.assertSameGraph(g, build('laptop.yaml'))
+
+
+class TestTypeRegistry(unittest.TestCase):
+    def test_ordinals(self):
+        r = TypeRegistry()
+        self.assertEqual([r.add_vertex(t, v) for v, t in
+                          enumerate(['node', 'core', 'core', 'node'])],
+                         [0, 0, 1, 1])
+        self.assertEqual(list(r.vertices_of_type('core')), [1, 2])
+        self.assertEqual(list(r.vertices_of_type('gpu')), [])
+
+    def test_pickle(self):
+        import cPickle
+        require_graph_tool(self)
+        registry = build('hype.yaml').gp.registry
+        copied = cPickle.loads(cPickle.dumps(registry, 2))
+        for key in ('vertices', 'edges', 'slots'):
+            self.assertEqual(
+                dict((t, list(a)) for t, a in getattr(copied, key).items()),
+                dict((t, list(a)) for t, a in getattr(registry, key).items()))
+        self.assertEqual(list(copied.parents), list(registry.parents))
+        self.assertEqual(copied.executable_leaves, registry.executable_leaves)
+        self.assertEqual(copied.string_codes, registry.string_codes)
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        require_graph_tool(self)
+        with open(sample('hype.yaml')) as f:
+            self.graph = to_resource_graph(canonicalize(f))
+        self.tree = resource_tree(self.graph)
+
+    def test_short_form_add(self):
+        # hype declares its cores as core, the short form says Core
+        apply_delta(self.graph, {'add': 'Core[4]', 'under': 'hype[201-202]'})
+        grafted = resource_tree(self.graph)
+        self.assertIs(grafted, self.tree)
+        self.graph.gp.registry.tree = None
+        rebuilt = resource_tree(self.graph)
+        self.assertIsNot(rebuilt, grafted)
+        self.assertEqual(grafted.columns, rebuilt.columns)
+        self.assertEqual(grafted.counts(0), rebuilt.counts(0))
+        self.assertEqual(rebuilt.counts(0)['core'], 154 * 16 + 8)
+        request = canonicalize('Node[1]>Core[20]')
+        for tree in grafted, rebuilt:
+            self.assertEqual(len(query(tree, request, None)), 2)
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['batch']:
+        sys.exit(batch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['serve']:
+        import query_daemon
+        sys.exit(query_daemon.main(sys.argv[2:]))
     Interactive().cmdloop()
 
+    # import pytoml, sexpdata, axon
     # for i, (doc, orig) in enumerate(parse(open(sys.argv[1]))):
     #     print '-' * 50
     #     print '-' * 20, "example", i, '-' * 20
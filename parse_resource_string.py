@@ -1,4 +1,5 @@
 import sys
+import re
 import pyparsing as pp
 import os
 import fileinput
@@ -6,6 +7,18 @@ import pprint
 import unittest
 import yaml
 import hostlist
+import collections
+import threading
+
+import phase_stats
+
+# memoize sub-expression results on cache misses, the rspec grammar backtracks
+# heavily through the link alternatives
+pp.ParserElement.enablePackrat()
+
+# bump when the canonical form produced for a string changes, persistent
+# caches are keyed on it
+GRAMMAR_VERSION = 1
 
 # define punctuation literals
 LPAR, RPAR, LBRK, RBRK, LBRC, RBRC, VBAR, COLON, GT, LT, AT, EQ, DASH, DOLLAR = map(pp.Suppress, "()[]{}|:><@=-$")
@@ -244,13 +257,298 @@ def canonicalize_inner(s, res):
         process_attribute(s, ret, a)
     return ret
 
-def canonicalize(s):
+class ResourceStringError(ValueError):
+    """
+    Syntax error in a short-form resource string or count range, carries
+    the position information of the underlying ParseException.
+    """
+
+    def __init__(self, pfe):
+        ValueError.__init__(self, pfe.msg)
+        self.msg = pfe.msg
+        self.text = pfe.line
+        self.lineno = pfe.lineno
+        self.col = pfe.col
+        self.marked = pfe.markInputline('^')
+
+    def __str__(self):
+        return '%s (line %d, col %d): %s' % (self.msg, self.lineno, self.col,
+                                             self.marked)
+
+    def __reduce__(self):
+        return (_rebuild_error, (self.msg, self.text, self.lineno, self.col,
+                                 self.marked))
+
+
+def _rebuild_error(msg, text, lineno, col, marked):
+    e = ResourceStringError.__new__(ResourceStringError)
+    ValueError.__init__(e, msg)
+    e.msg, e.text, e.lineno, e.col, e.marked = msg, text, lineno, col, marked
+    return e
+
+
+class DescentFallback(Exception):
+    """Input outside the subset handled by the recursive-descent parser"""
+
+
+# pyparsing only skips these between tokens
+_rd_token = re.compile(r'[ \t\n\r]*(?:([A-Za-z0-9_]+)|([^ \t\n\r]))')
+_rd_number = re.compile(r'(?:0|[1-9][0-9]*)$')
+_rd_attribute_start = ('(', '$', ':', '<', '>')
+_rd_stride_operators = ('+', '-', '*', '/', '^')
+_rd_ftypes = {'Shard': 'shard',
+              'Task': 'task',
+              'Instance': 'Instance',
+              'Program': 'Program'}
+
+
+class DescentParser(object):
+    """
+    Predictive recursive-descent parser for the rspec grammar.
+
+    Builds the same canonical dicts as canonicalize_inner directly, without
+    going through ParseResults. Anything outside the supported subset
+    (parenthesized link targets, hostlist id expressions, non-decimal
+    numbers) and every syntax error raises DescentFallback so the caller can
+    defer to the pyparsing reference grammar.
+    """
+
+    def __init__(self, s):
+        self.words = []
+        self.toks = []
+        for word, punct in _rd_token.findall(s):
+            self.words.append(bool(word))
+            self.toks.append(word or punct)
+        self.n = len(self.toks)
+        self.i = 0
+
+    def peek(self):
+        if self.i < self.n:
+            return self.toks[self.i]
+        return None
+
+    def peek_word(self):
+        return self.i < self.n and self.words[self.i]
+
+    def next(self):
+        if self.i >= self.n:
+            raise DescentFallback("unexpected end of input")
+        self.i += 1
+        return self.toks[self.i - 1]
+
+    def expect(self, tok):
+        if self.next() != tok:
+            raise DescentFallback("expected " + tok)
+
+    def word(self):
+        if not self.peek_word():
+            raise DescentFallback("expected identifier")
+        return self.next()
+
+    def number(self):
+        w = self.word()
+        if not _rd_number.match(w):
+            raise DescentFallback("unsupported number " + w)
+        return int(w)
+
+    def parse(self):
+        resources = [self.resource()]
+        while self.peek() == ',':
+            self.i += 1
+            resources.append(self.resource())
+        if self.i != self.n:
+            raise DescentFallback("expected end of text")
+        return resources if len(resources) > 1 else resources[0]
+
+    def range_body(self):
+        d = {'min': self.number()}
+        if self.peek() == ':':
+            self.i += 1
+            if self.peek_word():
+                d['max'] = self.number()
+                if self.peek() == ':':
+                    self.i += 1
+                    op = '+'
+                    if self.peek() in _rd_stride_operators:
+                        op = self.next()
+                    d['stride_operator'] = op
+                    d['stride_operand'] = self.number()
+        return d
+
+    def range_group(self):
+        self.expect('[')
+        d = self.range_body()
+        self.expect(']')
+        return d
+
+    def id_list(self):
+        if self.peek() == '(':
+            raise DescentFallback("hostlist id expressions")
+        return [self.word()]
+
+    def resource(self):
+        ret = {'ftype': 'resource'}
+        rtype = ids = unit = count = None
+        if self.peek() == '@':
+            self.i += 1
+            ids = self.id_list()
+        else:
+            rtype = self.word()
+        tok = self.peek()
+        if tok == '[':
+            count = self.range_group()
+            if self.peek_word():
+                unit = self.next()
+                if not unit.isalpha():
+                    raise DescentFallback("invalid unit " + unit)
+        elif tok == '=':
+            if ids is not None:
+                raise DescentFallback("duplicate id list")
+            self.i += 1
+            ids = self.id_list()
+
+        if rtype in _rd_ftypes:
+            ret['ftype'] = _rd_ftypes[rtype]
+            if rtype == 'Shard':
+                ret['tasks'] = []
+        if ids is not None:
+            ret['ids'] = ids
+        else:
+            ret['type'] = rtype
+        if unit:
+            ret['unit'] = unit
+        if count is not None and count != {'min': 1}:
+            ret['count'] = count
+        if self.peek() in _rd_attribute_start:
+            self.attribute_list(ret)
+        return ret
+
+    def attribute_list(self, ret):
+        tok = self.peek()
+        if tok == '(':
+            self.i += 1
+            self.attribute_or_task(ret)
+            while self.peek() == ',':
+                self.i += 1
+                self.attribute_or_task(ret)
+            self.expect(')')
+        elif tok == '$':
+            self.task(ret)
+            if self.peek() in (':', '<', '>'):
+                self.attribute(ret)
+        else:
+            self.attribute(ret)
+
+    def attribute_or_task(self, ret):
+        if self.peek() == '$':
+            self.task(ret)
+        else:
+            self.attribute(ret)
+
+    def task(self, ret):
+        self.expect('$')
+        nt = {}
+        if self.peek_word():
+            nt['command'] = self.next()
+        if self.peek() == '[':
+            count = self.range_group()
+            if count != {'min': 1}:
+                nt['count'] = count
+        if ret.get('tasks', None) is None:
+            ret['tasks'] = []
+        if nt:
+            ret['tasks'].append(nt)
+
+    def link_type(self):
+        link_type = 'with'
+        count = None
+        if self.peek_word():
+            link_type = self.next()
+        if self.peek() == '[':
+            count = self.range_group()
+        return link_type, count
+
+    def attribute(self, ret):
+        tok = self.next()
+        if tok == ':':
+            if ret.get('tags', None) is None:
+                ret['tags'] = []
+            ret['tags'].append(self.word())
+            return
+        link_type, count = 'with', None
+        if tok == '>':
+            direction = 'out'
+            if self.peek() == '-':
+                self.i += 1
+                link_type, count = self.link_type()
+                self.expect('-')
+                self.expect('>')
+        elif tok == '<':
+            direction = 'in'
+            if self.peek() == '-':
+                self.i += 1
+                link_type, count = self.link_type()
+                self.expect('-')
+                end = self.next()
+                if end == '>':
+                    direction = 'inout'
+                elif end != '<':
+                    raise DescentFallback("expected < or >")
+        else:
+            raise DescentFallback("expected attribute")
+
+        if self.peek() == '(':
+            raise DescentFallback("parenthesized link targets")
+        targets = [self.resource()]
+
+        if link_type == 'with' and direction == 'out' and not count:
+            if ret.get('with', None) is None:
+                ret['with'] = []
+            ret['with'].extend(targets)
+        elif not count:
+            if direction == 'in':
+                ln = '<' + link_type
+            elif direction == 'out':
+                ln = link_type + '>'
+            else:
+                ln = '<' + link_type + '>'
+            if ret.get(ln, None) is None:
+                ret[ln] = []
+            ret[ln].extend(targets)
+        else:
+            if ret.get('links', None) is None:
+                ret['links'] = []
+            link = {'type': link_type,
+                    'direction': direction,
+                    'targets': targets, }
+            if count != {'min': 1}:
+                link['count'] = count
+            ret['links'].append(link)
+
+
+def descent_canonicalize(s):
+    """Canonicalize s with the hand-written parser, raises DescentFallback"""
+    return DescentParser(s).parse()
+
+
+# 'descent' is the fast hand-written parser, 'pyparsing' the reference grammar
+DEFAULT_PARSER = 'descent'
+
+
+def canonicalize(s, parser=None):
+    if parser is None:
+        parser = DEFAULT_PARSER
+    if parser == 'descent':
+        try:
+            return descent_canonicalize(s)
+        except DescentFallback:
+            pass  # the reference grammar handles it or reports the error
+    elif parser != 'pyparsing':
+        raise ValueError("unknown parser: " + str(parser))
     try:
         return canonicalize_inner(s, rspec.parseString(s, parseAll=True))
     except pp.ParseException as pfe:
-        print "Error:", pfe.msg
-        print pfe.markInputline('^')
-        sys.exit(1)
+        raise ResourceStringError(pfe)
 
 def parse_bare_range(s):
     try:
@@ -258,11 +556,10 @@ def parse_bare_range(s):
         parse_range_into(d, bare_range.parseString(s, parseAll=True).count)
         return d
     except pp.ParseException as pfe:
-        print "Error:", pfe.msg
-        print pfe.markInputline('^')
-        sys.exit(1)
+        raise ResourceStringError(pfe)
 
-def parse_range(s):
+def parse_range_pyparsing(s):
+    """Reference range parser, tries the bracketed form then the bare one"""
     try:
         d = {}
         parse_range_into(d, range_group.parseString(s, parseAll=True).count)
@@ -270,8 +567,198 @@ def parse_range(s):
     except pp.ParseException as pfe:
         return parse_bare_range(s)
 
+class FrozenDict(dict):
+    """Read-only dict handed out by the canonical result cache"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("cached canonical results are immutable, use thaw()")
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+class FrozenList(list):
+    """Read-only list handed out by the canonical result cache"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("cached canonical results are immutable, use thaw()")
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _immutable
+    __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = reverse = sort = _immutable
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return thaw(self)
+
+
+def freeze(obj):
+    """Recursively convert a canonical result into FrozenDict/FrozenList"""
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return FrozenList(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    """Recursively convert a frozen canonical result into mutable dicts/lists"""
+    if isinstance(obj, dict):
+        return dict((k, thaw(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [thaw(v) for v in obj]
+    return obj
+
+
+# dump frozen results exactly like their mutable counterparts
+yaml.add_representer(FrozenDict, yaml.representer.SafeRepresenter.represent_dict)
+yaml.add_representer(FrozenList, yaml.representer.SafeRepresenter.represent_list)
+
+CacheInfo = collections.namedtuple('CacheInfo',
+        ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """Bounded least-recently-used mapping with hit/miss/eviction counters,
+    safe to share between threads"""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value  # re-insert as most recently used
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = value
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.data) > max(maxsize, 0):
+                self.data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self.data))
+
+
+_canonical_cache = LRUCache()
+
+
+def cache_info():
+    """Hit/miss/eviction counters of the parse_resource_string cache"""
+    return _canonical_cache.info()
+
+
+def cache_clear():
+    _canonical_cache.clear()
+
+
+def set_cache_size(maxsize):
+    """Bound the parse_resource_string cache to maxsize entries, 0 disables it"""
+    _canonical_cache.resize(maxsize)
+
+
+_parse_phase = phase_stats.phase('parse_resource_string')
+
+
 def parse_resource_string(s):
-    return canonicalize(s)
+    """Memoized canonicalize, results are shared and therefore immutable"""
+    with _parse_phase:
+        ret = _canonical_cache.get(s)
+        if ret is None:
+            ret = freeze(canonicalize(s))
+            _canonical_cache.put(s, ret)
+            _parse_phase.items += 1
+    return ret
+
+# bracketed or bare slice_expr in one pass, same tokens and whitespace rules
+# as range_group/bare_range
+_range_re = re.compile(r'''
+    [ \t\n\r]* (?P<lbrk>\[)?
+    [ \t\n\r]* (?P<min>-?0|[1-9][0-9]*)
+    (?: [ \t\n\r]* :
+        (?: [ \t\n\r]* (?P<max>-?0|[1-9][0-9]*)
+            (?: [ \t\n\r]* :
+                [ \t\n\r]* (?P<stride_operator>[-+*/^])?
+                [ \t\n\r]* (?P<stride_operand>-?0|[1-9][0-9]*)
+            )?
+        )?
+    )?
+    [ \t\n\r]* (?P<rbrk>\])? [ \t\n\r]* $
+    ''', re.VERBOSE)
+
+_range_cache = LRUCache()
+
+
+def range_cache_info():
+    """Hit/miss/eviction counters of the parse_range cache"""
+    return _range_cache.info()
+
+
+def parse_range(s):
+    """
+    Parse a count range, either bracketed ("[4:15]") or bare ("4:15:*2"),
+    into a frozen dict of min/max/stride_operator/stride_operand.
+    """
+    ret = _range_cache.get(s)
+    if ret is not None:
+        return ret
+    m = _range_re.match(s)
+    if m is None or (m.group('lbrk') is None) != (m.group('rbrk') is None):
+        # let the reference parser report the error
+        return freeze(parse_range_pyparsing(s))
+    ret = {'min': int(m.group('min'))}
+    if m.group('max') is not None:
+        ret['max'] = int(m.group('max'))
+    if m.group('stride_operand') is not None:
+        ret['stride_operator'] = m.group('stride_operator') or '+'
+        ret['stride_operand'] = int(m.group('stride_operand'))
+    ret = FrozenDict(ret)
+    _range_cache.put(s, ret)
+    return ret
+
 
 def parse(l):
     try:
@@ -284,9 +771,9 @@ def parse(l):
         # print yaml.dump(asDictDeep(res), default_flow_style=False)
         # pprint.pprint(res.asDict(), width=20)
         # print res.asDict()
-    except pp.ParseException as pfe:
-        print "Error:", pfe.msg
-        print pfe.markInputline('^')
+    except ResourceStringError as e:
+        print "Error:", e.msg
+        print e.marked
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -317,6 +804,14 @@ class TestResource(unittest.TestCase):
         self.assertFalse(res.count.stride_operator)
         self.assertFalse(res.count.stride_operand)
 
+    def test_parse_range(self):
+        for s in ("1024", "4:15", "[4:15]", "[1:15:+2]", "1:15:*4", "1:4:2",
+                  " [ 3: ] ", "0", "-0", "1:4:-0", "[2:8:^ 2]", "7:"):
+            self.assertEqual(parse_range(s), parse_range_pyparsing(s), s)
+        self.assertIs(parse_range("4:15"), parse_range("4:15"))
+        self.assertRaises(ResourceStringError, parse_range, "[4:15")
+        self.assertRaises(ResourceStringError, parse_range, "010")
+
     def test_rspec_single(self):
         r = canonicalize("Node[1:15:+2]")
         self.assertEqual(r['type'], "Node")
@@ -339,3 +834,132 @@ class TestResource(unittest.TestCase):
 
     # def range_group_no_max(self):
 
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        cache_clear()
+        set_cache_size(2)
+
+    def tearDown(self):
+        set_cache_size(LRUCache().maxsize)
+        cache_clear()
+
+    def test_hit_returns_same_object(self):
+        a = parse_resource_string("Node>Core[4]")
+        b = parse_resource_string("Node>Core[4]")
+        self.assertIs(a, b)
+        self.assertEqual(a, canonicalize("Node>Core[4]"))
+        self.assertEqual(cache_info().hits, 1)
+        self.assertEqual(cache_info().misses, 1)
+
+    def test_eviction(self):
+        for s in ("Node", "Core", "Node", "Socket[2]"):
+            parse_resource_string(s)
+        info = cache_info()
+        self.assertEqual(info.evictions, 1)
+        self.assertEqual(info.currsize, 2)
+        parse_resource_string("Node")
+        self.assertEqual(cache_info().hits, 2)
+
+    def test_immutable(self):
+        r = parse_resource_string("Socket[2]>Core[8]")
+        self.assertRaises(TypeError, r.__setitem__, 'type', 'Node')
+        self.assertRaises(TypeError, r['with'].append, {})
+        self.assertRaises(TypeError, r['count'].update, {'min': 3})
+        m = thaw(r)
+        m['with'].append({})
+        self.assertEqual(len(r['with']), 1)
+
+
+
+# short-form strings the descent parser must handle without falling back
+DESCENT_CORPUS = [
+    'Node',
+    'Node>Core[4]',
+    'Socket[2]>Core[8]',
+    'Node[1:15:+2]',
+    'Node[1:4:2]',
+    'Node[3:]',
+    'Node[0]',
+    'Node[1]',
+    'Node[1:2:^3]',
+    'Node[ 2 : 8 : * 2 ]',
+    'gpu_Core[4]>Lane[16]',
+    'Memory[15]MB',
+    'Node[2] MB>Core',
+    'Node:tag',
+    'Node(:a,:b)',
+    'Node$',
+    'Node($)',
+    'Node $x',
+    'Node$x:t',
+    'Node($cmd[3])',
+    'Node($[1])',
+    'Node($a,$b,:fast)',
+    'Node<Core',
+    'Node(<Core)',
+    'Node<Core>PU',
+    'Node<-foo-<Core',
+    'Node<-foo[3]-<Core',
+    'Node<-->Core',
+    'Node<-bar[1:2]->Core',
+    'Node>-x->Core',
+    'Node>-->Core',
+    'Node>-with->Core',
+    'Node>-with[2]->Core',
+    'Node(<-x[2]-<Core)',
+    'Node(>Core,>Socket[2]:t,$run)',
+    'Node>Core>PU',
+    'Node>Core:x',
+    'Node[2]>Core[1:4]>PU$run',
+    'Node,Core',
+    ' Node , Socket[2]>Core[8]\n',
+    'Shard',
+    'Shard$run[4]',
+    'Task',
+    'Program>Node',
+    'Instance',
+    '@n1',
+    '@abc[2]>Core',
+    'Node=abc',
+    'Shard=abc',
+]
+
+# constructs deferred to the pyparsing grammar
+FALLBACK_CORPUS = [
+    'Node>(Core,Socket[2])',
+    'Node<-bar->(Core,Socket)',
+    'Node>-with[2]->(Core)',
+    'Node[-0]',
+]
+
+
+class TestDescent(unittest.TestCase):
+    def test_matches_pyparsing(self):
+        for s in DESCENT_CORPUS:
+            self.assertEqual(descent_canonicalize(s),
+                             canonicalize(s, parser='pyparsing'), s)
+
+    def test_fallback_matches_pyparsing(self):
+        for s in FALLBACK_CORPUS:
+            self.assertRaises(DescentFallback, descent_canonicalize, s)
+            self.assertEqual(canonicalize(s),
+                             canonicalize(s, parser='pyparsing'), s)
+
+    def test_rejects_invalid(self):
+        for s in ('', 'Node Core', 'Node[010]', 'Node[1:4:]', 'Node[2]M2',
+                  'Node(:t)>Core', 'Node>-x-<Core', 'Node[1]=x', 'Node,'):
+            self.assertRaises(DescentFallback, descent_canonicalize, s)
+
+    def test_error_position(self):
+        try:
+            canonicalize("Node[2]>Core[")
+        except ResourceStringError as e:
+            self.assertEqual(e.col, 13)
+            self.assertEqual(e.lineno, 1)
+        else:
+            self.fail("no ResourceStringError")
+
+    def test_default_parser(self):
+        self.assertEqual(DEFAULT_PARSER, 'descent')
+        self.assertRaises(ValueError, canonicalize, 'Node', parser='lalr')
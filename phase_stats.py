@@ -0,0 +1,245 @@
+"""
+Counters and cumulative timers for the phases of loading jobspecs.
+
+A Phase counts the times it was entered, the items it processed (vertices,
+documents, ...) and the wall time spent in it. Phases nest, e.g.
+canonicalize includes parse_resource_string, and a phase entered again
+from inside itself (recursion) only times the outermost entry. They are
+always on: entering and leaving one costs two clock reads and a few
+additions, reading them is what snapshot(), report() and to_json() do.
+Nesting is tracked per thread, so phases entered from several threads at
+once each time their own outermost entry; the counters are shared and
+updated without a lock, a concurrent increment may rarely be lost.
+
+In memory accounting mode (track_memory()) phases also add up how much the
+resident set grew while they ran, at the cost of reading /proc on every
+outermost entry and exit.
+"""
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import unittest
+import functools
+import collections
+
+clock = time.time
+
+# set by track_memory()
+tracking = False
+
+
+def rss_bytes():
+    """ Current resident set size"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def track_memory(on=True):
+    """ Switch memory accounting mode on or off"""
+    global tracking
+    tracking = on
+
+
+def deep_sizeof(obj):
+    """ sys.getsizeof of obj and everything held by the dicts, lists, tuples
+    and sets in it, objects reachable twice counted once"""
+    seen = set()
+    stack = [obj]
+    ret = 0
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        ret += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.iterkeys())
+            stack.extend(o.itervalues())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return ret
+
+
+class Phase(object):
+    __slots__ = ('name', 'calls', 'items', 'seconds', 'bytes', 'entered')
+
+    def __init__(self, name):
+        self.name = name
+        # depth, start time and start rss of the thread's outermost entry
+        self.entered = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.calls = self.items = self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def depth(self):
+        return getattr(self.entered, 'depth', 0)
+
+    def __enter__(self):
+        self.calls += 1
+        entered = self.entered
+        depth = getattr(entered, 'depth', 0)
+        if not depth:
+            entered.start_rss = rss_bytes() if tracking else None
+            entered.started = clock()
+        entered.depth = depth + 1
+        return self
+
+    def __exit__(self, *exc):
+        entered = self.entered
+        entered.depth -= 1
+        if not entered.depth:
+            self.seconds += clock() - entered.started
+            if entered.start_rss is not None:
+                self.bytes += rss_bytes() - entered.start_rss
+
+    def as_dict(self):
+        return {'calls': self.calls, 'items': self.items,
+                'seconds': self.seconds, 'bytes': self.bytes}
+
+
+# name -> Phase, in the order the phases were declared
+phases = collections.OrderedDict()
+
+
+def phase(name):
+    """ The Phase called name, created on first use"""
+    ret = phases.get(name, None)
+    if ret is None:
+        ret = phases[name] = Phase(name)
+    return ret
+
+
+def timed(name):
+    """ Decorator running every call of the function as phase name"""
+    p = phase(name)
+
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with p:
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def timed_iter(name, iterable):
+    """ Yield from iterable, timing the production of each item as phase
+    name"""
+    p = phase(name)
+    it = iter(iterable)
+    while True:
+        with p:
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            p.items += 1
+        yield item
+
+
+def reset():
+    for p in phases.itervalues():
+        p.reset()
+
+
+def snapshot():
+    """ {phase: {'calls', 'items', 'seconds', 'bytes'}} of the phases
+    entered so far, bytes being the growth of the resident set while they
+    ran in memory accounting mode"""
+    return collections.OrderedDict((name, p.as_dict())
+                                   for name, p in phases.iteritems()
+                                   if p.calls)
+
+
+def to_json(indent=None):
+    return json.dumps(snapshot(), indent=indent)
+
+
+def report():
+    """ The phases entered so far as a table"""
+    lines = ['%-24s %10s %10s %12s %10s' % ('phase', 'calls', 'items',
+                                             'seconds', 'MB')]
+    for name, p in snapshot().iteritems():
+        lines.append('%-24s %10d %10d %12.4f %10.1f' % (
+            name, p['calls'], p['items'], p['seconds'], p['bytes'] / 2.0 ** 20))
+    return '\n'.join(lines)
+
+
+class TestPhaseStats(unittest.TestCase):
+    def setUp(self):
+        self.saved = phases.copy()
+        phases.clear()
+
+    def tearDown(self):
+        phases.clear()
+        phases.update(self.saved)
+
+    def test_nesting(self):
+        @timed('walk')
+        def walk(n):
+            with phase('leaf'):
+                pass
+            if n:
+                walk(n - 1)
+        walk(3)
+        stats = snapshot()
+        self.assertEqual(stats['walk']['calls'], 4)
+        self.assertEqual(stats['leaf']['calls'], 4)
+        self.assertTrue(stats['walk']['seconds'] >= stats['leaf']['seconds'])
+        self.assertEqual(phase('walk').depth, 0)
+
+    def test_threads(self):
+        # a thread entering a phase another one is inside still times itself
+        inside, done = threading.Event(), threading.Event()
+
+        def hold():
+            with phase('shared'):
+                inside.set()
+                done.wait()
+        t = threading.Thread(target=hold)
+        t.start()
+        inside.wait()
+        self.assertEqual(phase('shared').depth, 0)
+        with phase('shared'):
+            time.sleep(0.05)
+        done.set()
+        t.join()
+        self.assertEqual(phase('shared').calls, 2)
+        self.assertTrue(phase('shared').seconds >= 0.1)
+
+    def test_iter_and_export(self):
+        self.assertEqual(list(timed_iter('docs', 'abc')), ['a', 'b', 'c'])
+        self.assertEqual(phase('docs').items, 3)
+        self.assertEqual(phase('docs').calls, 4)
+        self.assertEqual(json.loads(to_json())['docs']['items'], 3)
+        self.assertTrue(report().splitlines()[1].startswith('docs'))
+        reset()
+        self.assertEqual(snapshot(), {})
+
+    def test_memory(self):
+        track_memory()
+        try:
+            with phase('grow'):
+                block = ' ' * (64 << 20)
+                block = block.replace(' ', 'x')
+        finally:
+            track_memory(False)
+        self.assertTrue(phase('grow').bytes >= 32 << 20)
+        with phase('grow'):
+            block = None
+        self.assertTrue(phase('grow').bytes >= 32 << 20)
+
+    def test_deep_sizeof(self):
+        name = 'x' * 10000
+        doc = {'with': [{'name': name}, {'name': name}]}
+        self.assertTrue(10000 < deep_sizeof(doc) < 12000)
+        self.assertTrue(deep_sizeof([doc, doc]) - deep_sizeof(doc) < 100)
@@ -0,0 +1,506 @@
+"""
+Resident query daemon: named resource graphs kept in memory and served over
+a Unix socket, so clients stop paying for loading and building them.
+
+usage: python query_daemon.py [--socket PATH] [--workers N] [name=path ...]
+       python parse_job_spec.py serve ...
+
+Clients write one JSON request per line and read one JSON response per
+line. A request is an object with an "op" and its arguments, and an
+optional "id" echoed in its response; responses come back in the order
+requests finish, not the order they were sent.
+
+    ping
+    graphs                                loaded graphs and their sizes
+    load      graph, path [, compact, workers]
+                                          yaml jobspec, snapshot or columnar
+    unload    graph
+    query     graph, request | path [, limit, steps, seconds]
+    allocate  graph, job, request | path
+    release   graph, job
+    export    graph, format (snapshot | columnar), path
+    stats     request latency percentiles per op and the load phase stats
+
+request is a jobspec document (short form strings included), path a file
+holding one; graph defaults to "default". A response is {"ok": true,
+"result": ...} or {"ok": false, "error": "..."}.
+
+Cheap requests are answered on the connection's thread. Loading, matching
+and exporting run on a pool of worker threads, holding the lock of the
+graph they use: requests to one graph run one at a time, requests to
+different graphs and cheap ones do not wait for them. Parsing requests
+is serialized across all workers.
+"""
+import os
+import sys
+import errno
+import json
+import stat
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import unittest
+import itertools
+import collections
+import multiprocessing
+import SocketServer
+from multiprocessing.pool import ThreadPool
+
+import parse_job_spec as pjs
+import phase_stats
+import resource_match
+
+SOCKET = os.environ.get('RESOURCE_SOCKET', 'resource.sock')
+
+# latencies kept per op for the percentiles
+LATENCY_WINDOW = 10000
+
+
+class Latency(object):
+    """ Counts and the latest LATENCY_WINDOW latencies of requests per op"""
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.counts = collections.Counter()
+        self.errors = collections.Counter()
+
+    def record(self, op, seconds, ok):
+        with self.lock:
+            recent = self.recent.get(op, None)
+            if recent is None:
+                recent = self.recent[op] = collections.deque(
+                    maxlen=self.window)
+            recent.append(seconds)
+            self.counts[op] += 1
+            if not ok:
+                self.errors[op] += 1
+
+    def percentiles(self, ps=(50, 90, 99)):
+        """ {op: {'count', 'errors', 'p50', ..., 'max'}}, in seconds"""
+        with self.lock:
+            recent = dict((op, sorted(s)) for op, s in self.recent.iteritems())
+            counts, errors = dict(self.counts), dict(self.errors)
+        ret = {}
+        for op, s in recent.iteritems():
+            ret[op] = dict(('p%d' % p, pjs.percentile(s, p)) for p in ps)
+            ret[op].update(count=counts[op], errors=errors.get(op, 0),
+                           max=s[-1])
+        return ret
+
+
+class Loaded(object):
+    """ A named graph (or mapped ResourceTree) and the lock serializing the
+    requests using it"""
+
+    def __init__(self, resources, canonical, path):
+        self.resources = resources
+        self.canonical = canonical
+        self.path = path
+        self.lock = threading.Lock()
+
+    def describe(self):
+        mapped = isinstance(self.resources, resource_match.ResourceTree)
+        return {'path': self.path, 'mapped': mapped,
+                'vertices': len(self.resources) if mapped
+                else self.resources.num_vertices()}
+
+
+def plain(obj):
+    """ json default: numpy scalars and arrays as python values"""
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("not serializable: %r" % (obj,))
+
+
+class Queries(object):
+    """ The loaded graphs and the request handlers, apart from the
+    transport"""
+
+    # answered without going through the worker pool
+    CHEAP = frozenset(['ping', 'graphs', 'unload', 'stats'])
+
+    def __init__(self, workers=None):
+        self.graphs = {}
+        self.lock = threading.Lock()
+        # the pyparsing packrat cache is global: one request parsed at a time
+        self.parsing = threading.Lock()
+        self.pool = ThreadPool(workers or multiprocessing.cpu_count())
+        self.latency = Latency()
+        self.started = time.time()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def submit(self, request, reply, received=None):
+        """ Handle request and pass the response to reply, here for cheap
+        ops and on a worker otherwise"""
+        if request.get('op', None) in self.CHEAP:
+            reply(self.handle(request, received))
+        else:
+            self.pool.apply_async(
+                lambda: reply(self.handle(request, received)))
+
+    def handle(self, request, received=None):
+        """ The response to request, latency counted from received"""
+        if received is None:
+            received = time.time()
+        op = request.get('op', None)
+        fn = getattr(self, 'op_%s' % op, None)
+        try:
+            if fn is None:
+                raise ValueError("unknown op: %r" % (op,))
+            ret = {'ok': True, 'result': fn(request)}
+        except Exception as e:
+            ret = {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+        self.latency.record(op, time.time() - received, ret['ok'])
+        if 'id' in request:
+            ret['id'] = request['id']
+        return ret
+
+    def loaded(self, request):
+        name = request.get('graph', 'default')
+        with self.lock:
+            ret = self.graphs.get(name, None)
+        if ret is None:
+            raise ValueError("no graph loaded as " + name)
+        return ret
+
+    def canonical_request(self, request):
+        if 'path' in request:
+            with open(request['path']) as f, self.parsing:
+                return pjs.canonicalize(f)
+        if 'request' not in request:
+            raise ValueError("request or path needed")
+        # json is yaml: read back with the strings canonicalize expects
+        with self.parsing:
+            return pjs.canonicalize(json.dumps(request['request']))
+
+    def placements(self, tree, placements):
+        return {'placements': [resource_match.labelled(tree, p)
+                               for p in placements],
+                'hosts': resource_match.placed_hostlist(
+                    tree, list(itertools.chain(*placements)))}
+
+    def op_ping(self, request):
+        return {'uptime': time.time() - self.started}
+
+    def op_graphs(self, request):
+        with self.lock:
+            graphs = self.graphs.items()
+        return dict((name, loaded.describe()) for name, loaded in graphs)
+
+    def op_load(self, request):
+        path = request['path']
+        resources, canonical = pjs.load_resources(
+            path, request.get('compact', False), request.get('workers', None))
+        loaded = Loaded(resources, canonical, path)
+        with self.lock:
+            self.graphs[request.get('graph', 'default')] = loaded
+        return loaded.describe()
+
+    def op_unload(self, request):
+        loaded = self.loaded(request)
+        with self.lock:
+            self.graphs.pop(request.get('graph', 'default'), None)
+        return loaded.describe()
+
+    def op_query(self, request):
+        loaded = self.loaded(request)
+        match = self.canonical_request(request)
+        budget = resource_match.Budget(request.get('steps', None),
+                                       request.get('seconds', None))
+        with loaded.lock:
+            found = pjs.query(loaded.resources, match,
+                              request.get('limit', 1) or None, budget)
+            tree = pjs.resource_tree(loaded.resources)
+            matches = [self.placements(tree, p) for p in found]
+        return {'matches': matches, 'exhausted': budget.exhausted,
+                'steps': budget.used}
+
+    def op_allocate(self, request):
+        loaded = self.loaded(request)
+        match = self.canonical_request(request)
+        with loaded.lock:
+            allocator = pjs.allocation(loaded.resources)
+            placements = allocator.allocate(request['job'], match)
+            if placements is None:
+                return None
+            return self.placements(allocator.tree, placements)
+
+    def op_release(self, request):
+        loaded = self.loaded(request)
+        with loaded.lock:
+            pjs.allocation(loaded.resources).release(request['job'])
+
+    def op_export(self, request):
+        loaded = self.loaded(request)
+        fmt, path = request['format'], request['path']
+        with loaded.lock:
+            if fmt == 'columnar':
+                pjs.save_columnar(loaded.resources, path)
+            elif fmt == 'snapshot':
+                if isinstance(loaded.resources, resource_match.ResourceTree):
+                    raise ValueError("a mapped tree has no graph to snapshot")
+                pjs.save_snapshot(loaded.resources, path, loaded.canonical)
+            else:
+                raise ValueError("unknown export format: " + fmt)
+        return {'path': path}
+
+    def op_stats(self, request):
+        return {'latency': self.latency.percentiles(),
+                'phases': phase_stats.snapshot()}
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    """ One client connection: reads requests until the client closes its
+    side, then waits for the responses still being worked on"""
+
+    def handle(self):
+        queries = self.server.queries
+        written = threading.Condition()
+        state = {'pending': 0}
+
+        def reply(response):
+            try:
+                try:
+                    line = json.dumps(response, default=plain) + '\n'
+                except Exception as e:
+                    error = {'ok': False, 'error': 'unserializable response: '
+                             '%s: %s' % (type(e).__name__, e)}
+                    if 'id' in response:
+                        error['id'] = response['id']
+                    line = json.dumps(error) + '\n'
+                with written:
+                    try:
+                        self.wfile.write(line)
+                        self.wfile.flush()
+                    except socket.error:
+                        pass
+            finally:
+                # the connection is done once every request was answered
+                with written:
+                    state['pending'] -= 1
+                    written.notify()
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            received = time.time()
+            if not line.strip():
+                continue
+            with written:
+                state['pending'] += 1
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("a request is a json object")
+            except ValueError as e:
+                reply({'ok': False, 'error': 'bad request: %s' % e})
+                continue
+            queries.submit(request, reply, received)
+        with written:
+            while state['pending']:
+                written.wait()
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, queries):
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error as e:
+                if e.errno != errno.ECONNREFUSED:
+                    raise
+                # left behind by a daemon that did not exit cleanly
+                os.unlink(path)
+            else:
+                raise ValueError("a daemon is already serving on " + path)
+            finally:
+                probe.close()
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.path = path
+        self.queries = queries
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.queries.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def call(address, op, **args):
+    """ Send one request to the daemon listening on address and return its
+    result, raising ValueError with the error of a failed one"""
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(address)
+        s.sendall(json.dumps(dict(args, op=op)) + '\n')
+        s.shutdown(socket.SHUT_WR)
+        response = json.loads(s.makefile().readline())
+    finally:
+        s.close()
+    if not response['ok']:
+        raise ValueError(response['error'])
+    return response['result']
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='query_daemon.py')
+    parser.add_argument('--socket', default=SOCKET)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='matching threads, one per cpu by default')
+    parser.add_argument('graphs', nargs='*', metavar='name=path',
+                        help='graphs to load before serving')
+    args = parser.parse_args(argv)
+    queries = Queries(args.workers)
+    for spec in args.graphs:
+        name, _, path = spec.rpartition('=')
+        response = queries.handle({'op': 'load', 'graph': name or 'default',
+                                   'path': path})
+        if not response['ok']:
+            print >> sys.stderr, path + ':', response['error']
+            return 1
+    try:
+        server = Server(args.socket, queries)
+    except ValueError as e:
+        print >> sys.stderr, e
+        queries.close()
+        return 1
+    print "serving", ', '.join(sorted(queries.graphs)) or "no graphs", \
+        "on", args.socket
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # root > 4 nodes n01-n04 > (4 cores, 8 GB memory)
+        parent, types, count, pool = [-1], ['root'], [1], [False]
+        for n in range(4):
+            parent += [0, len(parent), len(parent)]
+            types += ['node', 'core', 'memory']
+            count += [1, 4, 8]
+            pool += [False, False, True]
+        tree = resource_match.ResourceTree.from_types(
+            parent, types, count=count, pool=pool,
+            names=resource_match.NameIndex([('n', '', 2, 1, 4, 1, 3)]))
+        self.columns = os.path.join(self.root, 'tree')
+        tree.save(self.columns)
+        self.path = os.path.join(self.root, 'sock')
+        self.server = Server(self.path, Queries(2))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_requests(self):
+        loaded = call(self.path, 'load', graph='c', path=self.columns)
+        self.assertEqual(loaded['vertices'], 13)
+        self.assertEqual(call(self.path, 'graphs').keys(), ['c'])
+        found = call(self.path, 'query', graph='c', request='Node[2]',
+                     limit=0)
+        self.assertEqual(len(found['matches']), 2)
+        placed = call(self.path, 'allocate', graph='c', job='a',
+                      request='Node[3]>Core[4]')
+        self.assertEqual(placed['hosts'], 'n[01-03]')
+        self.assertIsNone(call(self.path, 'allocate', graph='c', job='b',
+                               request='Node[2]'))
+        call(self.path, 'release', graph='c', job='a')
+        self.assertRaises(ValueError, call, self.path, 'query', graph='x',
+                          request='Node[1]')
+        latency = call(self.path, 'stats')['latency']
+        self.assertEqual(latency['allocate']['count'], 2)
+        self.assertEqual(latency['query']['errors'], 1)
+
+    def test_pipelined(self):
+        call(self.path, 'load', path=self.columns)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(self.path)
+        requests = [{'id': i, 'op': 'query',
+                     'request': 'Node[%d]' % (i % 5 + 1)} for i in range(20)]
+        requests += ['not json', {'id': 'p', 'op': 'ping'}]
+        s.sendall(''.join((r if isinstance(r, str) else json.dumps(r)) + '\n'
+                          for r in requests))
+        s.shutdown(socket.SHUT_WR)
+        responses = [json.loads(line) for line in s.makefile()]
+        s.close()
+        self.assertEqual(len(responses), len(requests))
+        by_id = dict((r.get('id'), r) for r in responses)
+        self.assertEqual(by_id[3]['result']['matches'][0]['hosts'],
+                         'n[01-04]')
+        self.assertEqual(by_id[4]['result']['matches'], [])
+        self.assertFalse(by_id[None]['ok'])
+        self.assertTrue(by_id['p']['ok'])
+
+    def test_socket_in_use(self):
+        self.assertRaises(ValueError, Server, self.path, Queries(1))
+        self.assertEqual(call(self.path, 'graphs'), {})
+        # a socket nobody listens on any more is taken over
+        stale = os.path.join(self.root, 'stale')
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(stale)
+        s.close()
+        server = Server(stale, Queries(1))
+        server.server_close()
+
+    def test_unserializable(self):
+        self.server.queries.op_query = lambda request: object()
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(self.path)
+        s.sendall(json.dumps({'id': 1, 'op': 'query'}) + '\n')
+        s.shutdown(socket.SHUT_WR)
+        responses = [json.loads(line) for line in s.makefile()]
+        s.close()
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0]['id'], 1)
+        self.assertIn('unserializable', responses[0]['error'])
+
+    def test_concurrent(self):
+        call(self.path, 'load', path=self.columns)
+        results, errors = {}, []
+
+        def client(i):
+            try:
+                for k in range(10):
+                    n = (i + k) % 5 + 1
+                    found = call(self.path, 'query',
+                                 request='Node[%d]>Core[%d]' % (n, k % 4 + 1))
+                    results[i, k] = (n, found['matches'])
+            except Exception as e:
+                errors.append(e)
+        clients = [threading.Thread(target=client, args=(i,))
+                   for i in range(8)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 80)
+        for n, matches in results.itervalues():
+            self.assertEqual(len(matches), 1 if n <= 4 else 0)
+        self.assertEqual(call(self.path, 'stats')['latency']['query']['count'],
+                         80)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
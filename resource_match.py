@@ -0,0 +1,1598 @@
+"""
+Count-aware matching of canonical jobspec requests against resource trees.
+
+A request (type, count, 'with' children) is treated as a tree pattern and
+matched bottom-up over a ResourceTree, a flat array view of the 'with'
+hierarchy of a resource graph. Each pattern node is evaluated with a few
+numpy passes per tree level, so a match costs O(pattern size x vertices)
+instead of the exponential search of generic subgraph isomorphism.
+
+Aggregate vertices (compact graphs) count as as many instances as their
+multiplicity and pool vertices provide their capacity in units.
+"""
+import os
+import re
+import json
+import time
+import heapq
+import bisect
+import unittest
+import itertools
+import collections
+import numpy as np
+import hostlist
+
+import parse_resource_string as prs
+
+
+def scatter_add(target, index, values):
+    """ target[index] += values for 1 or 2-d values with repeated indices,
+    much faster than np.add.at"""
+    if not len(index):
+        return
+    uniq, inverse = np.unique(index, return_inverse=True)
+    if values.ndim == 1:
+        sums = np.bincount(inverse, weights=values, minlength=len(uniq))
+    else:
+        sums = np.column_stack([
+            np.bincount(inverse, weights=values[:, j], minlength=len(uniq))
+            for j in range(values.shape[1])])
+    target[uniq] += sums.astype(target.dtype)
+
+
+def lift(below, parent, mult, vertices, rows, blocked=None):
+    """ Add rows, what vertices hold in all their instances, to the below
+    matrix of their ancestors: scaled by the instances of each ancestor on
+    the way up and not past blocked ones"""
+    p = parent[vertices]
+    while len(p):
+        has = p >= 0
+        p, rows = p[has], rows[has]
+        scatter_add(below, p, rows)
+        if blocked is not None:
+            keep = ~blocked[p]
+            p, rows = p[keep], rows[keep]
+        rows = rows * mult[p][:, None]
+        p = parent[p]
+
+
+def child_index(parent):
+    """ Children of each vertex as (child_ptr, child_idx): those of v are
+    child_idx[child_ptr[v]:child_ptr[v + 1]]"""
+    n = len(parent)
+    order = np.argsort(parent, kind='mergesort')
+    order = order[parent[order] >= 0]
+    ptr = np.zeros(n + 1, np.int64)
+    np.cumsum(np.bincount(parent[order], minlength=n), out=ptr[1:])
+    return ptr, order
+
+
+def widen(below, old_types, types, columns):
+    """ below with zero columns for the types and pool columns added since
+    it was computed, type columns coming first"""
+    if below.shape[1] == columns:
+        return below
+    ret = np.zeros((below.shape[0], columns), below.dtype)
+    ret[:, :old_types] = below[:, :old_types]
+    ret[:, types:types + below.shape[1] - old_types] = below[:, old_types:]
+    return ret
+
+
+def type_name(t):
+    """ The name a resource type goes by in trees and patterns: spellings
+    that differ only in case, Core from short forms and core from
+    documents, are one type"""
+    return t.lower()
+
+
+def type_table(names):
+    """ The sorted types of names and the code of each name in it"""
+    types = sorted(set(type_name(t) for t in names))
+    index = dict((t, i) for i, t in enumerate(types))
+    return types, dict((t, index[type_name(t)]) for t in set(names))
+
+
+class StringTable(object):
+    """ Strings stored back to back in data, string i being
+    data[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def from_strings(strings):
+        encoded = [s.encode('utf-8') if isinstance(s, unicode) else s
+                   for s in strings]
+        offsets = np.zeros(len(encoded) + 1, np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        data = np.frombuffer(''.join(encoded), np.uint8) if encoded else \
+            np.zeros(0, np.uint8)
+        return StringTable(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tostring()
+
+
+_numbered = re.compile(r'^(.*?)([0-9]+)([^0-9]*)$')
+
+
+def name_runs(names):
+    """ Compress a list of names into runs (prefix, suffix, width, start,
+    count, offset): names offset .. offset + count - 1 are prefix, the
+    numbers start .. start + count - 1 zero-padded to width, and suffix.
+    Names without a number are runs of one with width -1."""
+    runs = []
+    for offset, name in enumerate(names):
+        m = _numbered.match(name)
+        if m is None:
+            runs.append((name, '', -1, 0, 1, offset))
+            continue
+        prefix, digits, suffix = m.groups()
+        width = len(digits) if digits[0] == '0' and len(digits) > 1 else 0
+        number = int(digits)
+        if runs:
+            p, sfx, w, start, count, first = runs[-1]
+            if p == prefix and sfx == suffix and start + count == number and \
+                    first + count == offset and \
+                    (w == width or (w and len(digits) == w)):
+                runs[-1] = (p, sfx, w, start, count + 1, first)
+                continue
+        runs.append((prefix, suffix, width, number, 1, offset))
+    return runs
+
+
+class NameIndex(object):
+    """
+    Names of resources kept as compressed hostlist runs. A run of count
+    names belongs to the vertices first, first + stride, ... so neither
+    names nor per-vertex strings are stored. Names resolve to vertices and
+    vertices to names by bisection, O(log runs).
+    """
+
+    def __init__(self, runs=()):
+        # (prefix, suffix, width, start, count, first vertex, stride), None
+        # for runs split by discard()
+        self.runs = []
+        self.starts = {}  # (prefix, suffix, width) -> sorted [(start, run)]
+        self.firsts = []  # sorted [(first vertex, run)]
+        for run in runs:
+            self.add_run(*run)
+
+    def add_run(self, prefix, suffix, width, start, count, first, stride):
+        i = len(self.runs)
+        self.runs.append((prefix, suffix, width, start, count, first, stride))
+        bisect.insort(self.starts.setdefault((prefix, suffix, width), []),
+                      (start, i))
+        bisect.insort(self.firsts, (first, i))
+
+    def add(self, names, first, stride=1):
+        """ Name vertices first, first + stride, ... after names, a hostlist
+        expression or the list it expands to"""
+        if isinstance(names, basestring):
+            names = hostlist.expand_hostlist(names)
+        for prefix, suffix, width, start, count, offset in name_runs(names):
+            self.add_run(prefix, suffix, width, start, count,
+                         first + offset * stride, stride)
+
+    def discard(self, v):
+        """ Forget the name of vertex v, splitting its run"""
+        i = bisect.bisect_right(self.firsts, (v, len(self.runs))) - 1
+        if i < 0:
+            return
+        r = self.firsts[i][1]
+        prefix, suffix, width, start, count, first, stride = self.runs[r]
+        k, rest = divmod(v - first, stride)
+        if rest or k >= count:
+            return
+        self.runs[r] = None
+        self.starts[(prefix, suffix, width)].remove((start, r))
+        del self.firsts[i]
+        if k:
+            self.add_run(prefix, suffix, width, start, k, first, stride)
+        if k + 1 < count:
+            self.add_run(prefix, suffix, width, start + k + 1, count - k - 1,
+                         first + (k + 1) * stride, stride)
+
+    def live_runs(self):
+        return [run for run in self.runs if run is not None]
+
+    def __len__(self):
+        return sum(run[4] for run in self.live_runs())
+
+    def resolve(self, name):
+        """ Vertex named name, or None"""
+        m = _numbered.match(name)
+        if m is None:
+            keys = [((name, '', -1), 0)]
+        else:
+            prefix, digits, suffix = m.groups()
+            keys = [((prefix, suffix, len(digits)), int(digits))]
+            if digits[0] != '0' or len(digits) == 1:
+                keys.append(((prefix, suffix, 0), int(digits)))
+        for key, number in keys:
+            starts = self.starts.get(key, ())
+            i = bisect.bisect_right(starts, (number, len(self.runs))) - 1
+            if i < 0:
+                continue
+            prefix, suffix, width, start, count, first, stride = \
+                self.runs[starts[i][1]]
+            if number < start + count:
+                return first + (number - start) * stride
+        return None
+
+    def __getstate__(self):
+        return {'runs': self.live_runs()}
+
+    def __setstate__(self, state):
+        self.__init__(state['runs'])
+
+    def resolve_hostlist(self, expr):
+        """ Vertices of the names in a hostlist expression, unknown names
+        are skipped"""
+        ret = []
+        for name in hostlist.expand_hostlist(expr):
+            v = self.resolve(name)
+            if v is not None:
+                ret.append(v)
+        return ret
+
+    def name(self, v):
+        """ Name of vertex v, or None"""
+        i = bisect.bisect_right(self.firsts, (v, len(self.runs))) - 1
+        if i < 0:
+            return None
+        prefix, suffix, width, start, count, first, stride = \
+            self.runs[self.firsts[i][1]]
+        k, rest = divmod(v - first, stride)
+        if rest or k >= count:
+            return None
+        if width < 0:
+            return prefix
+        return prefix + str(start + k).zfill(width) + suffix
+
+    def hostlist(self, vertices):
+        """ The names of vertices as a compact hostlist expression"""
+        names = [self.name(v) for v in vertices]
+        return hostlist.collect_hostlist([n for n in names if n is not None])
+
+
+# arrays of a ResourceTree written by save() and mapped by open(), besides
+# the levels and labels
+MAPPED_ARRAYS = ('parent', 'type', 'count', 'pool', 'executable', 'unit',
+                 'mult', 'cap', 'depth', 'child_ptr', 'child_idx', 'column',
+                 'below')
+COLUMNAR_VERSION = 1
+
+
+class ResourceTree(object):
+    """
+    The 'with' hierarchy of a resource graph as arrays indexed by vertex:
+    parent (-1 for roots), type codes into types, count (count_max of the
+    graph: multiplicity, or capacity for pools), pool and executable.
+    Children always have larger indices than their parent. labels is a
+    sequence or a function of the vertex index, units maps pool vertices
+    to their unit and names is the NameIndex of named vertices.
+
+    below[v] holds what lies beneath one instance of v, one column per
+    entry of columns: a type name counts instances, a (type, unit) pair
+    the capacity of pools.
+
+    save() writes the arrays as a columnar directory that open() maps
+    read-only, so processes opening the same tree share one copy.
+
+    graft() and prune() add and remove resources in place, in time
+    proportional to the change: vertices are only ever appended and
+    removed ones keep their index with a count of 0.
+    """
+
+    def __init__(self, parent, type_codes, types, count=None, pool=None,
+                 labels=None, units=None, executable=None, names=None):
+        self.parent = np.asarray(parent, dtype=np.int64)
+        n = len(self.parent)
+        types = list(types)
+        self.types, codes = type_table(types)
+        self.type = np.asarray([codes[t] for t in types], np.int32)[
+            np.asarray(type_codes, np.int64)]
+        self.type_codes = dict((t, i) for i, t in enumerate(self.types))
+        self.count = np.ones(n, np.int64) if count is None else \
+            np.asarray(count, dtype=np.int64)
+        self.pool = np.zeros(n, np.bool_) if pool is None else \
+            np.asarray(pool, dtype=np.bool_)
+        self.executable = np.zeros(n, np.bool_) if executable is None else \
+            np.asarray(executable, dtype=np.bool_)
+        self.labels = labels
+        self.names = NameIndex() if names is None else names
+        self.path = None
+        # allocation state kept with the tree by its users
+        self.allocator = None
+        # children added by graft(), by parent
+        self.grafted = {}
+        # instances a vertex stands for, and units each instance provides
+        self.mult = np.where(self.pool, 1, self.count)
+        self.cap = np.where(self.pool, self.count, 1)
+        self.depth = np.zeros(n, np.int64)
+        p = self.parent.copy()
+        while True:
+            has = p >= 0
+            if not has.any():
+                break
+            self.depth[has] += 1
+            p[has] = self.parent[p[has]]
+        self.levels = [np.flatnonzero(self.depth == d)
+                       for d in range(int(self.depth.max()) + 1 if n else 0)]
+        # position of each vertex's parent within the level above
+        self.parent_pos = [np.zeros(len(self.levels[0]) if n else 0, np.int64)]
+        for d in range(1, len(self.levels)):
+            self.parent_pos.append(np.searchsorted(
+                self.levels[d - 1], self.parent[self.levels[d]]))
+        self.child_ptr, self.child_idx = child_index(self.parent)
+        self.columns = list(self.types)
+        self.column = self.type.astype(np.int64)
+        self.units = ['']
+        self.unit = np.zeros(n, np.int32)
+        column_codes = {}
+        for v in np.flatnonzero(self.pool):
+            unit = units[v] if units else ''
+            if unit not in self.units:
+                self.units.append(unit)
+            self.unit[v] = self.units.index(unit)
+            key = (self.types[self.type[v]], unit)
+            if key not in column_codes:
+                column_codes[key] = len(self.columns)
+                self.columns.append(key)
+            self.column[v] = column_codes[key]
+        self.index_columns()
+        self.below = self.subtree_counts(self.mult, self.cap)
+        # per level, the type codes present at or beneath it
+        self.level_types = []
+        for idx in self.levels:
+            present = set(np.unique(self.type[idx]))
+            for code, cols in enumerate(self.type_columns):
+                if self.below[idx][:, cols].any():
+                    present.add(code)
+            self.level_types.append(present)
+
+    def index_columns(self):
+        """ type_columns: the columns holding each type code, instances and
+        pools alike"""
+        self.type_columns = [[i] for i in range(len(self.types))]
+        for i, key in enumerate(self.columns[len(self.types):]):
+            self.type_columns[self.types.index(key[0])].append(
+                len(self.types) + i)
+
+    def save(self, path):
+        """ Write the tree as a columnar directory: one .npy file per array,
+        labels as a string table and the small tables in meta.json"""
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = dict((name, getattr(self, name)) for name in MAPPED_ARRAYS)
+        if self.grafted:
+            arrays['child_ptr'], arrays['child_idx'] = child_index(self.parent)
+        arrays['level_ptr'] = np.cumsum([0] + [len(l) for l in self.levels])
+        arrays['level_idx'] = np.concatenate(self.levels) if self.levels \
+            else np.zeros(0, np.int64)
+        arrays['parent_pos'] = np.concatenate(self.parent_pos) \
+            if self.levels else np.zeros(0, np.int64)
+        labels = StringTable.from_strings(
+            self.label(v) for v in range(len(self)))
+        arrays['label_offsets'] = labels.offsets
+        arrays['label_data'] = labels.data
+        for name, a in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), a)
+        meta = {'version': COLUMNAR_VERSION, 'types': self.types,
+                'columns': self.columns, 'units': self.units,
+                'level_types': [sorted(int(c) for c in l)
+                                for l in self.level_types],
+                'names': self.names.live_runs()}
+        # written last: a directory with meta.json is complete
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def open(path):
+        """ Map a tree written by save(), read-only and shared between all
+        processes opening it"""
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise ValueError("not a columnar resource tree: " + path)
+        if meta.get('version') != COLUMNAR_VERSION:
+            raise ValueError("unsupported columnar tree version %s: %s"
+                             % (meta.get('version'), path))
+        tree = ResourceTree.__new__(ResourceTree)
+        tree.path = path
+        tree.allocator = None
+        tree.grafted = {}
+        load = lambda name: np.load(os.path.join(path, name + '.npy'),
+                                    mmap_mode='r')
+        for name in MAPPED_ARRAYS:
+            setattr(tree, name, load(name))
+        tree.types = [str(t) for t in meta['types']]
+        tree.type_codes = dict((t, i) for i, t in enumerate(tree.types))
+        tree.columns = [str(c) if not isinstance(c, list) else
+                        (str(c[0]), str(c[1])) for c in meta['columns']]
+        tree.units = [str(u) for u in meta['units']]
+        tree.index_columns()
+        tree.level_types = [set(l) for l in meta['level_types']]
+        ptr, idx, pos = load('level_ptr'), load('level_idx'), load('parent_pos')
+        tree.levels = [idx[ptr[d]:ptr[d + 1]] for d in range(len(ptr) - 1)]
+        tree.parent_pos = [pos[ptr[d]:ptr[d + 1]] for d in range(len(ptr) - 1)]
+        tree.labels = StringTable(load('label_offsets'), load('label_data'))
+        tree.names = NameIndex(
+            [(str(r[0]), str(r[1])) + tuple(r[2:])
+             for r in meta.get('names', ())])
+        return tree
+
+    def private(self, name):
+        """ A writable copy of one of the arrays. Mapped trees map the file
+        copy-on-write: pages stay shared until they are written."""
+        if self.path is None:
+            return getattr(self, name).copy()
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='c')
+
+    def subtree_counts(self, mult, cap):
+        """ One post-order pass (deepest level first) accumulating the
+        below matrix for the given instances and capacities"""
+        below = np.zeros((len(self), len(self.columns)), np.int64)
+        for d in reversed(range(1, len(self.levels))):
+            idx = self.levels[d]
+            inside = below[idx]
+            inside[np.arange(len(idx)), self.column[idx]] += cap[idx]
+            inside *= mult[idx][:, None]
+            above = self.levels[d - 1]
+            for j in range(len(self.columns)):
+                below[above, j] += np.bincount(
+                    self.parent_pos[d], weights=inside[:, j],
+                    minlength=len(above)).astype(np.int64)
+        return below
+
+    def counts(self, v):
+        """ Nonzero entries of below[v] as a dict keyed by column"""
+        return dict((self.columns[i], int(c))
+                    for i, c in enumerate(self.below[v]) if c)
+
+    @staticmethod
+    def from_types(parent, types, **kwargs):
+        """ Build from per-vertex type names"""
+        table, codes = type_table(types)
+        return ResourceTree(parent, [codes[t] for t in types], table, **kwargs)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def nbytes(self):
+        """ Bytes held by the per-vertex and per-level arrays, mapped ones
+        included"""
+        ret = 0
+        for value in self.__dict__.itervalues():
+            if isinstance(value, np.ndarray):
+                ret += value.nbytes
+            elif isinstance(value, list):
+                ret += sum(a.nbytes for a in value if isinstance(a, np.ndarray))
+        return ret
+
+    def unit_of(self, v):
+        return self.units[self.unit[v]]
+
+    def children(self, v):
+        extra = self.grafted.get(v, None)
+        if v >= len(self.child_ptr) - 1:
+            return extra if extra is not None else self.child_idx[:0]
+        ret = self.child_idx[self.child_ptr[v]:self.child_ptr[v + 1]]
+        return ret if extra is None else np.concatenate((ret, extra))
+
+    def subtree(self, v):
+        """ v and every vertex beneath it"""
+        ret = [np.array([v], np.int64)]
+        frontier = [v]
+        while frontier:
+            level = [self.children(u) for u in frontier]
+            frontier = [int(c) for cs in level for c in cs]
+            ret.extend(level)
+        return np.concatenate(ret)
+
+    def content(self, vertices, mult, cap, below):
+        """ Rows of what vertices hold in all their instances: their own
+        column, cap units per instance, and everything beneath"""
+        rows = below[vertices].copy()
+        rows[np.arange(len(vertices)), self.column[vertices]] += \
+            cap[vertices]
+        return rows * mult[vertices][:, None]
+
+    def writable(self):
+        if self.path is not None:
+            raise ValueError("mapped resource tree is read-only: " + self.path)
+
+    def graft(self, parent, types, count=None, pool=None, units=None,
+              executable=None):
+        """ Append vertices below existing ones, or below each other with
+        parents first, and add them to the below of their ancestors.
+        units is the unit of each vertex, for pools. Returns the indices
+        of the new vertices."""
+        self.writable()
+        parent = np.asarray(parent, np.int64)
+        n, k = len(self), len(parent)
+        vids = np.arange(n, n + k, dtype=np.int64)
+        count = np.ones(k, np.int64) if count is None else \
+            np.asarray(count, np.int64)
+        pool = np.zeros(k, np.bool_) if pool is None else \
+            np.asarray(pool, np.bool_)
+        executable = np.zeros(k, np.bool_) if executable is None else \
+            np.asarray(executable, np.bool_)
+        # new types take the columns after the known ones, pool columns
+        # move up
+        old_types = len(self.types)
+        codes = np.zeros(k, np.int32)
+        for i, t in enumerate(types):
+            t = type_name(t)
+            code = self.type_codes.get(t, None)
+            if code is None:
+                code = self.type_codes[t] = len(self.types)
+                self.types.append(t)
+            codes[i] = code
+        added = len(self.types) - old_types
+        if added:
+            self.columns[old_types:old_types] = self.types[old_types:]
+            self.column[self.column >= old_types] += added
+        column = codes.astype(np.int64)
+        unit = np.zeros(k, np.int32)
+        for i in np.flatnonzero(pool):
+            u = units[i] if units is not None else ''
+            if u not in self.units:
+                self.units.append(u)
+            unit[i] = self.units.index(u)
+            key = (self.types[codes[i]], u)
+            if key not in self.columns:
+                self.columns.append(key)
+            column[i] = self.columns.index(key)
+        self.index_columns()
+        self.below = widen(self.below, old_types, len(self.types),
+                           len(self.columns))
+
+        depth = np.zeros(k, np.int64)
+        for i in range(k):
+            p = parent[i]
+            depth[i] = (depth[p - n] if p >= n else self.depth[p]) + 1 \
+                if p >= 0 else 0
+        append = lambda a, b: np.concatenate((a, b.astype(a.dtype)))
+        self.parent = append(self.parent, parent)
+        self.type = append(self.type, codes)
+        self.count = append(self.count, count)
+        self.pool = append(self.pool, pool)
+        self.executable = append(self.executable, executable)
+        self.mult = append(self.mult, np.where(pool, 1, count))
+        self.cap = append(self.cap, np.where(pool, count, 1))
+        self.depth = append(self.depth, depth)
+        self.unit = append(self.unit, unit)
+        self.column = append(self.column, column)
+        self.below = np.vstack((self.below, np.zeros(
+            (k, len(self.columns)), self.below.dtype)))
+
+        for d in np.unique(depth):
+            idx = vids[depth == d]
+            if d < len(self.levels):
+                self.levels[d] = np.concatenate((self.levels[d], idx))
+            else:
+                self.levels.append(idx)
+                self.parent_pos.append(np.zeros(0, np.int64))
+                self.level_types.append(set())
+        for d in np.unique(depth):
+            idx = vids[depth == d]
+            pos = np.searchsorted(self.levels[d - 1], self.parent[idx]) \
+                if d else np.zeros(len(idx), np.int64)
+            self.parent_pos[d] = np.concatenate((self.parent_pos[d], pos))
+            for code in np.unique(self.type[idx]):
+                for level in self.level_types[:d + 1]:
+                    level.add(code)
+        children = {}
+        for v, p in zip(vids, parent):
+            if p >= 0:
+                children.setdefault(int(p), []).append(v)
+        for p, cs in children.iteritems():
+            old = self.grafted.get(p, None)
+            cs = np.array(cs, np.int64)
+            self.grafted[p] = cs if old is None else np.concatenate((old, cs))
+
+        # deepest first: new parents collect their new children, existing
+        # ones pass them on to their ancestors
+        for d in reversed(np.unique(depth)):
+            idx = vids[depth == d]
+            rows = self.content(idx, self.mult, self.cap, self.below)
+            inner = self.parent[idx] >= n
+            scatter_add(self.below, self.parent[idx[inner]], rows[inner])
+            lift(self.below, self.parent, self.mult, idx[~inner], rows[~inner])
+        return vids
+
+    def prune(self, vertices):
+        """ Remove vertices and what lies beneath them: their count drops to
+        0 and their ancestors no longer hold them"""
+        self.writable()
+        for v in np.unique(np.asarray(vertices, np.int64)):
+            idx = np.array([v])
+            lift(self.below, self.parent, self.mult, idx,
+                 -self.content(idx, self.mult, self.cap, self.below))
+            self.count[v] = 0
+            if self.pool[v]:
+                self.cap[v] = 0
+            else:
+                self.mult[v] = 0
+
+    def type_of(self, v):
+        return self.types[self.type[v]]
+
+    def label(self, v):
+        if callable(self.labels):
+            return self.labels(v)
+        if self.labels is not None:
+            return self.labels[v]
+        return self.type_of(v) + '@' + str(v)
+
+
+class Pattern(object):
+    """ One node of a request: type, count range and child patterns"""
+
+    def __init__(self, type, count=None, children=()):
+        self.type = type_name(type)
+        if isinstance(count, int):
+            count = {'min': count}
+        self.count = dict(count or {'min': 1})
+        self.min = self.count.get('min', 1)
+        self.children = list(children)
+
+    def scaled(self, factor):
+        count = dict(self.count)
+        count['min'] = self.min * factor
+        if 'max' in count:
+            count['max'] = count['max'] * factor
+        return Pattern(self.type, count, self.children)
+
+    def __repr__(self):
+        return 'Pattern(%r, %r, %r)' % (self.type, self.count, self.children)
+
+
+def count_values(count):
+    """ The counts a range allows in increasing order, min first"""
+    value = count.get('min', 1)
+    top = count.get('max', None)
+    if top is None:
+        yield value
+        return
+    op = count.get('stride_operator', '+')
+    operand = count.get('stride_operand', 1)
+    while value <= top:
+        yield value
+        if op == '+':
+            nxt = value + operand
+        elif op == '*':
+            nxt = value * operand
+        elif op == '^':
+            nxt = value ** operand
+        else:  # decreasing strides only allow the minimum
+            break
+        if nxt <= value:
+            break
+        value = nxt
+
+
+def best_count(count, available):
+    """ Largest count the range allows that fits in available, or None"""
+    best = None
+    for value in count_values(count):
+        if value > available:
+            break
+        best = value
+    return best
+
+
+def patterns(request):
+    """ Normalize a canonical jobspec request into a list of Patterns.
+    Tasks are not resources and are skipped, programs contribute their
+    resources and slots are transparent: their children are requested
+    count(slot) times."""
+    if request is None:
+        return []
+    if isinstance(request, str):
+        return patterns(prs.parse_resource_string(request))
+    if isinstance(request, (list, tuple)):
+        ret = []
+        for r in request:
+            ret.extend(patterns(r))
+        return ret
+    if not isinstance(request, dict):
+        raise ValueError("invalid request: " + str(request))
+    ftype = request.get('ftype', None)
+    rtype = type_name(str(request.get('type', '')))
+    if ftype == 'program':
+        return patterns(request.get('resources', None))
+    if ftype == 'task' or rtype == 'task':
+        return []
+    count = request.get('count', None)
+    if isinstance(count, int):
+        count = {'min': count}
+    children = patterns(request.get('with', None))
+    if rtype == 'slot':
+        factor = (count or {}).get('min', 1)
+        return [c.scaled(factor) for c in children]
+    return [Pattern(rtype, count, children)]
+
+
+class Evaluation(object):
+    """ Per-vertex arrays for one pattern node: sat (the vertex satisfies
+    it), below (units found strictly below one instance of the vertex) and
+    provide (units one instance offers: cap if sat, below otherwise)"""
+
+    def __init__(self, pattern, sat, below, provide, children):
+        self.pattern = pattern
+        self.sat = sat
+        self.below = below
+        self.provide = provide
+        self.children = children
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class Budget(object):
+    """ Bounds a search by steps (vertices visited) and/or wall-clock
+    seconds, exhausted is set once either runs out"""
+
+    def __init__(self, steps=None, seconds=None):
+        self.steps = steps
+        self.deadline = None if seconds is None else time.time() + seconds
+        self.used = 0
+        self.exhausted = False
+
+    def charge(self, n=1):
+        self.used += n
+        if (self.steps is not None and self.used > self.steps) or \
+                (self.deadline is not None and time.time() > self.deadline):
+            self.exhausted = True
+            raise BudgetExceeded()
+
+
+class Free(object):
+    """ Resources not allocated yet: free instances per vertex (mult), free
+    units per instance (cap) and the free part of tree.below.
+
+    Drained vertices are blocked: their free units are held back and what
+    is released beneath them stays in their own below until resume()."""
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.mult = tree.private('mult')
+        self.cap = tree.private('cap')
+        self.below = tree.private('below')
+        self.blocked = np.zeros(len(tree), np.bool_)
+        self.held = np.zeros(len(tree), np.int64)
+        self.types = len(tree.types)
+
+    def copy(self):
+        ret = Free.__new__(Free)
+        ret.tree = self.tree
+        ret.mult = self.mult.copy()
+        ret.cap = self.cap.copy()
+        ret.below = self.below.copy()
+        ret.blocked = self.blocked.copy()
+        ret.held = self.held.copy()
+        ret.types = self.types
+        return ret
+
+    def grow(self):
+        """ Take in the vertices tree.graft() added, all of them free"""
+        tree = self.tree
+        n, k = len(self.mult), len(tree) - len(self.mult)
+        self.below = widen(self.below, self.types, len(tree.types),
+                           len(tree.columns))
+        self.types = len(tree.types)
+        if not k:
+            return
+        vids = np.arange(n, n + k)
+        self.mult = np.concatenate((self.mult, tree.mult[n:]))
+        self.cap = np.concatenate((self.cap, tree.cap[n:]))
+        self.below = np.vstack((self.below, tree.below[n:]))
+        self.blocked = np.concatenate((self.blocked, np.zeros(k, np.bool_)))
+        self.held = np.concatenate((self.held, np.zeros(k, np.int64)))
+        attached = vids[tree.parent[n:] < n]
+        lift(self.below, tree.parent, self.mult, attached,
+             tree.content(attached, self.mult, self.cap, self.below),
+             self.blocked)
+
+    def drain(self, vertices):
+        """ Hold back the free units of vertices and block them"""
+        for v in np.unique(np.asarray(vertices, np.int64)):
+            if self.blocked[v]:
+                continue
+            units = self.cap[v] if self.tree.pool[v] else self.mult[v]
+            self.allocate([(v, units)])
+            self.held[v] = units
+            self.blocked[v] = True
+
+    def resume(self, vertices):
+        """ Unblock drained vertices, freeing what they held back"""
+        for v in np.unique(np.asarray(vertices, np.int64)):
+            if not self.blocked[v]:
+                continue
+            self.blocked[v] = False
+            units, self.held[v] = self.held[v], 0
+            self.release([(v, units)])
+
+    def change(self, vertices, units):
+        """ Rows by which allocating units of vertices reduces their
+        ancestors: capacity for pools, whole instances and their content
+        otherwise"""
+        tree = self.tree
+        rows = np.zeros((len(vertices), len(tree.columns)), np.int64)
+        rows[np.arange(len(vertices)), tree.column[vertices]] = units
+        whole = ~tree.pool[vertices]
+        rows[whole] += units[whole, None] * self.below[vertices[whole]]
+        return rows
+
+    def update(self, vertices, rows):
+        """ Add rows to the ancestors of vertices, one level at a time, up to
+        the first blocked one, as lift does"""
+        lift(self.below, self.tree.parent, self.mult, vertices, rows,
+             self.blocked)
+
+    def allocate(self, taken):
+        """ Remove (vertex, units) pairs: pools lose capacity, everything
+        else whole instances. The pairs are disjoint subtrees."""
+        if not taken:
+            return
+        vertices, units = np.array(taken, np.int64).T
+        self.update(vertices, -self.change(vertices, units))
+        pool = self.tree.pool[vertices]
+        np.subtract.at(self.cap, vertices[pool], units[pool])
+        np.subtract.at(self.mult, vertices[~pool], units[~pool])
+
+    def release(self, taken):
+        """ Return (vertex, units) pairs taken by allocate"""
+        if not taken:
+            return
+        vertices, units = np.array(taken, np.int64).T
+        blocked = self.blocked[vertices]
+        if blocked.any():
+            np.add.at(self.held, vertices[blocked], units[blocked])
+            vertices, units = vertices[~blocked], units[~blocked]
+        pool = self.tree.pool[vertices]
+        np.add.at(self.cap, vertices[pool], units[pool])
+        np.add.at(self.mult, vertices[~pool], units[~pool])
+        self.update(vertices, self.change(vertices, units))
+
+    def available(self, code):
+        """ Free units of type code in the whole tree"""
+        tree = self.tree
+        roots = tree.levels[0] if tree.levels else np.zeros(0, np.int64)
+        cols = tree.type_columns[code]
+        inside = self.below[roots][:, cols].sum(axis=1)
+        inside += np.where(tree.type[roots] == code, self.cap[roots], 0)
+        return int((self.mult[roots] * inside).sum())
+
+
+def evaluate(tree, pattern, free=None, budget=None):
+    """ Bottom-up evaluation of pattern over tree, restricted to free
+    resources when given"""
+    free = Free(tree) if free is None else free
+    children = [evaluate(tree, c, free, budget) for c in pattern.children]
+    n = len(tree)
+    mult, cap = free.mult, free.cap
+    code = tree.type_codes.get(pattern.type, None)
+    sat = np.zeros(n, np.bool_)
+    below = np.zeros(n, np.int64)
+    provide = np.zeros(n, np.int64)
+    if code is None:
+        return Evaluation(pattern, sat, below, provide, children)
+    # subtrees without any free unit of the type can neither satisfy the
+    # pattern nor contribute to it
+    cols = tree.type_columns[code]
+    for level in reversed(range(len(tree.levels))):
+        if code not in tree.level_types[level]:
+            continue
+        idx = tree.levels[level]
+        inside = free.below[idx][:, cols].sum(axis=1) if len(cols) > 1 else \
+            free.below[idx, cols[0]]
+        is_type = tree.type[idx] == code
+        keep = (is_type | (inside > 0)) & (mult[idx] > 0)
+        idx, pos, is_type = idx[keep], tree.parent_pos[level][keep], \
+            is_type[keep]
+        if budget is not None:
+            budget.charge(len(idx))
+        s = is_type & (cap[idx] > 0)
+        for c in children:
+            s &= c.below[idx] >= c.pattern.min
+        sat[idx] = s
+        provide[idx] = np.where(s, cap[idx], below[idx])
+        if level:
+            above = tree.levels[level - 1]
+            below[above] += np.bincount(
+                pos, weights=mult[idx] * provide[idx],
+                minlength=len(above)).astype(np.int64)
+    ev = Evaluation(pattern, sat, below, provide, children)
+    ev.mult = mult
+    return ev
+
+
+def total(tree, ev):
+    """ Units of ev's pattern available in the whole tree"""
+    roots = tree.levels[0] if tree.levels else np.zeros(0, np.int64)
+    return int((ev.mult[roots] * ev.provide[roots]).sum())
+
+
+def select(tree, ev, candidates, need, taken=None, budget=None):
+    """ Pick need units of ev's pattern from candidates (vertices) in order.
+    Returns placements: dicts with the vertex, its type, how many of its
+    instances are used (count, units for pools) and the children placed
+    inside each, see labelled() to name them.
+    The (vertex, units) consumed are appended to taken: a matched vertex is
+    used whole, and so are instances of aggregates enclosing matches."""
+    out = []
+    candidates = np.asarray(candidates, np.int64)
+    amount = ev.mult[candidates] * ev.provide[candidates]
+    pos = np.flatnonzero(amount > 0)
+    if need <= 0 or not len(pos):
+        return out
+    # only the candidates up to the one completing need are visited
+    pos = pos[:np.searchsorted(np.cumsum(amount[pos]), need) + 1]
+    if budget is not None:
+        budget.charge(len(pos))
+    chosen = candidates[pos]
+    for c, per, mult, sat in zip(chosen.tolist(), ev.provide[chosen].tolist(),
+                                 ev.mult[chosen].tolist(),
+                                 ev.sat[chosen].tolist()):
+        take = min(need, mult * per)
+        need -= take
+        if sat:
+            out.append(place(tree, ev, c, take, budget))
+            if taken is not None:
+                taken.append((c, take))
+            continue
+        full, rest = divmod(take, per)
+        # what is taken inside an aggregate can not be told apart from its
+        # other instances: whole instances are taken instead
+        inner = taken if tree.mult[c] == 1 else None
+        if full:
+            out.append(enclosing(tree, c, full, select(
+                tree, ev, tree.children(c), per, inner, budget)))
+        if rest:
+            out.append(enclosing(tree, c, 1, select(
+                tree, ev, tree.children(c), rest, inner, budget)))
+        if taken is not None and inner is None:
+            taken.append((c, full + (1 if rest else 0)))
+    return out
+
+
+def enclosing(tree, v, count, inner):
+    """ Placement of count instances of v holding the inner placements"""
+    return {'vertex': v, 'type': tree.type_of(v), 'count': count,
+            'with': inner}
+
+
+def place(tree, ev, v, units, budget=None):
+    """ Placement of units of ev's pattern at v, which satisfies it"""
+    placed = {'vertex': v, 'type': tree.type_of(v), 'count': units}
+    with_ = []
+    for c in ev.children:
+        want = best_count(c.pattern.count, int(c.below[v]))
+        with_.extend(select(tree, c, tree.children(v), want, budget=budget))
+    if with_:
+        placed['with'] = with_
+    return placed
+
+
+def labelled(tree, placements):
+    """ Copy of placements with the label, and the name of named
+    vertices, added"""
+    ret = []
+    for p in placements:
+        p = dict(p, label=tree.label(p['vertex']))
+        name = tree.names.name(p['vertex'])
+        if name is not None:
+            p['name'] = name
+        if 'with' in p:
+            p['with'] = labelled(tree, p['with'])
+        ret.append(p)
+    return ret
+
+
+def placed(placements):
+    """ Vertices of placements and everything placed beneath them"""
+    ret = []
+    for p in placements:
+        ret.append(p['vertex'])
+        ret.extend(placed(p.get('with', ())))
+    return ret
+
+
+def placed_hostlist(tree, placements):
+    """ The named vertices among placements as a compact hostlist"""
+    return tree.names.hostlist(placed(placements))
+
+
+def match_once(tree, pats, free, taken, budget=None):
+    """ One match of all patterns disjointly within free, allocating what
+    it uses from free and recording it in taken. Returns one placement list
+    per pattern, or None."""
+    ret = []
+    roots = tree.levels[0] if tree.levels else ()
+    for p in pats:
+        code = tree.type_codes.get(p.type, None)
+        if code is None or free.available(code) < p.min:
+            return None
+        ev = evaluate(tree, p, free, budget)
+        want = best_count(p.count, total(tree, ev))
+        if want is None:
+            return None
+        used = []
+        ret.append(select(tree, ev, roots, want, used, budget))
+        free.allocate(used)
+        taken.extend(used)
+    return ret
+
+
+def iter_matches(tree, request, free=None, budget=None):
+    """ Lazily yield disjoint matches of request, each one using resources
+    left free by the ones before. Stops when no further match fits or the
+    budget runs out (budget.exhausted tells which)."""
+    pats = patterns(request)
+    if not pats:
+        return
+    free = Free(tree) if free is None else free
+    while True:
+        taken = []
+        try:
+            ret = match_once(tree, pats, free, taken, budget)
+        except BudgetExceeded:
+            ret = None
+        if ret is None:
+            free.release(taken)
+            return
+        yield ret
+
+
+def match(tree, request, free=None, budget=None):
+    """ Match a canonical request against tree, returns one placement list
+    per top-level request pattern, or None when it can not be satisfied"""
+    for ret in iter_matches(tree, request, free, budget):
+        return ret
+    return None
+
+
+def matches(tree, request, limit=1, free=None, budget=None):
+    """ Up to limit matches (None for all), fewer if the budget ran out"""
+    return list(itertools.islice(iter_matches(tree, request, free, budget),
+                                 limit))
+
+
+class Allocator(object):
+    """
+    Allocation state of a tree: which resources are held by which job.
+    owner[v] is the code of the job holding all of v (-1 when free or
+    shared, like pools and aggregates split between jobs), the units each
+    job took are kept per job so release costs O(allocated).
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.free = Free(tree)
+        self.owner = np.full(len(tree), -1, np.int32)
+        self.jobs = {}
+        self.codes = {}
+        self.job_ids = []
+
+    def allocate(self, job_id, request, budget=None):
+        """ Match request on free resources and hold them for job_id.
+        Returns the placements, or None leaving the state unchanged."""
+        if job_id in self.jobs:
+            raise ValueError("job already allocated: " + str(job_id))
+        pats = patterns(request)
+        taken = []
+        try:
+            ret = match_once(self.tree, pats, self.free, taken, budget)
+        except BudgetExceeded:
+            ret = None
+        if ret is None:
+            self.free.release(taken)
+            return None
+        code = self.codes.get(job_id, None)
+        if code is None:
+            code = self.codes[job_id] = len(self.job_ids)
+            self.job_ids.append(job_id)
+        self.jobs[job_id] = taken
+        for v, units in taken:
+            if not self.tree.pool[v] and self.tree.mult[v] == 1:
+                self.owner[v] = code
+        return ret
+
+    def release(self, job_id):
+        taken = self.jobs.pop(job_id, None)
+        if taken is None:
+            raise ValueError("unknown job: " + str(job_id))
+        self.free.release(taken)
+        for v, units in taken:
+            self.owner[v] = -1
+
+    def allocated(self):
+        """ Boolean array of vertices held whole by some job"""
+        return self.owner >= 0
+
+    def grow(self):
+        """ Take in the vertices tree.graft() added, all of them free"""
+        self.free.grow()
+        self.owner = np.concatenate((self.owner, np.full(
+            len(self.tree) - len(self.owner), -1, np.int32)))
+
+    def drain(self, vertices):
+        """ Stop handing out vertices: their free units are held back now,
+        the rest as the jobs holding them release it"""
+        self.free.drain(vertices)
+
+    def resume(self, vertices):
+        """ Hand out drained vertices again"""
+        vertices = np.asarray(vertices, np.int64)
+        gone = vertices[self.tree.count[vertices] == 0]
+        if len(gone):
+            raise ValueError("removed resources: " + str(list(gone)))
+        self.free.resume(vertices)
+
+    def remove(self, vertices):
+        """ Drain vertices for good and prune them from the tree"""
+        self.free.drain(vertices)
+        self.tree.prune(vertices)
+
+    def owned_by(self, job_id):
+        return [v for v, units in self.jobs.get(job_id, ())]
+
+    def query(self, request, limit=1, budget=None):
+        """ Up to limit matches on the free resources, allocating nothing"""
+        return matches(self.tree, request, limit, self.free.copy(), budget)
+
+    def usage(self):
+        """ Allocated and total amount per column of the whole tree"""
+        tree = self.tree
+        roots = tree.levels[0] if tree.levels else np.zeros(0, np.int64)
+        total = (tree.mult[roots][:, None] * tree.below[roots]).sum(axis=0)
+        free = (self.free.mult[roots][:, None] *
+                self.free.below[roots]).sum(axis=0)
+        return dict((c, (int(t - f), int(t)))
+                    for c, t, f in zip(tree.columns, total, free) if t)
+
+
+def fits(tree, request, free):
+    """ Whether request has a match within free, which is left unchanged"""
+    taken = []
+    try:
+        return match_once(tree, patterns(request), free, taken) is not None
+    finally:
+        free.release(taken)
+
+
+ReplayStats = collections.namedtuple('ReplayStats',
+        ['started', 'completed', 'rejected', 'pending', 'max_wait'])
+
+
+def replay(allocator, jobs):
+    """
+    Replay (submit_time, duration, job_id, request) submissions in time
+    order: jobs start first come first served as soon as they fit, and
+    those that do not fit even on an empty machine are rejected.
+    """
+    jobs = sorted(jobs, key=lambda j: j[0])
+    ends = []  # heap of (end time, job id)
+    queue = collections.deque()
+    waits = [0]
+    started = completed = rejected = 0
+
+    def start_queued(now):
+        count = 0
+        while queue:
+            submit, duration, job_id, request = queue[0]
+            if allocator.allocate(job_id, request) is None:
+                break
+            queue.popleft()
+            heapq.heappush(ends, (now + duration, job_id))
+            count += 1
+            waits.append(now - submit)
+        return count
+
+    empty = Free(allocator.tree)
+    for submit, duration, job_id, request in jobs:
+        while ends and ends[0][0] <= submit:
+            now, done = heapq.heappop(ends)
+            allocator.release(done)
+            completed += 1
+            started += start_queued(now)
+        queue.append((submit, duration, job_id, request))
+        started += start_queued(submit)
+        # only jobs that have to wait are checked against the empty machine
+        if queue and queue[-1][2] == job_id and \
+                not fits(allocator.tree, request, empty):
+            queue.pop()
+            rejected += 1
+    while ends:
+        now, done = heapq.heappop(ends)
+        allocator.release(done)
+        completed += 1
+        started += start_queued(now)
+    return ReplayStats(started, completed, rejected, len(queue), max(waits))
+
+
+class TestMatch(unittest.TestCase):
+    def setUp(self):
+        # root > 2 racks > 2 nodes > (2 sockets > 4 cores, memory pool 16)
+        parent, types, count, pool = [-1], ['root'], [1], [False]
+
+        def add(p, t, c=1, is_pool=False):
+            parent.append(p)
+            types.append(t)
+            count.append(c)
+            pool.append(is_pool)
+            return len(parent) - 1
+        for r in range(2):
+            rack = add(0, 'rack')
+            for n in range(2):
+                node = add(rack, 'node')
+                for s in range(2):
+                    add(add(node, 'socket'), 'core', 4)
+                add(node, 'memory', 16, True)
+        self.tree = ResourceTree.from_types(parent, types, count=count,
+                                            pool=pool)
+
+    def units(self, placements, t):
+        """ Total units of type t in a placement list"""
+        ret = 0
+        for p in placements:
+            inner = self.units(p.get('with', []), t)
+            ret += p['count'] * (1 if p['type'] == t else inner)
+        return ret
+
+    def of_type(self, placements, t):
+        """ The outermost placements of type t"""
+        ret = []
+        for p in placements:
+            if p['type'] == t:
+                ret.append(p)
+            else:
+                ret.extend(self.of_type(p.get('with', []), t))
+        return ret
+
+    def test_simple(self):
+        ret = match(self.tree, {'type': 'node', 'count': {'min': 3}})
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(self.units(ret[0], 'node'), 3)
+        self.assertEqual([p['type'] for p in ret[0]], ['root'])
+        self.assertEqual(len(self.of_type(ret[0], 'rack')), 2)
+        self.assertIsNone(match(self.tree, {'type': 'node',
+                                            'count': {'min': 5}}))
+
+    def test_count_constraints(self):
+        # a node only has 8 cores, sockets 4
+        req = {'type': 'Node', 'count': {'min': 2},
+               'with': [{'type': 'core', 'count': {'min': 6}}]}
+        ret = match(self.tree, req)
+        self.assertEqual(self.units(ret[0], 'node'), 2)
+        for p in self.of_type(ret[0], 'node'):
+            self.assertEqual(self.units(p['with'], 'core'), 6)
+        req['with'][0]['count'] = {'min': 9}
+        self.assertIsNone(match(self.tree, req))
+        req = {'type': 'socket', 'with': [{'type': 'core',
+                                           'count': {'min': 5}}]}
+        self.assertIsNone(match(self.tree, req))
+
+    def test_ranges_and_pools(self):
+        req = {'type': 'node', 'count': {'min': 1, 'max': 8,
+                                         'stride_operator': '*',
+                                         'stride_operand': 2}}
+        self.assertEqual(self.units(match(self.tree, req)[0], 'node'), 4)
+        req = {'type': 'node', 'with': [{'type': 'memory',
+                                         'count': {'min': 10}}]}
+        placed = self.of_type(match(self.tree, req)[0], 'memory')
+        self.assertEqual([p['count'] for p in placed], [10])
+        req['with'][0]['count'] = {'min': 17}
+        self.assertIsNone(match(self.tree, req))
+
+    def test_slots_and_tasks(self):
+        req = [{'type': 'slot', 'count': {'min': 2},
+                'with': [{'type': 'node', 'count': {'min': 2}}]},
+               {'type': 'task', 'command': 'app'}]
+        ret = match(self.tree, req)
+        self.assertEqual(len(ret), 1)
+        self.assertEqual(self.units(ret[0], 'node'), 4)
+
+    def test_aggregates(self):
+        # the same machine in compact form: node[4] > socket[2] > core[4]
+        tree = ResourceTree.from_types(
+            [-1, 0, 1, 2], ['root', 'node', 'socket', 'core'],
+            count=[1, 4, 2, 4])
+        req = {'type': 'node', 'count': {'min': 3},
+               'with': [{'type': 'core', 'count': {'min': 6}}]}
+        node, = self.of_type(match(tree, req)[0], 'node')
+        self.assertEqual(node['count'], 3)
+        self.assertEqual(self.units(node['with'], 'core'), 6)
+        req['count'] = {'min': 5}
+        self.assertIsNone(match(tree, req))
+
+    def test_short_form(self):
+        self.assertIsNotNone(match(self.tree, 'Rack[2]>Node[2]>Core[8]'))
+        self.assertIsNone(match(self.tree, 'Rack[2]>Node[3]'))
+
+    def test_mixed_case(self):
+        # nodes from short forms (Core) and from documents (core)
+        parent, types = [-1], ['cluster']
+        for t in ['Core', 'Core', 'core', 'core']:
+            parent += [0, len(parent)]
+            types += ['Node', t]
+        tree = ResourceTree.from_types(parent, types, count=[1] + [1, 4] * 4)
+        self.assertEqual(tree.types, ['cluster', 'core', 'node'])
+        self.assertEqual(tree.counts(0), {'node': 4, 'core': 16})
+        self.assertIsNotNone(match(tree, 'Node[4]>Core[4]'))
+        ret = match(tree, {'type': 'node', 'count': {'min': 4},
+                           'with': [{'type': 'core', 'count': {'min': 4}}]})
+        self.assertEqual(self.units(ret[0], 'core'), 16)
+        tree.graft([1], ['CORE'], count=[2])
+        self.assertEqual(tree.counts(0), {'node': 4, 'core': 18})
+
+    def test_subtree_counts(self):
+        rack = self.tree.children(0)[0]
+        self.assertEqual(self.tree.counts(rack),
+                         {'node': 2, 'socket': 4, 'core': 16,
+                          ('memory', ''): 32})
+        self.assertEqual(self.tree.counts(0)['core'], 32)
+        tree = ResourceTree.from_types(
+            [-1, 0, 1, 2, 1], ['root', 'node', 'socket', 'core', 'memory'],
+            count=[1, 4, 2, 4, 64], pool=[0, 0, 0, 0, 1],
+            units={4: 'GB'})
+        self.assertEqual(tree.counts(0), {'node': 4, 'socket': 8, 'core': 32,
+                                          ('memory', 'GB'): 256})
+
+    def test_allocate_release(self):
+        free = Free(self.tree)
+        req = {'type': 'node', 'with': [{'type': 'memory',
+                                         'count': {'min': 10}}]}
+        found = matches(self.tree, req, limit=3, free=free)
+        self.assertEqual(len(found), 3)
+        self.assertEqual(free.available(self.tree.type_codes['node']), 1)
+        # the incremental totals agree with a fresh post-order pass
+        expected = self.tree.subtree_counts(free.mult, free.cap)
+        self.assertTrue((free.below == expected).all())
+        taken = [(self.tree.levels[2][0], 1)]
+        free.release(taken)
+        self.assertEqual(free.available(self.tree.type_codes['node']), 2)
+        free.allocate(taken)
+        # a pool pattern skips the allocated nodes' memory
+        mem = {'type': 'memory', 'count': {'min': 16}}
+        self.assertEqual(len(matches(self.tree, mem, None, free)), 1)
+        self.assertTrue((free.below ==
+                         self.tree.subtree_counts(free.mult, free.cap)).all())
+
+    def test_pruning(self):
+        budget = Budget()
+        match(self.tree, {'type': 'rack'}, budget=budget)
+        # root and racks are evaluated, root and one rack selected; nothing
+        # below the racks is visited
+        self.assertEqual(budget.used, 3 + 2)
+
+    def test_labelled(self):
+        ret = labelled(self.tree, match(self.tree, 'Node[1]>Core[1]')[0])
+        node, = self.of_type(ret, 'node')
+        self.assertEqual(node['label'], 'node@2')
+        self.assertEqual(node['with'][0]['with'][0]['label'], 'core@4')
+
+    def test_limit(self):
+        req = {'type': 'node', 'with': [{'type': 'core', 'count': {'min': 4}}]}
+        found = matches(self.tree, req, limit=None)
+        self.assertEqual(len(found), 4)
+        nodes = [p['vertex'] for m in found
+                 for p in self.of_type(m[0], 'node')]
+        self.assertEqual(len(set(nodes)), 4)
+        self.assertEqual(len(matches(self.tree, req, limit=2)), 2)
+        # patterns of one request do not overlap either
+        self.assertIsNone(match(self.tree, [{'type': 'node', 'count': 3},
+                                            {'type': 'node', 'count': 2}]))
+
+    def test_budget(self):
+        req = {'type': 'core'}
+        budget = Budget(steps=len(self.tree) * 3)
+        found = matches(self.tree, req, limit=None, budget=budget)
+        self.assertTrue(budget.exhausted)
+        self.assertTrue(0 < len(found) < 32)
+        budget = Budget(seconds=60)
+        self.assertEqual(len(matches(self.tree, req, None, budget=budget)), 32)
+        self.assertFalse(budget.exhausted)
+
+
+class TestAllocator(unittest.TestCase):
+    def setUp(self):
+        # root > 4 nodes > (4 cores, memory pool 8)
+        parent, types, count, pool = [-1], ['root'], [1], [False]
+        for n in range(4):
+            parent += [0, len(parent), len(parent)]
+            types += ['node', 'core', 'memory']
+            count += [1, 4, 8]
+            pool += [False, False, True]
+        self.tree = ResourceTree.from_types(parent, types, count=count,
+                                            pool=pool)
+        self.alloc = Allocator(self.tree)
+
+    def test_allocate_release(self):
+        req = {'type': 'node', 'count': {'min': 3}}
+        self.assertIsNotNone(self.alloc.allocate('a', req))
+        self.assertEqual(self.alloc.allocated().sum(), 3)
+        self.assertEqual(self.alloc.usage()['node'], (3, 4))
+        self.assertIsNone(self.alloc.allocate('b', req))
+        self.assertEqual(len(self.alloc.query({'type': 'node'}, None)), 1)
+        self.assertRaises(ValueError, self.alloc.allocate, 'a', req)
+        self.alloc.release('a')
+        self.assertEqual(self.alloc.allocated().sum(), 0)
+        self.assertEqual(self.alloc.usage()['node'], (0, 4))
+        self.assertIsNotNone(self.alloc.allocate('b', req))
+        self.assertRaises(ValueError, self.alloc.release, 'a')
+
+    def test_aggregates(self):
+        # compact Node[2]>Core[4]: one aggregate vertex per level
+        tree = ResourceTree.from_types([-1, 0, 1], ['root', 'node', 'core'],
+                                       count=[1, 2, 4])
+        alloc = Allocator(tree)
+        fresh = alloc.free.below.copy()
+        self.assertIsNotNone(alloc.allocate('a', {'type': 'core', 'count': 4}))
+        self.assertIsNotNone(alloc.allocate('b', {'type': 'core', 'count': 1}))
+        self.assertEqual(alloc.usage()['core'], (8, 8))
+        alloc.release('a')
+        alloc.release('b')
+        self.assertEqual(alloc.usage()['core'], (0, 8))
+        self.assertEqual(alloc.free.below.tolist(), fresh.tolist())
+        self.assertIsNotNone(alloc.allocate('c', {'type': 'core', 'count': 8}))
+
+    def test_shared_pools(self):
+        mem = {'type': 'memory', 'count': {'min': 6}}
+        self.assertIsNotNone(self.alloc.allocate('a', mem))
+        self.assertIsNotNone(self.alloc.allocate('b', mem))
+        self.assertEqual(self.alloc.usage()[('memory', '')], (12, 32))
+        self.assertEqual(self.alloc.allocated().sum(), 0)
+        self.alloc.release('a')
+        self.assertEqual(self.alloc.usage()[('memory', '')], (6, 32))
+
+    def test_replay(self):
+        node = {'type': 'node', 'count': {'min': 2}}
+        jobs = [(0, 10, 'a', node), (1, 10, 'b', node), (2, 5, 'c', node),
+                (3, 1, 'd', {'type': 'node', 'count': {'min': 5}})]
+        stats = replay(self.alloc, jobs)
+        self.assertEqual(stats, ReplayStats(3, 3, 1, 0, 8))
+        self.assertEqual(self.alloc.usage()['node'], (0, 4))
+
+
+class TestDelta(unittest.TestCase):
+    setUp = TestAllocator.__dict__['setUp']
+
+    def node(self, parent):
+        """ A node with 4 cores and memory 8 grafted under parent"""
+        n = len(self.tree)
+        return self.tree.graft([parent, n, n], ['node', 'core', 'memory'],
+                               count=[1, 4, 8], pool=[False, False, True])
+
+    def test_graft(self):
+        self.alloc.allocate('a', {'type': 'node', 'count': {'min': 4}})
+        node = self.node(0)[0]
+        self.alloc.grow()
+        self.assertEqual(self.tree.counts(0), {'node': 5, 'core': 20,
+                                               ('memory', ''): 40})
+        self.assertEqual(list(self.tree.children(0))[-1], node)
+        self.assertEqual(self.alloc.usage()['core'], (16, 20))
+        self.assertIsNotNone(self.alloc.allocate('b', 'Node[1]>Core[2]'))
+        self.assertTrue(set(self.alloc.owned_by('b')) <=
+                        set(self.tree.subtree(node)))
+        # a type the tree has not seen yet moves the pool columns
+        gpu, = self.tree.graft([node], ['gpu'], count=[2])
+        self.alloc.grow()
+        self.assertEqual(self.tree.counts(0)[('memory', '')], 40)
+        self.assertEqual(self.tree.counts(node), {'core': 4, 'gpu': 2,
+                                                  ('memory', ''): 8})
+        # added to a node b holds
+        self.assertEqual(self.alloc.usage()['gpu'], (2, 2))
+        self.alloc.release('b')
+        self.assertEqual(self.alloc.usage()['gpu'], (0, 2))
+        self.assertIsNotNone(self.alloc.query('Node[1]>GPU[2]'))
+
+    def test_drain(self):
+        nodes = self.tree.levels[1]
+        self.alloc.allocate('a', {'type': 'node'})
+        self.alloc.drain(nodes[:2])
+        self.assertEqual(self.alloc.usage()['node'], (2, 4))
+        self.alloc.release('a')
+        # released into the drained node, not back to the pool of free ones
+        self.assertEqual(self.alloc.usage()['node'], (2, 4))
+        self.assertIsNone(self.alloc.allocate('b', 'Node[3]'))
+        self.alloc.resume(nodes[:2])
+        self.assertEqual(self.alloc.usage(), Allocator(self.tree).usage())
+        self.assertIsNotNone(self.alloc.allocate('b', 'Node[4]'))
+
+    def test_remove(self):
+        node = self.tree.levels[1][0]
+        self.alloc.allocate('a', 'Node[1]>Core[2]')
+        self.alloc.remove([node])
+        self.assertEqual(self.alloc.usage()['node'], (0, 3))
+        self.assertEqual(self.alloc.usage()['core'], (0, 12))
+        self.alloc.release('a')
+        self.assertEqual(self.alloc.usage()['core'], (0, 12))
+        self.assertRaises(ValueError, self.alloc.resume, [node])
+        self.assertIsNone(self.alloc.allocate('b', 'Node[4]'))
+        self.assertEqual(len(self.tree.subtree(node)), 3)
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.root = tempfile.mkdtemp()
+        self.tree = ResourceTree.from_types(
+            [-1, 0, 1, 1, 0, 4, 4], ['root', 'node', 'core', 'memory', 'node',
+                                     'core', 'memory'],
+            count=[1, 1, 4, 16, 1, 4, 16], pool=[0, 0, 0, 1, 0, 0, 1],
+            units={3: 'GB', 6: 'GB'}, executable=[0, 1, 0, 0, 1, 0, 0],
+            names=NameIndex([('n', '', 2, 1, 2, 1, 3)]))
+        self.path = os.path.join(self.root, 'tree')
+        self.tree.save(self.path)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.root)
+
+    def test_roundtrip(self):
+        mapped = ResourceTree.open(self.path)
+        self.assertTrue(isinstance(mapped.below, np.memmap))
+        self.assertEqual(mapped.counts(0), self.tree.counts(0))
+        self.assertEqual(mapped.unit_of(3), 'GB')
+        self.assertEqual(list(mapped.executable), list(self.tree.executable))
+        self.assertEqual(mapped.label(5), 'core@5')
+        self.assertEqual(mapped.names.resolve('n02'), 4)
+        req = 'Node[2]>Memory[8]'
+        self.assertEqual(match(mapped, req), match(self.tree, req))
+
+    def test_private_state(self):
+        mapped = ResourceTree.open(self.path)
+        alloc = Allocator(mapped)
+        self.assertIsNotNone(alloc.allocate('a', {'type': 'node'}))
+        self.assertEqual(alloc.usage()['node'], (1, 2))
+        # allocations stay private to the process that made them
+        other = Allocator(ResourceTree.open(self.path))
+        self.assertEqual(other.usage()['node'], (0, 2))
+        self.assertRaises(ValueError, ResourceTree.open, self.root)
+
+
+class TestNameIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = NameIndex()
+        # 154 nodes of 3 vertices each, then a padded range and a login node
+        self.index.add('hype[201-354]', 10, 3)
+        self.index.add('n[008-011]x,login', 1000)
+
+    def test_runs(self):
+        self.assertEqual(name_runs(['n9', 'n10', 'n08', 'n09', 'login']),
+                         [('n', '', 0, 9, 2, 0), ('n', '', 2, 8, 2, 2),
+                          ('login', '', -1, 0, 1, 4)])
+        self.assertEqual(len(self.index.runs), 3)
+        self.assertEqual(len(self.index), 159)
+
+    def test_resolve(self):
+        self.assertEqual(self.index.resolve('hype201'), 10)
+        self.assertEqual(self.index.resolve('hype354'), 10 + 153 * 3)
+        self.assertEqual(self.index.resolve('n010x'), 1002)
+        self.assertEqual(self.index.resolve('login'), 1004)
+        for unknown in ('hype355', 'hype0201', 'n10x', 'logon'):
+            self.assertIsNone(self.index.resolve(unknown))
+        self.assertEqual(self.index.resolve_hostlist('hype[201-202],login'),
+                         [10, 13, 1004])
+
+    def test_names(self):
+        self.assertEqual(self.index.name(13), 'hype202')
+        self.assertEqual(self.index.name(1001), 'n009x')
+        self.assertIsNone(self.index.name(11))
+        self.assertIsNone(self.index.name(1005))
+        self.assertEqual(self.index.hostlist([10, 11, 13, 16, 1000, 1004]),
+                         'hype[201-203],login,n008x')
+        import cPickle
+        index = cPickle.loads(cPickle.dumps(self.index, 2))
+        self.assertEqual(index.resolve('n011x'), 1003)